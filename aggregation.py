@@ -0,0 +1,154 @@
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional
+
+from analysis_pipeline import categorize_items, map_items_to_categories
+from text_utils import normalize_item
+
+# Analysis result field -> category_type used by the categorization prompts
+KINDS = {"themes": "theme", "emotions": "emotion"}
+# Items the categorizer could not place; kept so they are never sent again
+UNCATEGORIZED = "Other"
+
+
+class IncrementalAggregator:
+    """
+    Running per-substance theme and emotion counts, raw and by broad category.
+
+    add() only updates counters. flush() maps the items seen for the first time onto the
+    existing broad categories, so its cost grows with the new vocabulary rather than the
+    whole corpus. The broad categories themselves are only recomputed over the full
+    vocabulary once more than `recategorize_threshold` unseen items have accumulated
+    since the last full categorization.
+    """
+
+    def __init__(
+        self,
+        categorizer: str = "llm",
+        recategorize_threshold: int = 200,
+        max_concurrency: int = 4,
+    ):
+        self.categorizer = categorizer
+        self.recategorize_threshold = recategorize_threshold
+        self.max_concurrency = max_concurrency
+        self.report_count = 0
+        self.report_keys = set()
+        self.raw_counts = {kind: defaultdict(Counter) for kind in KINDS}
+        self.category_counts = {kind: defaultdict(Counter) for kind in KINDS}
+        self.broad_categories: Dict[str, List[str]] = {kind: [] for kind in KINDS}
+        self.item_categories: Dict[str, Dict[str, str]] = {kind: {} for kind in KINDS}
+        # normalized item -> spelling, for items not yet assigned a category
+        self.pending: Dict[str, Dict[str, str]] = {kind: {} for kind in KINDS}
+        self.unseen_since_categorization = {kind: 0 for kind in KINDS}
+        self._lock = threading.RLock()
+
+    def add(self, analysis: Dict[str, Any]):
+        """
+        Count one analysis (an AnalysisResultJSON-shaped dict). Analyses carrying a report
+        "key" that was already counted are ignored, so re-selecting a report is free.
+        """
+        substance = (analysis.get("substance") or "N/A").strip()
+        with self._lock:
+            report_key = analysis.get("key")
+            if report_key is not None:
+                if report_key in self.report_keys:
+                    return
+                self.report_keys.add(report_key)
+            self.report_count += 1
+            for kind in KINDS:
+                for item in analysis.get(kind) or []:
+                    key = normalize_item(item)
+                    if not key:
+                        continue
+                    self.raw_counts[kind][substance][item] += 1
+                    category = self.item_categories[kind].get(key)
+                    if category is not None:
+                        self.category_counts[kind][substance][category] += 1
+                    elif key not in self.pending[kind]:
+                        self.pending[kind][key] = item
+
+    def add_many(self, analyses: Iterable[Dict[str, Any]]):
+        for analysis in analyses:
+            self.add(analysis)
+
+    def flush(self):
+        """
+        Categorize every pending item, then bring the category counts up to date.
+        """
+        with self._lock:
+            for kind in KINDS:
+                if self.pending[kind]:
+                    self._categorize_pending(kind)
+
+    def _categorize_pending(self, kind):
+        category_type = KINDS[kind]
+        pending = self.pending[kind]
+        self.unseen_since_categorization[kind] += len(pending)
+        full = (
+            not self.broad_categories[kind]
+            or self.unseen_since_categorization[kind] > self.recategorize_threshold
+        )
+        vocabulary = pending
+        if full:
+            vocabulary = {
+                normalize_item(item): item
+                for counts in self.raw_counts[kind].values()
+                for item in counts
+            }
+            mapping = categorize_items(
+                list(vocabulary.values()),
+                category_type,
+                max_concurrency=self.max_concurrency,
+                categorizer=self.categorizer,
+            )
+            self.broad_categories[kind] = list(mapping.keys())
+            self.item_categories[kind] = {}
+            self.unseen_since_categorization[kind] = 0
+        else:
+            mapping = map_items_to_categories(
+                list(pending.values()),
+                category_type,
+                self.broad_categories[kind],
+                max_concurrency=self.max_concurrency,
+                categorizer=self.categorizer,
+            )
+        for category, items in mapping.items():
+            for item in items:
+                self.item_categories[kind].setdefault(normalize_item(item), category)
+        for key in vocabulary:
+            self.item_categories[kind].setdefault(key, UNCATEGORIZED)
+        self.pending[kind] = {}
+        if full:
+            self._recount(kind)
+        else:
+            self._count_new_items(kind, pending)
+
+    def _recount(self, kind):
+        # Purely local: raw counts are re-bucketed with the new item -> category table
+        self.category_counts[kind] = defaultdict(Counter)
+        self._count_new_items(kind, None)
+
+    def _count_new_items(self, kind, keys: Optional[Dict[str, str]]):
+        categories = self.item_categories[kind]
+        for substance, counts in self.raw_counts[kind].items():
+            for item, count in counts.items():
+                key = normalize_item(item)
+                if keys is None or key in keys:
+                    self.category_counts[kind][substance][categories[key]] += count
+
+    def counts(self, kind: str, substance: Optional[str] = None, raw: bool = False) -> Counter:
+        """
+        Counts for `kind` ("themes" or "emotions"), for one substance or summed over all.
+        Category counts only include items categorized by the last flush().
+        """
+        source = self.raw_counts[kind] if raw else self.category_counts[kind]
+        with self._lock:
+            if substance is not None:
+                return Counter(source.get(substance, Counter()))
+            total = Counter()
+            for counts in source.values():
+                total.update(counts)
+            return total
+
+    def substances(self) -> List[str]:
+        return sorted(self.raw_counts["themes"].keys() | self.raw_counts["emotions"].keys())
@@ -1,17 +1,125 @@
-from openai import OpenAI
 import os
-import dotenv
 import json
+import logging
+import time
 from pydantic import BaseModel, ValidationError
 from typing import List, Optional, Dict, Any
+import contextlib
+import contextvars
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from uuid import uuid4
+from llm_cache import ResponseCache
+from data_utils import aggregate_data_from_store
+from results_store import ResultsStore
+from llm_utils import (
+    AdaptiveConcurrencyLimiter,
+    AnalysisCancelled,
+    RateBudget,
+    cancellable,
+    chat_completion,
+    get_openai_client,
+    is_retryable,
+    count_tokens,
+    estimate_tokens,
+    split_into_chunks,
+    track_usage,
+)
+from telemetry import telemetry
+from text_utils import count_unique_items, normalize_item
 
-dotenv.load_dotenv()
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
 extracted_data_dir = "processed_data"
+results_store = ResultsStore(path=f"{extracted_data_dir}/results.sqlite3")
+# Shared by every worker thread; unlimited until run_analysis_and_categorize configures it
+request_budget = RateBudget()
+# Caps LLM requests in flight across reports, chunks and shards; backs off on 429s
+concurrency_limiter = AdaptiveConcurrencyLimiter()
+# Reports that still fail with transient errors get this many more rounds, each after
+# waiting REPORT_RETRY_COOLDOWN seconds times the round number
+MAX_REPORT_RETRY_ROUNDS = 2
+REPORT_RETRY_COOLDOWN = 10.0
+# Reports longer than this are analyzed in overlapping chunks and the results merged
+MAX_REPORT_TOKENS = 6000
+CHUNK_OVERLAP_TOKENS = 200
+MAX_CHUNK_CONCURRENCY = 4
+# Items per categorization call are capped so the mapping reply fits the model's output limit
+MAX_CATEGORY_SHARD_TOKENS = 1500
+# Set LLM_CACHE_DISABLED=1 to always hit the API
+response_cache = ResponseCache(
+    path=os.getenv("LLM_CACHE_PATH", "cache/llm_cache.sqlite3"),
+    enabled=os.getenv("LLM_CACHE_DISABLED", "0") != "1",
+)
+# Per run (and the worker threads it starts), so one app session can't switch it off for
+# the others; response_cache.enabled turns the cache off for everyone
+_cache_enabled: contextvars.ContextVar = contextvars.ContextVar(
+    "cache_enabled", default=True
+)
+
+
+# Settings of the client analysis calls go through, unless use_client overrides them
+client_settings: Dict[str, Any] = {}
+_client_override: contextvars.ContextVar = contextvars.ContextVar(
+    "client_override", default=None
+)
+
+
+def configure_client(api_key=None, base_url=None, **client_options):
+    """
+    Set the client every analysis call goes through, e.g. to point the pipeline at
+    a local mock server (benchmarks/mock_openai.py) or an OpenAI-compatible proxy.
+    The client itself is only created once a call needs it.
+    """
+    global client_settings
+    client_settings = dict(api_key=api_key, base_url=base_url, **client_options)
+
+
+@contextlib.contextmanager
+def use_client(client=None, **settings):
+    """
+    Send the analysis calls made in this context (and the worker threads it starts)
+    through `client`, or a client with these settings on top of configure_client's,
+    e.g. use_client(api_key=key) for the key typed into the app.
+    """
+    if client is None:
+        client = {
+            **client_settings,
+            **{name: value for name, value in settings.items() if value is not None},
+        }
+    token = _client_override.set(client)
+    try:
+        yield
+    finally:
+        _client_override.reset(token)
+
+
+@contextlib.contextmanager
+def use_response_cache(enabled: bool = True):
+    """
+    Answer the analysis calls made in this context from response_cache (the default),
+    or always ask the API with enabled=False.
+    """
+    token = _cache_enabled.set(enabled)
+    try:
+        yield
+    finally:
+        try:
+            _cache_enabled.reset(token)
+        except ValueError:
+            # A generator finalized from another context, which was never changed
+            pass
+
+
+def get_client():
+    """
+    The OpenAI client for the current context, see configure_client and use_client.
+    """
+    client = _client_override.get()
+    if client is None:
+        return get_openai_client(**client_settings)
+    if isinstance(client, dict):
+        return get_openai_client(**client)
+    return client
 
 
 class AnalysisResultJSON(BaseModel):
@@ -45,6 +153,36 @@ anlaysis_prompt = """
     If gender or age is not available please say that they are "N/A". Begin!
 """
 
+single_pass_prompt = """
+    You are a psychedelic experience analyst. You are tasked with analyzing the experience of a person who has had a psychedelic experience.
+    You will be given the raw trip report below delimited by <r> tags:
+    <r>
+    # PSYCHEDELIC EXPERIENCE REPORT
+    {raw_experience}
+    # END OF REPORT
+    <r>
+    ----
+    Your task is to identify the most common themes and emotions in the trip report, as well as the substance used and the age and gender of the reporter, and return them in the following JSON format:
+    {{
+        "substance": "<substance name>",
+        "themes": [
+            <"Theme 1">,
+            <"Theme 2">,
+            <"Theme 3">,
+        ],
+        "emotions": [
+            <"Emotion 1">,
+            <"Emotion 2">,
+            <"Emotion 3">,
+        ],
+        "age": "<age>",
+        "gender": "<gender>"
+    }}
+    ----
+    If no specific age or gender is mentioned, please use "N/A" for those fields.
+    Begin!
+    """
+
 extraction_prompt = """
     You are a psychedelic experience analyst. You are tasked with extracting the experiences of a group of people who have experienced a psychedelic experience.
     You will be given a raw text analysis of a given experience below delimited by <e> tags:
@@ -148,24 +286,118 @@ map_individual_to_broad_categories_prompt = """
 """
 
 
-def find_broad_categories(prompt_template: str, items):
+def _chat(
+    prompt: str, json_mode: bool = False, stage: str = "llm", validate=None
+) -> str:
+    return chat_completion(
+        get_client,
+        prompt,
+        json_mode=json_mode,
+        budget=request_budget,
+        cache=response_cache if _cache_enabled.get() else None,
+        stage=stage,
+        limiter=concurrency_limiter,
+        validate=validate,
+    )
+
+
+# Reply checks: replies that fail them are not cached, so a rerun asks again
+def _parse_json_object(reply: str) -> Dict[str, Any]:
+    parsed = json.loads(reply)
+    if not isinstance(parsed, dict):
+        raise ValueError("The response is not a dictionary.")
+    return parsed
+
+
+def _parse_analysis(reply: str) -> AnalysisResultJSON:
+    return AnalysisResultJSON(**json.loads(reply))
+
+
+def shard_items(items, max_tokens=MAX_CATEGORY_SHARD_TOKENS):
+    """
+    Split items into consecutive batches whose formatted size stays under `max_tokens`.
+    """
+    shards, shard, shard_tokens = [], [], 0
+    for item in items:
+        item_tokens = estimate_tokens(f"- {item}\n")
+        if shard and shard_tokens + item_tokens > max_tokens:
+            shards.append(shard)
+            shard, shard_tokens = [], 0
+        shard.append(item)
+        shard_tokens += item_tokens
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def _category_list(response: Dict[str, Any]):
+    # The broad category prompts return a single list under "common_themes"/"common_emotions"
+    for value in response.values():
+        if isinstance(value, list):
+            return value
+    return []
+
+
+def _most_common_fitting(items, max_tokens):
+    unique = count_unique_items(items).values()
+    ranked = [
+        entry["item"]
+        for entry in sorted(unique, key=lambda entry: (-entry["count"], entry["item"]))
+    ]
+    return sorted(shard_items(ranked, max_tokens=max_tokens)[0])
+
+
+def find_broad_categories(
+    prompt_template: str,
+    items,
+    max_shard_tokens=MAX_CATEGORY_SHARD_TOKENS,
+    max_concurrency=4,
+):
     """
     General function to find broad categories for themes or emotions.
+    Vocabularies too large for one prompt are categorized shard by shard, and the
+    per-shard categories are then reduced into broad categories the same way. No prompt
+    lists more than `max_shard_tokens` worth of items.
     """
-    formatted_items = "\n".join(
-        f"- {item}" for item in set(items)
-    )  # Remove duplicates and format
+    unique_items = sorted(
+        unique["item"] for unique in count_unique_items(items).values()
+    )  # Remove duplicates and format (sorted so the prompt, and its cache key, is stable)
+    shards = shard_items(unique_items, max_tokens=max_shard_tokens)
+    if len(shards) > 1:
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    find_broad_categories,
+                    prompt_template,
+                    shard,
+                    max_shard_tokens=max_shard_tokens,
+                )
+                for shard in shards
+            ]
+            shard_results = [future.result() for future in futures]
+        shard_categories = [
+            category for result in shard_results for category in _category_list(result)
+        ]
+        if len(shard_categories) < len(unique_items):
+            return find_broad_categories(
+                prompt_template,
+                shard_categories,
+                max_shard_tokens=max_shard_tokens,
+                max_concurrency=max_concurrency,
+            )
+        # The shards condensed nothing, so reducing again wouldn't converge: reduce the
+        # categories most shards came up with, as many as fit in one prompt
+        unique_items = _most_common_fitting(
+            shard_categories or unique_items, max_shard_tokens
+        )
+
+    formatted_items = "\n".join(f"- {item}" for item in unique_items)
     prompt = prompt_template.format(items=formatted_items)
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        response_format={"type": "json_object"},
-        messages=[{"role": "user", "content": prompt}],
+    response = _chat(
+        prompt, json_mode=True, stage="broad_categories", validate=_parse_json_object
     )
-
-    json_loaded_res = json.loads(response.choices[0].message.content)
-    if not isinstance(json_loaded_res, dict):
-        raise ValueError("The response is not a dictionary.")
-    return json_loaded_res
+    return _parse_json_object(response)
 
 
 def map_individual_to_broad_categories(
@@ -182,40 +414,172 @@ def map_individual_to_broad_categories(
         all_items_for_category_type="\n".join(f"- {item}" for item in individual_items),
     )
 
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        response_format={"type": "json_object"},
-        messages=[{"role": "user", "content": prompt}],
+    return _parse_json_object(
+        _chat(prompt, json_mode=True, stage="mapping", validate=_parse_json_object)
+    )
+
+
+def map_items_to_broad_categories(
+    individual_items,
+    category_type,
+    broad_categories,
+    max_shard_tokens=MAX_CATEGORY_SHARD_TOKENS,
+    max_concurrency=4,
+) -> Dict[str, List[str]]:
+    """
+    Sharded version of map_individual_to_broad_categories: only unique items are sent,
+    shards are mapped in parallel, and the merged mapping lists every original occurrence
+    so aggregate_mapping_counts still counts mentions.
+    """
+    unique = count_unique_items(individual_items)
+    shards = shard_items(
+        sorted(entry["item"] for entry in unique.values()), max_tokens=max_shard_tokens
+    )
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                map_individual_to_broad_categories,
+                shard,
+                category_type,
+                broad_categories,
+            )
+            for shard in shards
+        ]
+        shard_mappings = [future.result() for future in futures]
+
+    mapping = {}
+    assigned = set()
+    for shard_mapping in shard_mappings:
+        for category, items in shard_mapping.items():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                key = normalize_item(item)
+                if key in assigned:
+                    continue
+                assigned.add(key)
+                entry = unique.get(key, {"item": item, "count": 1})
+                mapping.setdefault(category, []).extend(
+                    [entry["item"]] * entry["count"]
+                )
+    return mapping
+
+
+# "llm" asks the model for broad categories and the item mapping; "local" clusters
+# the items on CPU with local_categorizer (no API calls, reproducible)
+CATEGORIZERS = ("llm", "local")
+
+
+def categorize_items(
+    items,
+    category_type,
+    max_shard_tokens=MAX_CATEGORY_SHARD_TOKENS,
+    max_concurrency=4,
+    categorizer="llm",
+) -> Dict[str, List[str]]:
+    """
+    Find broad categories for all themes (or emotions) and map every item onto them.
+    If the LLM calls still fail with transient errors after retrying, the items are
+    clustered locally instead so the analyses already paid for are not lost.
+    """
+    # numpy, which local_categorizer needs, is only loaded when clustering is needed
+    from local_categorizer import categorize_locally
+
+    if categorizer == "local":
+        with telemetry.stage("categorize_local", kind=category_type, items=len(items)):
+            return categorize_locally(items)
+    if categorizer != "llm":
+        raise ValueError(
+            f"Unknown categorizer '{categorizer}', expected one of {CATEGORIZERS}"
+        )
+    prompt_template = (
+        find_broad_themes_prompt if category_type == "theme" else find_broad_emotions_prompt
     )
+    try:
+        with telemetry.stage(
+            "broad_categories", kind=category_type, items=len(items)
+        ) as labels:
+            broad_categories = _category_list(
+                find_broad_categories(
+                    prompt_template,
+                    items,
+                    max_shard_tokens=max_shard_tokens,
+                    max_concurrency=max_concurrency,
+                )
+            )
+            labels["categories"] = len(broad_categories)
+        with telemetry.stage("mapping", kind=category_type, items=len(items)) as labels:
+            mapping = map_items_to_broad_categories(
+                individual_items=items,
+                category_type=category_type,
+                broad_categories=broad_categories,
+                max_shard_tokens=max_shard_tokens,
+                max_concurrency=max_concurrency,
+            )
+            labels["categories"] = len(mapping)
+    except Exception as e:
+        if not is_retryable(e):
+            raise
+        telemetry.log(
+            logging.WARNING,
+            f"Categorizing {category_type}s with the LLM failed ({e}), "
+            "clustering locally",
+            stage="categorize",
+        )
+        with telemetry.stage("categorize_local", kind=category_type, items=len(items)):
+            return categorize_locally(items)
+    return mapping
 
-    return json.loads(response.choices[0].message.content)
 
+def map_items_to_categories(
+    items,
+    category_type,
+    broad_categories,
+    max_concurrency=4,
+    categorizer="llm",
+) -> Dict[str, List[str]]:
+    """
+    Map items onto already known broad categories without looking for new categories.
+    Falls back to local assignment when the LLM calls keep failing with transient errors.
+    """
+    from local_categorizer import assign_locally
+
+    with telemetry.stage("mapping", kind=category_type, items=len(items)):
+        if categorizer == "local":
+            return assign_locally(items, broad_categories)
+        try:
+            return map_items_to_broad_categories(
+                individual_items=items,
+                category_type=category_type,
+                broad_categories=broad_categories,
+                max_concurrency=max_concurrency,
+            )
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            telemetry.log(
+                logging.WARNING,
+                f"Mapping {category_type}s with the LLM failed ({e}), assigning locally",
+                stage="mapping",
+            )
+            return assign_locally(items, broad_categories)
 
-def categorize_analysis_results(analysis_results):
+
+def categorize_analysis_results(analysis_results, max_concurrency=4, categorizer="llm"):
     # Extract all themes and emotions from the analysis results
     all_themes = [theme for result in analysis_results for theme in result.themes]
     all_emotions = [
         emotion for result in analysis_results for emotion in result.emotions
     ]
 
-    # Find broad categories for themes and emotions
-    broad_themes = find_broad_categories(find_broad_themes_prompt, all_themes)
-    broad_emotions = find_broad_categories(find_broad_emotions_prompt, all_emotions)
-    print(f"===== Broad Themes =====:\n{broad_themes}\n")
-    print(f"===== Broad Emotions =====:\n{broad_emotions}")
-    # Map individual themes and emotions to broad categories
-    theme_mapping = map_individual_to_broad_categories(
-        individual_items=all_themes,
-        category_type="theme",
-        broad_categories=broad_themes["common_themes"],
+    # Find broad categories and map individual themes and emotions onto them
+    theme_mapping = categorize_items(
+        all_themes, "theme", max_concurrency=max_concurrency, categorizer=categorizer
     )
-    print(f"===== Theme Mapping =====:\n{theme_mapping}\n")
-    emotion_mapping = map_individual_to_broad_categories(
-        individual_items=all_emotions,
-        category_type="emotion",
-        broad_categories=broad_emotions["common_emotions"],
+    emotion_mapping = categorize_items(
+        all_emotions, "emotion", max_concurrency=max_concurrency, categorizer=categorizer
     )
-    print(f"===== Emotion Mapping =====:\n{emotion_mapping}\n")
 
     # Return mappings
     return theme_mapping, emotion_mapping
@@ -223,48 +587,152 @@ def categorize_analysis_results(analysis_results):
 
 def analyze_themes(raw_experience):
     prompt = anlaysis_prompt.format(raw_experience=raw_experience)
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        messages=[{"role": "user", "content": prompt}],
-    )
-    return response.choices[0].message
+    return _chat(prompt, stage="analyze")
 
 
 def extract_data_to_json(raw_analysis):
     prompt = extraction_prompt.format(raw_analysis=raw_analysis)
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        response_format={"type": "json_object"},
-        messages=[{"role": "user", "content": prompt}],
-    )
-    return response.choices[0].message.content
+    return _chat(prompt, json_mode=True, stage="extract", validate=_parse_analysis)
 
 
-def save_data(data, file_name, session_id):
-    with open(f"{extracted_data_dir}/{session_id}-{file_name}", "w") as f:
-        json.dump(data, f, indent=4)
+def analyze_to_json(raw_experience):
+    """
+    Single-call alternative to analyze_themes -> extract_data_to_json.
+    """
+    prompt = single_pass_prompt.format(raw_experience=raw_experience)
+    return _chat(prompt, json_mode=True, stage="analyze", validate=_parse_analysis)
 
 
-def run_analysis(raw_experience, output_filename, session_id):
-    try:
+# "two_pass" asks for free-form analysis first and then extracts JSON from it;
+# "single_pass" asks for AnalysisResultJSON-shaped output directly (half the calls).
+ANALYSIS_MODES = ("two_pass", "single_pass")
+
+
+def _analyze_chunk_json(raw_experience, mode):
+    if mode == "single_pass":
+        return analyze_to_json(raw_experience=raw_experience)
+    if mode == "two_pass":
         raw_analysis = analyze_themes(raw_experience=raw_experience)
-        json_data = extract_data_to_json(raw_analysis=raw_analysis)
-        data = json.loads(json_data)  # Parse the JSON string into a Python dict
+        return extract_data_to_json(raw_analysis=raw_analysis)
+    raise ValueError(f"Unknown analysis mode '{mode}', expected one of {ANALYSIS_MODES}")
+
+
+def _merge_items(item_lists):
+    # Items found in more chunks first; capped at the longest single-chunk list so a
+    # long report doesn't outweigh short ones in the aggregates
+    unique = count_unique_items(item for items in item_lists for item in items)
+    ranked = sorted(unique.values(), key=lambda entry: -entry["count"])
+    limit = max((len(items) for items in item_lists), default=0)
+    return [entry["item"] for entry in ranked[:limit]]
+
+
+def _first_known(values):
+    return next((value for value in values if value and value != "N/A"), "N/A")
+
+
+def merge_analysis_results(results: List[AnalysisResultJSON]) -> AnalysisResultJSON:
+    """
+    Combine the analyses of a report's chunks into one analysis of the whole report.
+    """
+    substances = Counter(
+        result.substance for result in results if result.substance not in ("", "N/A")
+    )
+    return AnalysisResultJSON(
+        substance=substances.most_common(1)[0][0] if substances else "N/A",
+        themes=_merge_items([result.themes for result in results]),
+        emotions=_merge_items([result.emotions for result in results]),
+        age=_first_known(result.age for result in results),
+        gender=_first_known(result.gender for result in results),
+    )
+
 
-        analysis_result = AnalysisResultJSON(**data)
+def analyze_report_json(
+    raw_experience, mode="two_pass", max_report_tokens=MAX_REPORT_TOKENS, stats=None
+):
+    """
+    Return the raw JSON string describing a report, produced with the given analysis mode.
+    Reports over `max_report_tokens` are split into overlapping chunks that are analyzed in
+    parallel and merged; chunks whose output fails validation are dropped. A `stats` dict
+    gets the report's "report_tokens" and "chunks".
+    """
+    report_tokens = count_tokens(raw_experience)
+    chunks = split_into_chunks(
+        raw_experience,
+        max_report_tokens,
+        CHUNK_OVERLAP_TOKENS,
+        total_tokens=report_tokens,
+    )
+    if stats is not None:
+        stats.update(report_tokens=report_tokens, chunks=len(chunks))
+    if len(chunks) == 1:
+        return _analyze_chunk_json(raw_experience, mode)
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(chunks), MAX_CHUNK_CONCURRENCY)
+    ) as executor:
+        # Copy the context so per-report usage tracking sees the chunk calls
+        futures = [
+            executor.submit(contextvars.copy_context().run, _analyze_chunk_json, chunk, mode)
+            for chunk in chunks
+        ]
+        chunk_results, last_error = [], None
+        for future in futures:
+            try:
+                chunk_results.append(AnalysisResultJSON(**json.loads(future.result())))
+            except (ValidationError, json.JSONDecodeError, TypeError) as e:
+                last_error = e
+    if not chunk_results:
+        raise last_error
+    return merge_analysis_results(chunk_results).model_dump_json()
+
+
+def save_data(records, session_id):
+    """
+    Persist a batch of analysis records (see ResultsStore.save_analyses) in one transaction.
+    """
+    with telemetry.stage("save", reports=len(records)):
+        return results_store.save_analyses(session_id, records)
+
+
+def run_analysis(
+    raw_experience, output_filename, session_id, mode="two_pass", save=True, stats=None
+):
+    """
+    Analyze one report. `output_filename` is the report key it is stored under; pass
+    save=False when the caller batches its own save_data call. `stats` is passed on to
+    analyze_report_json.
+    """
+    try:
+        json_data = analyze_report_json(raw_experience, mode=mode, stats=stats)
+        with telemetry.stage("validate"):
+            data = json.loads(json_data)  # Parse the JSON string into a Python dict
+            analysis_result = AnalysisResultJSON(**data)
         themes = analysis_result.themes
         emotions = analysis_result.emotions
         substance = analysis_result.substance
         age = analysis_result.age if analysis_result.age else "N/A"
         gender = analysis_result.gender if analysis_result.gender else "N/A"
-        save_data(
-            data=data,
-            file_name=f"{output_filename}.json",
-            session_id=session_id,
-        )
+        if save:
+            save_data(
+                [
+                    {
+                        "key": output_filename,
+                        "substance": substance,
+                        "themes": themes,
+                        "emotions": emotions,
+                        "age": age,
+                        "gender": gender,
+                    }
+                ],
+                session_id=session_id,
+            )
         return themes, substance, emotions, age, gender
     except ValidationError as e:
-        print(e)
+        telemetry.log(
+            logging.WARNING,
+            f"Analysis of report '{output_filename}' failed validation: {e}",
+            stage="validate",
+        )
         return None, None, None, None, None
 
 
@@ -279,68 +747,393 @@ def aggregate_mapping_counts(mapping):
     return counts
 
 
-def run_analysis_and_categorize(df, selected_titles, output_dir="processed_data"):
-    # Collect all individual themes and emotions
-    all_themes = []
-    all_emotions = []
-    analysis_results = []
-    curr_session_id = str(uuid4())
-    for title in selected_titles:
-        raw_experience = df[df["title"] == title]["text"].iloc[0]
-        try:
+def _analyze_report(
+    key, raw_experience, session_id, mode="two_pass", queued_at=None, transient_failures=None
+):
+    """
+    Analyze a single report, isolating failures so one bad report doesn't sink the batch.
+    `queued_at` (time.perf_counter() at submission) records its wait for a worker. Reports
+    that failed with a transient API error are recorded in `transient_failures`.
+    """
+    stats = {}
+    try:
+        with telemetry.stage("report", queued_at=queued_at), track_usage() as usage:
             themes, substance, emotions, age, gender = run_analysis(
-                raw_experience, title, session_id=curr_session_id
+                raw_experience,
+                key,
+                session_id=session_id,
+                mode=mode,
+                save=False,
+                stats=stats,
             )
-            if themes is not None:
-                all_themes.extend(themes)
-                all_emotions.extend(emotions)
-                analysis_results.append(
-                    {
-                        "substance": substance,
-                        "themes": themes,
-                        "emotions": emotions,
-                        "age": age,
-                        "gender": gender,
-                    }
-                )
-        except Exception as e:
-            print(f"An error occurred while analyzing report titled '{title}': {e}")
+    except AnalysisCancelled:
+        return None
+    except Exception as e:
+        telemetry.log(
+            logging.ERROR,
+            f"An error occurred while analyzing report '{key}': {e}",
+            stage="report",
+            key=key,
+        )
+        if transient_failures is not None and is_retryable(e):
+            transient_failures[key] = repr(e)
+        return None
+    if themes is None:
+        return None
+    return {
+        "key": key,
+        "substance": substance,
+        "themes": themes,
+        "emotions": emotions,
+        "age": age,
+        "gender": gender,
+        "usage": {**usage.snapshot(), **stats},
+    }
 
-    # Use the LLM to generate broader categories for themes and emotions
-    broad_theme_categories = find_broad_categories(find_broad_themes_prompt, all_themes)
-    broad_emotion_categories = find_broad_categories(
-        find_broad_emotions_prompt, all_emotions
-    )
-    print(f"===== Broad Themes =====:\n{broad_theme_categories}\n")
-    print(f"===== Broad Emotions =====:\n{broad_emotion_categories}")
-    # Map individual themes and emotions to the broad categories
-    theme_mapping = map_individual_to_broad_categories(
-        individual_items=all_themes,
-        category_type="theme",
-        broad_categories=broad_theme_categories["common_themes"],
-    )
-    print(f"===== Theme Mapping =====:\n{theme_mapping}\n")
-    emotion_mapping = map_individual_to_broad_categories(
-        individual_items=all_emotions,
-        category_type="emotion",
-        broad_categories=broad_emotion_categories["common_emotions"],
+
+def _iter_pending(
+    pending, session_id, mode, max_concurrency, transient_failures, cancel_event
+):
+    """
+    Analyze (key, text) pairs on a thread pool, yielding (key, analysis or None) as each
+    report finishes. Reports not started yet are dropped when the generator is closed.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency))
+    try:
+        queued_at = time.perf_counter()
+        with cancellable(cancel_event):
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run,
+                    _analyze_report,
+                    key,
+                    text,
+                    session_id,
+                    mode,
+                    queued_at,
+                    transient_failures,
+                ): key
+                for key, text in pending
+            }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _raw_counts(counts: Counter) -> Counter:
+    # Spellings that only differ in formatting are counted together
+    merged = Counter()
+    spellings = {}
+    for item, count in counts.items():
+        key = normalize_item(item)
+        if key:
+            merged[spellings.setdefault(key, str(item).strip())] += count
+    return merged
+
+
+def iter_analysis(
+    reports,
+    selected_keys,
+    max_concurrency=4,
+    requests_per_minute=None,
+    tokens_per_minute=None,
+    mode="two_pass",
+    categorizer="llm",
+    dataset=None,
+    aggregator=None,
+    dedup_index=None,
+    dedup_threshold=None,
+    max_report_retry_rounds=MAX_REPORT_RETRY_ROUNDS,
+    cancel_event: Optional[threading.Event] = None,
+    use_cache=True,
+):
+    """
+    Analyze the selected reports (keys of the `reports` ReportIndex) with up to
+    `max_concurrency` reports in flight at once, then categorize and aggregate their themes
+    and emotions, yielding progress events as it goes:
+
+    - {"type": "report", "key", "result", "reused", "done", "total"} as each report
+      finishes; "result" is the analysis dict, or None if the report failed.
+    - {"type": "stage", "stage": "categorize"} once all reports are analyzed.
+    - {"type": "complete", "theme_counts", "emotion_counts", "analysis_results",
+      "cancelled", "session_id"} last. Results keep the order of `selected_keys`; the
+      session id is also the run's telemetry run id.
+
+    `mode` is one of ANALYSIS_MODES and `categorizer` one of CATEGORIZERS. All analyses of
+    the run are stored in one transaction under a new session, tagged with `dataset`.
+
+    Setting `cancel_event` (or closing the generator) stops the outstanding API calls:
+    queued reports are dropped and calls that are waiting or backing off give up. Reports
+    already analyzed are still saved; a cancelled run skips categorization and completes
+    with raw (uncategorized) counts.
+
+    With an aggregation.IncrementalAggregator, results are added to its running counts
+    and only newly seen themes/emotions are categorized; the returned counts then cover
+    everything the aggregator has seen.
+
+    With a dedup.DedupIndex, reports that are near-duplicates of an already analyzed
+    report (in the index or earlier in this selection) copy that analysis instead of
+    calling the API; analyzed reports are added to the index. `dedup_threshold` is the
+    similarity that counts as a near-duplicate (default: the index's threshold).
+
+    LLM calls are retried with backoff, and at most `max_concurrency` are in flight,
+    fewer while the API answers with 429s. Reports that still fail with transient errors
+    are retried in up to `max_report_retry_rounds` later rounds. With use_cache=False,
+    every call of this run goes to the API instead of response_cache.
+    """
+    cancel_event = cancel_event or threading.Event()
+    run_start = time.perf_counter()
+    request_budget.configure(
+        requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute
     )
-    print(f"===== Emotion Mapping =====:\n{emotion_mapping}\n")
+    concurrency_limiter.configure(maximum=max_concurrency)
+    curr_session_id = str(uuid4())
+    # Exported when the run ends, also if it fails or the generator is closed early
+    with telemetry.run(curr_session_id), use_response_cache(use_cache):
+        results_store.start_session(
+            curr_session_id, mode=mode, categorizer=categorizer, dataset=dataset
+        )
+        raw_experiences = [reports.text(key) for key in selected_keys]
+        reuse = {}
+        if dedup_index is not None:
+            from dedup import plan_reuse
 
-    # Aggregate the mapped data for visualization
-    theme_counts = aggregate_mapping_counts(theme_mapping)
-    emotion_counts = aggregate_mapping_counts(emotion_mapping)
+            with telemetry.stage("dedup", reports=len(selected_keys)):
+                signatures, reuse = plan_reuse(
+                    dedup_index,
+                    selected_keys,
+                    raw_experiences,
+                    has_analysis=results_store.has_analysis,
+                    threshold=dedup_threshold,
+                )
+        pending = [
+            (key, text)
+            for key, text in zip(selected_keys, raw_experiences)
+            if key not in reuse
+        ]
+        total = len(selected_keys)
+        done = 0
+        results_by_key = {}
+        saved = False
+
+        def save_results():
+            # Collect all individual analyses, in selection order
+            analysis_results = [
+                results_by_key[key] for key in selected_keys if key in results_by_key
+            ]
+            save_data(
+                [
+                    {**result, "title": reports.title(result["key"]), "dataset": dataset}
+                    for result in analysis_results
+                ],
+                session_id=curr_session_id,
+            )
+            return analysis_results
 
-    # Save the results
+        try:
+            transient_failures = {}
+            # Round 0 is the first pass. Later rounds are the retry queue for reports that
+            # ran out of retries on 429s/timeouts, run once the API has had time to recover
+            # and the limiter has settled on a sustainable rate
+            retry = pending
+            for retry_round in range(max_report_retry_rounds + 1):
+                if not retry or cancel_event.is_set():
+                    break
+                if retry_round and cancel_event.wait(REPORT_RETRY_COOLDOWN * retry_round):
+                    break
+                last_round = retry_round == max_report_retry_rounds
+                transient_failures.clear()
+                round_stage = (
+                    telemetry.stage("report_retry", round=retry_round, reports=len(retry))
+                    if retry_round
+                    else contextlib.nullcontext()
+                )
+                with round_stage:
+                    for key, result in _iter_pending(
+                        retry,
+                        curr_session_id,
+                        mode,
+                        min(max_concurrency, concurrency_limiter.limit),
+                        transient_failures,
+                        cancel_event,
+                    ):
+                        if result is None and cancel_event.is_set():
+                            continue  # dropped, not failed
+                        # Reports queued for another round are reported when that round ends
+                        if (
+                            result is None
+                            and key in transient_failures
+                            and not last_round
+                        ):
+                            continue
+                        if result is not None:
+                            results_by_key[key] = result
+                        done += 1
+                        yield {
+                            "type": "report",
+                            "key": key,
+                            "result": result,
+                            "reused": False,
+                            "done": done,
+                            "total": total,
+                        }
+                retry = [
+                    (key, text) for key, text in pending if key in transient_failures
+                ]
+
+            if dedup_index is not None:
+                for key, source in reuse.items():
+                    source_result = results_by_key.get(
+                        source
+                    ) or results_store.latest_analysis(source)
+                    result = None
+                    if source_result is not None:
+                        result = {
+                            field: source_result[field]
+                            for field in (
+                                "substance", "themes", "emotions", "age", "gender"
+                            )
+                        }
+                        result["key"] = key
+                        results_by_key[key] = result
+                    done += 1
+                    yield {
+                        "type": "report",
+                        "key": key,
+                        "result": result,
+                        "reused": True,
+                        "done": done,
+                        "total": total,
+                    }
+                for key in results_by_key:
+                    dedup_index.add(key, signature=signatures[key])
+                reused = sum(key in results_by_key for key in reuse)
+                dedup_index.reused_analyses += reused
+                calls_per_report = 1 if mode == "single_pass" else 2
+                telemetry.record_stage(
+                    "dedup_reuse",
+                    0.0,
+                    reused=reused,
+                    saved_calls=reused * calls_per_report,
+                )
 
-    save_data(
-        data={
+            saved = True
+            analysis_results = save_results()
+        finally:
+            # Closing the generator early cancels the work still in flight, but keeps the
+            # analyses that were already paid for
+            if not saved:
+                cancel_event.set()
+                save_results()
+
+        cancelled = cancel_event.is_set()
+        if cancelled:
+            # Uncategorized counts of what was analyzed, straight from the stored session
+            counts = aggregate_data_from_store(results_store, session_id=curr_session_id)
+            theme_counts = _raw_counts(counts["themes"])
+            emotion_counts = _raw_counts(counts["emotions"])
+        else:
+            yield {"type": "stage", "stage": "categorize"}
+            theme_counts, emotion_counts = _categorize_results(
+                analysis_results, max_concurrency, categorizer, aggregator
+            )
+
+        # Save the results
+        with telemetry.stage("save", summary=True):
+            results_store.save_session_summary(
+                curr_session_id, theme_counts, emotion_counts
+            )
+        telemetry.record_stage(
+            "run",
+            time.perf_counter() - run_start,
+            reports=len(selected_keys),
+            mode=mode,
+            cancelled=cancelled,
+        )
+        yield {
+            "type": "complete",
             "theme_counts": theme_counts,
             "emotion_counts": emotion_counts,
             "analysis_results": analysis_results,
-        },
-        file_name="aggregated_analysis.json",
-        session_id=curr_session_id,
+            "cancelled": cancelled,
+            "session_id": curr_session_id,
+        }
+
+
+def _categorize_results(analysis_results, max_concurrency, categorizer, aggregator):
+    all_themes = [theme for result in analysis_results for theme in result["themes"]]
+    all_emotions = [
+        emotion for result in analysis_results for emotion in result["emotions"]
+    ]
+
+    if aggregator is not None:
+        with telemetry.stage("aggregate", reports=len(analysis_results)):
+            aggregator.add_many(analysis_results)
+            aggregator.flush()
+            return aggregator.counts("themes"), aggregator.counts("emotions")
+
+    # Use the LLM to generate broader categories and map individual items onto them
+    theme_mapping = categorize_items(
+        all_themes, "theme", max_concurrency=max_concurrency, categorizer=categorizer
+    )
+    emotion_mapping = categorize_items(
+        all_emotions,
+        "emotion",
+        max_concurrency=max_concurrency,
+        categorizer=categorizer,
     )
 
-    return theme_counts, emotion_counts, analysis_results
+    # Aggregate the mapped data for visualization
+    with telemetry.stage("aggregate", reports=len(analysis_results)):
+        return aggregate_mapping_counts(theme_mapping), aggregate_mapping_counts(
+            emotion_mapping
+        )
+
+
+def run_analysis_and_categorize(
+    reports,
+    selected_keys,
+    output_dir="processed_data",
+    max_concurrency=4,
+    requests_per_minute=None,
+    tokens_per_minute=None,
+    mode="two_pass",
+    categorizer="llm",
+    dataset=None,
+    aggregator=None,
+    dedup_index=None,
+    dedup_threshold=None,
+    max_report_retry_rounds=MAX_REPORT_RETRY_ROUNDS,
+    progress_callback=None,
+    cancel_event=None,
+    use_cache=True,
+):
+    """
+    Blocking form of iter_analysis: returns (theme_counts, emotion_counts,
+    analysis_results), passing every progress event to `progress_callback` if given.
+    """
+    for event in iter_analysis(
+        reports,
+        selected_keys,
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        mode=mode,
+        categorizer=categorizer,
+        dataset=dataset,
+        aggregator=aggregator,
+        dedup_index=dedup_index,
+        dedup_threshold=dedup_threshold,
+        max_report_retry_rounds=max_report_retry_rounds,
+        cancel_event=cancel_event,
+        use_cache=use_cache,
+    ):
+        if progress_callback is not None:
+            progress_callback(event)
+        if event["type"] == "complete":
+            return (
+                event["theme_counts"],
+                event["emotion_counts"],
+                event["analysis_results"],
+            )
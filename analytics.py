@@ -0,0 +1,263 @@
+"""
+Cross-substance analytics over stored analyses.
+
+Analyses are loaded once into category-coded arrays: one integer code per analysis for its
+substance, gender, age band and dataset, and, for themes and emotions, sorted
+(analysis row, item code) arrays over an interned vocabulary. Contingency tables, co-occurrence
+matrices and demographic breakdowns are then NumPy bincounts and matrix products over
+those codes, so slicing even 100k analyses takes milliseconds.
+"""
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from results_store import ResultsStore
+from text_utils import normalize_item
+
+KINDS = ("themes", "emotions")
+GROUPS = ("substance", "gender", "age_band", "dataset")
+UNKNOWN = "N/A"
+AGE_BAND_EDGES = [0, 18, 25, 35, 45, 55, 200]
+AGE_BANDS = ["<18", "18-24", "25-34", "35-44", "45-54", "55+"]
+GENDERS = {
+    "male": "Male",
+    "man": "Male",
+    "m": "Male",
+    "female": "Female",
+    "woman": "Female",
+    "f": "Female",
+}
+
+
+def _intern(values: Iterable[str]):
+    """
+    (codes, labels): values that normalize_item considers equal share a code, labelled
+    with the first spelling seen. Empty values become UNKNOWN.
+    """
+    codes, labels, index = [], [], {}
+    for value in values:
+        key = normalize_item(value) if value is not None else ""
+        if key in ("", "n/a", "na", "none", "unknown", "not given"):
+            key, value = "", UNKNOWN
+        if key not in index:
+            index[key] = len(labels)
+            labels.append(str(value).strip())
+        codes.append(index[key])
+    return np.asarray(codes, dtype=np.int32), labels
+
+
+def age_bands(ages: Sequence) -> pd.Series:
+    """
+    Age band of each reported age; ages that aren't numbers fall into UNKNOWN.
+    """
+    numeric = pd.to_numeric(
+        pd.Series(ages, dtype=object).astype(str).str.extract(r"(\d+)")[0],
+        errors="coerce",
+    )
+    bands = pd.cut(numeric, AGE_BAND_EDGES, right=False, labels=AGE_BANDS)
+    return bands.cat.add_categories([UNKNOWN]).fillna(UNKNOWN)
+
+
+def _gender(value) -> str:
+    key = normalize_item(value) if value is not None else ""
+    return GENDERS.get(key, value if key and key not in ("n/a", "not given") else UNKNOWN)
+
+
+class AnalysisFrame:
+    """
+    Compact, read-only table of analyses. Filter with mask(); every table method takes
+    the resulting boolean mask so one selection can drive several views.
+    """
+
+    def __init__(self, records: List[Dict]):
+        self.size = len(records)
+        self.keys = [record.get("key") for record in records]
+        self.codes: Dict[str, np.ndarray] = {}
+        self.labels: Dict[str, List[str]] = {}
+        self.codes["substance"], self.labels["substance"] = _intern(
+            record.get("substance") for record in records
+        )
+        self.codes["gender"], self.labels["gender"] = _intern(
+            _gender(record.get("gender")) for record in records
+        )
+        self.codes["dataset"], self.labels["dataset"] = _intern(
+            record.get("dataset") for record in records
+        )
+        bands = age_bands([record.get("age") for record in records])
+        self.codes["age_band"] = bands.cat.codes.to_numpy(dtype=np.int32)
+        self.labels["age_band"] = list(bands.cat.categories)
+        # The items of analysis i are item_codes[kind][rows[kind] == i], each at most once
+        self.rows: Dict[str, np.ndarray] = {}
+        self.item_codes: Dict[str, np.ndarray] = {}
+        self.vocabulary: Dict[str, List[str]] = {}
+        for kind in KINDS:
+            lists = [record.get(kind) or [] for record in records]
+            lengths = np.fromiter((len(items) for items in lists), np.int64, self.size)
+            codes, self.vocabulary[kind] = _intern(chain.from_iterable(lists))
+            rows = np.repeat(np.arange(self.size, dtype=np.int64), lengths)
+            pairs = np.unique(rows * len(self.vocabulary[kind]) + codes)
+            self.rows[kind] = pairs // max(1, len(self.vocabulary[kind]))
+            self.item_codes[kind] = (pairs % max(1, len(self.vocabulary[kind]))).astype(
+                np.int32
+            )
+
+    @classmethod
+    def from_store(
+        cls, store: ResultsStore, dataset: Optional[str] = None, latest_only: bool = True
+    ) -> "AnalysisFrame":
+        """
+        Load the stored analyses; with `latest_only`, each report counts once, with its
+        most recent analysis.
+        """
+        records = store.fetch_analyses(dataset=dataset)
+        if latest_only:
+            records = list({record["key"]: record for record in records}.values())
+        return cls(records)
+
+    def __len__(self):
+        return self.size
+
+    def mask(self, **filters: Optional[Iterable[str]]) -> np.ndarray:
+        """
+        Analyses whose group labels are among the given ones (compared like
+        normalize_item), e.g. mask(substance=["LSD"], age_band=["18-24", "25-34"]).
+        None or empty means any.
+        """
+        selected = np.ones(self.size, dtype=bool)
+        for group, values in filters.items():
+            if not values:
+                continue
+            values = {normalize_item(value) for value in values}
+            wanted = [
+                i
+                for i, label in enumerate(self.labels[group])
+                if normalize_item(label) in values
+            ]
+            selected &= np.isin(self.codes[group], wanted)
+        return selected
+
+    def _selected_items(self, kind, mask):
+        if mask is None:
+            return self.item_codes[kind]
+        return self.item_codes[kind][mask[self.rows[kind]]]
+
+    def item_counts(self, kind: str, mask: Optional[np.ndarray] = None) -> pd.Series:
+        """
+        Analyses mentioning each item, most frequent first.
+        """
+        counts = np.bincount(
+            self._selected_items(kind, mask), minlength=len(self.vocabulary[kind])
+        )
+        series = pd.Series(counts, index=self.vocabulary[kind], name=kind)
+        return series[series > 0].sort_values(ascending=False, kind="stable")
+
+    def _top_items(self, kind, mask, top, items=None) -> np.ndarray:
+        if items is not None:
+            index = {label: i for i, label in enumerate(self.vocabulary[kind])}
+            return np.asarray([index[item] for item in items if item in index], np.int64)
+        counts = np.bincount(
+            self._selected_items(kind, mask), minlength=len(self.vocabulary[kind])
+        )
+        order = np.argsort(-counts, kind="stable")
+        return order[: min(top, int((counts > 0).sum()))]
+
+    def _entries(self, kind, columns, mask):
+        """
+        (analysis row, column) of every selected analysis mentioning one of the `columns`
+        item codes, the column being the item's position in `columns`.
+        """
+        column_of = np.full(len(self.vocabulary[kind]), -1, dtype=np.int64)
+        column_of[columns] = np.arange(len(columns))
+        rows, cols = self.rows[kind], column_of[self.item_codes[kind]]
+        keep = cols >= 0
+        if mask is not None:
+            keep &= mask[rows]
+        return rows[keep], cols[keep]
+
+    def _incidence(self, kind, columns, mask) -> np.ndarray:
+        """
+        Dense 0/1 matrix of the selected analyses (rows) by the `columns` item codes.
+        """
+        rows, cols = self._entries(kind, columns, mask)
+        matrix = np.zeros((self.size, len(columns)), dtype=np.float32)
+        matrix[rows, cols] = 1.0
+        return matrix if mask is None else matrix[mask]
+
+    def _labels(self, kind, columns) -> pd.Index:
+        return pd.Index([self.vocabulary[kind][c] for c in columns], name=kind)
+
+    def contingency(
+        self,
+        kind: str,
+        by: str = "substance",
+        mask: Optional[np.ndarray] = None,
+        top: int = 20,
+        items: Optional[Sequence[str]] = None,
+        share: bool = False,
+    ) -> pd.DataFrame:
+        """
+        `by` group (substance, gender, age_band or dataset) × item table of how many
+        analyses in the group mention the item, over the `top` items of the selection
+        (or the given `items`). With `share`, cells are the fraction of the group's
+        analyses instead, which compares groups of different sizes.
+        """
+        columns = self._top_items(kind, mask, top, items)
+        groups = self.codes[by]
+        n_groups, n_columns = len(self.labels[by]), len(columns)
+        rows, cols = self._entries(kind, columns, mask)
+        cells = np.bincount(
+            groups[rows].astype(np.int64) * n_columns + cols,
+            minlength=n_groups * n_columns,
+        ).reshape(n_groups, n_columns)
+        sizes = np.bincount(groups if mask is None else groups[mask], minlength=n_groups)
+        table = pd.DataFrame(
+            cells,
+            index=pd.Index(self.labels[by], name=by),
+            columns=self._labels(kind, columns),
+        )[sizes > 0]
+        if share:
+            table = table.div(sizes[sizes > 0], axis=0)
+        return table
+
+    def co_occurrence(
+        self,
+        kind: str,
+        other_kind: Optional[str] = None,
+        mask: Optional[np.ndarray] = None,
+        top: int = 20,
+        share: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Item × item counts of analyses mentioning both, over the `top` items of each kind
+        (themes × emotions when `other_kind` differs). With `share`, each row is divided
+        by its item's count: the fraction of analyses mentioning the row item that also
+        mention the column item.
+        """
+        other_kind = other_kind or kind
+        row_items = self._top_items(kind, mask, top)
+        left = self._incidence(kind, row_items, mask)
+        if other_kind == kind:
+            column_items, right = row_items, left
+        else:
+            column_items = self._top_items(other_kind, mask, top)
+            right = self._incidence(other_kind, column_items, mask)
+        table = pd.DataFrame(
+            (left.T @ right).astype(np.int64),
+            index=self._labels(kind, row_items),
+            columns=self._labels(other_kind, column_items),
+        )
+        if share:
+            totals = left.sum(axis=0)
+            table = table.div(np.where(totals > 0, totals, 1), axis=0)
+        return table
+
+    def group_sizes(self, by: str, mask: Optional[np.ndarray] = None) -> pd.Series:
+        """
+        Number of selected analyses in each group, e.g. the demographics of a selection.
+        """
+        codes = self.codes[by] if mask is None else self.codes[by][mask]
+        counts = np.bincount(codes, minlength=len(self.labels[by]))
+        index = pd.Index(self.labels[by], name=by)
+        return pd.Series(counts, index=index, name="analyses")
@@ -0,0 +1,549 @@
+"""
+Deferred analysis of many reports through the OpenAI Batch API.
+
+Reports are compiled into a JSONL file of single-pass chat completion requests, uploaded
+and submitted as one or more batches, polled until done, and the outputs validated as
+AnalysisResultJSON and stored with save_data. Batches are priced lower than synchronous
+calls and don't count against the per-minute rate limits.
+
+A job keeps its state in a directory, so running the same command again resumes it:
+batches still running are polled instead of resubmitted, and reports already stored are
+skipped. Requests that failed or returned invalid output are resubmitted in a new batch,
+up to --max-resubmissions times per run; run it again to retry what's still missing.
+
+Usage:
+    python batch_api.py raw_experiences/LSD --job batches/lsd
+    python batch_api.py raw_experiences/LSD --job batches/lsd \
+        --base-url http://127.0.0.1:8089/v1  # e.g. benchmarks/mock_openai.py
+"""
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
+from uuid import uuid4
+
+import httpx
+import pandas as pd
+from pydantic import ValidationError
+from tenacity import (
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+import analysis_pipeline
+from analysis_pipeline import (
+    CHUNK_OVERLAP_TOKENS,
+    MAX_REPORT_TOKENS,
+    AnalysisResultJSON,
+    merge_analysis_results,
+    save_data,
+    single_pass_prompt,
+)
+from batch_runner import iter_reports
+from llm_cache import cache_key
+from llm_utils import DEFAULT_MODEL, split_into_chunks, usage_tracker
+from report_index import ReportIndex
+from telemetry import telemetry
+
+ENDPOINT = "/v1/chat/completions"
+# Batch API limits: requests per batch and bytes per input file
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+DEFAULT_POLL_INTERVAL = 30.0
+DEFAULT_MAX_RESUBMISSIONS = 2
+
+
+def _is_transient(error: BaseException) -> bool:
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and (
+        error.response.status_code in (408, 409, 429) or error.response.status_code >= 500
+    )
+
+
+class BatchAPI:
+    """
+    Minimal client for the files and batches endpoints (the installed openai package
+    predates the Batch API). Transient HTTP errors are retried with backoff.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        timeout: float = 120.0,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self._http = httpx.Client(
+            base_url=str(base_url).rstrip("/") + "/",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=timeout,
+            transport=transport,
+        )
+
+    @classmethod
+    def from_client(cls, client) -> "BatchAPI":
+        """
+        Use the base URL and key of an openai.OpenAI client, e.g. the pipeline's.
+        """
+        return cls(client.base_url, client.api_key)
+
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        def attempt():
+            response = self._http.request(method, path, **kwargs)
+            response.raise_for_status()
+            return response
+
+        retrying = Retrying(
+            stop=stop_after_attempt(5),
+            wait=wait_random_exponential(multiplier=1.0, max=30.0),
+            retry=retry_if_exception(_is_transient),
+            reraise=True,
+        )
+        return retrying(attempt)
+
+    def upload_file(self, filename: str, content: bytes) -> str:
+        response = self._request(
+            "POST",
+            "files",
+            data={"purpose": "batch"},
+            files={"file": (filename, content, "application/jsonl")},
+        )
+        return response.json()["id"]
+
+    def create_batch(
+        self, input_file_id: str, completion_window: str = "24h", metadata=None
+    ) -> Dict[str, Any]:
+        return self._request(
+            "POST",
+            "batches",
+            json={
+                "input_file_id": input_file_id,
+                "endpoint": ENDPOINT,
+                "completion_window": completion_window,
+                "metadata": metadata,
+            },
+        ).json()
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"batches/{batch_id}").json()
+
+    def file_content(self, file_id: str) -> bytes:
+        return self._request("GET", f"files/{file_id}/content").content
+
+
+def build_requests(
+    reports: ReportIndex,
+    keys: Iterable[str],
+    model: str = DEFAULT_MODEL,
+    max_report_tokens: int = MAX_REPORT_TOKENS,
+):
+    """
+    One single-pass request per report (per chunk for long reports). Returns
+    (requests by custom ID, custom IDs of each report in chunk order).
+
+    Custom IDs are derived from the report key and the request content, so compiling
+    the same reports again yields the same IDs, while an edited report gets new ones.
+    """
+    requests, report_ids = {}, {}
+    for key in keys:
+        chunks = split_into_chunks(
+            reports.text(key), max_report_tokens, CHUNK_OVERLAP_TOKENS
+        )
+        report_ids[key] = []
+        for index, chunk in enumerate(chunks):
+            prompt = single_pass_prompt.format(raw_experience=chunk)
+            custom_id = f"{key}:{index}:{cache_key(model, prompt, True)[:16]}"
+            requests[custom_id] = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": ENDPOINT,
+                "body": {
+                    "model": model,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "response_format": {"type": "json_object"},
+                },
+            }
+            report_ids[key].append(custom_id)
+    return requests, report_ids
+
+
+def split_batches(
+    lines: List[bytes],
+    max_requests: int = MAX_REQUESTS_PER_BATCH,
+    max_bytes: int = MAX_BATCH_FILE_BYTES,
+) -> List[List[bytes]]:
+    """
+    Group JSONL lines into batch input files within the Batch API limits.
+    """
+    batches, batch, size = [], [], 0
+    for line in lines:
+        if batch and (len(batch) == max_requests or size + len(line) > max_bytes):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(line)
+        size += len(line)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def parse_output_line(record: Dict[str, Any]):
+    """
+    (reply content, usage) of a successful output line whose content validates as
+    AnalysisResultJSON; raises ValueError describing the failure otherwise.
+    """
+    response = record.get("response") or {}
+    if record.get("error") or response.get("status_code") != 200:
+        error = record.get("error") or (response.get("body") or {}).get("error")
+        raise ValueError(f"status {response.get('status_code')}: {error}")
+    body = response["body"]
+    content = body["choices"][0]["message"]["content"]
+    try:
+        AnalysisResultJSON(**json.loads(content))
+    except (ValidationError, json.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"invalid analysis: {e}")
+    return content, body.get("usage")
+
+
+class BatchJob:
+    """
+    State of one batch analysis job, kept in `directory`:
+
+    - state.json: session, dataset, the batches submitted and the reports stored
+    - results.jsonl: the validated reply of every finished request, by custom ID
+    - errors.jsonl: every failed or invalid request, for inspection
+    - input-<round>-<part>.jsonl: the submitted request files
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.state_path = os.path.join(directory, "state.json")
+        self.results_path = os.path.join(directory, "results.jsonl")
+        self.errors_path = os.path.join(directory, "errors.jsonl")
+        self.state = {"session_id": None, "dataset": None, "batches": [], "ingested": []}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state.update(json.load(f))
+
+    def save_state(self):
+        # Written to a temporary file first so a crash never leaves half a state file
+        temporary = self.state_path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temporary, self.state_path)
+
+    def results(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Validated replies by custom ID. A trailing partial line from a crash is ignored.
+        """
+        results = {}
+        if not os.path.exists(self.results_path):
+            return results
+        with open(self.results_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                results[record["custom_id"]] = record
+        return results
+
+    def _append(self, path: str, records: List[Dict[str, Any]]):
+        with open(path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def submit(self, api: BatchAPI, requests: List[Dict[str, Any]], completion_window):
+        rounds = [batch["round"] for batch in self.state["batches"]]
+        round_number = max(rounds, default=-1) + 1
+        lines = [(json.dumps(request) + "\n").encode("utf-8") for request in requests]
+        with telemetry.stage("batch_submit", round=round_number, requests=len(requests)):
+            for part, batch_lines in enumerate(split_batches(lines)):
+                filename = f"input-{round_number}-{part}.jsonl"
+                content = b"".join(batch_lines)
+                with open(os.path.join(self.directory, filename), "wb") as f:
+                    f.write(content)
+                file_id = api.upload_file(filename, content)
+                batch = api.create_batch(
+                    file_id,
+                    completion_window=completion_window,
+                    metadata={"session_id": self.state["session_id"]},
+                )
+                self.state["batches"].append(
+                    {
+                        "id": batch["id"],
+                        "round": round_number,
+                        "input_file": filename,
+                        "requests": len(batch_lines),
+                        "status": batch.get("status"),
+                        "collected": False,
+                    }
+                )
+                # Recorded right away so a rerun polls this batch instead of resubmitting
+                self.save_state()
+                print(f"Submitted batch {batch['id']} with {len(batch_lines)} requests")
+
+    def wait(self, api: BatchAPI, poll_interval: float):
+        """
+        Poll the job's unfinished batches until each reaches a terminal status.
+        """
+        running = [b for b in self.state["batches"] if not b["collected"]]
+        with telemetry.stage("batch_wait", batches=len(running)):
+            while True:
+                for entry in running:
+                    if entry["status"] in TERMINAL_STATUSES:
+                        continue
+                    batch = api.retrieve_batch(entry["id"])
+                    entry.update(
+                        status=batch["status"],
+                        output_file_id=batch.get("output_file_id"),
+                        error_file_id=batch.get("error_file_id"),
+                    )
+                    counts = batch.get("request_counts") or {}
+                    print(
+                        f"Batch {entry['id']}: {batch['status']} "
+                        f"({counts.get('completed', 0)}/{counts.get('total', '?')} done, "
+                        f"{counts.get('failed', 0)} failed)"
+                    )
+                self.save_state()
+                if all(entry["status"] in TERMINAL_STATUSES for entry in running):
+                    return
+                time.sleep(poll_interval)
+
+    def collect(self, api: BatchAPI, cache=None) -> int:
+        """
+        Download the output and error files of finished batches. Valid replies go to
+        results.jsonl (and `cache`, so synchronous runs can reuse them); everything else
+        goes to errors.jsonl. Returns the number of valid replies.
+        """
+        collected = 0
+        for entry in self.state["batches"]:
+            if entry["collected"] or entry["status"] not in TERMINAL_STATUSES:
+                continue
+            results, errors = [], []
+            if entry.get("output_file_id"):
+                for line in api.file_content(entry["output_file_id"]).splitlines():
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    try:
+                        content, usage = parse_output_line(record)
+                    except (ValueError, KeyError, IndexError) as e:
+                        errors.append(
+                            {"custom_id": record.get("custom_id"), "error": str(e)}
+                        )
+                        continue
+                    results.append(
+                        {
+                            "custom_id": record["custom_id"],
+                            "content": content,
+                            "usage": usage,
+                        }
+                    )
+            if entry.get("error_file_id"):
+                for line in api.file_content(entry["error_file_id"]).splitlines():
+                    if line.strip():
+                        record = json.loads(line)
+                        errors.append(
+                            {"custom_id": record.get("custom_id"), "error": record}
+                        )
+            self._record_usage(results, errors, cache)
+            self._append(self.results_path, results)
+            self._append(self.errors_path, errors)
+            entry["collected"] = True
+            self.save_state()
+            collected += len(results)
+            print(f"Batch {entry['id']}: {len(results)} results, {len(errors)} failed")
+        return collected
+
+    def _record_usage(self, results, errors, cache):
+        from openai.types import CompletionUsage
+
+        for result in results:
+            usage = CompletionUsage(**result["usage"]) if result["usage"] else None
+            usage_tracker.record(usage)
+            telemetry.record_call(
+                "batch",
+                0.0,
+                prompt_tokens=getattr(usage, "prompt_tokens", 0),
+                completion_tokens=getattr(usage, "completion_tokens", 0),
+            )
+        for error in errors:
+            telemetry.record_call("batch", 0.0, error=str(error["error"])[:200])
+        if cache is None or not cache.enabled or not results:
+            return
+        requests = self._submitted_requests()
+        for result in results:
+            request = requests.get(result["custom_id"])
+            if request is not None:
+                body = request["body"]
+                key = cache_key(body["model"], body["messages"][0]["content"], True)
+                cache.put(key, body["model"], result["content"])
+
+    def _submitted_requests(self) -> Dict[str, Dict[str, Any]]:
+        requests = {}
+        for entry in self.state["batches"]:
+            with open(os.path.join(self.directory, entry["input_file"])) as f:
+                for line in f:
+                    request = json.loads(line)
+                    requests[request["custom_id"]] = request
+        return requests
+
+
+def ingest(job: BatchJob, reports: ReportIndex, report_ids, dataset=None) -> int:
+    """
+    Store every report whose requests have all succeeded and that isn't stored yet.
+    Chunked reports are merged like synchronous runs merge them. Returns the count.
+    `dataset` is one dataset key for all reports, or a dict of report key to dataset key.
+    """
+    results = job.results()
+    ingested = set(job.state["ingested"])
+    records = []
+    with telemetry.stage("batch_ingest", reports=len(report_ids)):
+        for key, custom_ids in report_ids.items():
+            if key in ingested or not all(cid in results for cid in custom_ids):
+                continue
+            analyses = [
+                AnalysisResultJSON(**json.loads(results[cid]["content"]))
+                for cid in custom_ids
+            ]
+            if len(analyses) > 1:
+                analyses = [merge_analysis_results(analyses)]
+            analysis = analyses[0]
+            usages = [results[cid]["usage"] or {} for cid in custom_ids]
+            records.append(
+                {
+                    "key": key,
+                    "title": reports.title(key),
+                    "dataset": dataset.get(key) if isinstance(dataset, dict) else dataset,
+                    "substance": analysis.substance,
+                    "themes": analysis.themes,
+                    "emotions": analysis.emotions,
+                    "age": analysis.age or "N/A",
+                    "gender": analysis.gender or "N/A",
+                    "usage": {
+                        "requests": len(custom_ids),
+                        "prompt_tokens": sum(
+                            usage.get("prompt_tokens", 0) for usage in usages
+                        ),
+                        "completion_tokens": sum(
+                            usage.get("completion_tokens", 0) for usage in usages
+                        ),
+                    },
+                }
+            )
+        if records:
+            save_data(records, session_id=job.state["session_id"])
+    job.state["ingested"] = sorted(ingested | {record["key"] for record in records})
+    job.save_state()
+    return len(records)
+
+
+def run_batch_job(
+    reports: ReportIndex,
+    keys: Iterable[str],
+    job_dir: str,
+    dataset: Union[str, Dict[str, str], None] = None,
+    api: Optional[BatchAPI] = None,
+    model: str = DEFAULT_MODEL,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    max_resubmissions: int = DEFAULT_MAX_RESUBMISSIONS,
+    completion_window: str = "24h",
+) -> Dict[str, int]:
+    """
+    Analyze `keys` of `reports` through the Batch API and store the results under one
+    session, tagged with `dataset` (see ingest). Safe to rerun with the same `job_dir`
+    after an interruption.
+    """
+    api = api or BatchAPI.from_client(analysis_pipeline.get_client())
+    job = BatchJob(job_dir)
+    if job.state["session_id"] is None:
+        job.state["session_id"] = str(uuid4())
+        job.state["dataset"] = dataset
+        job.save_state()
+    datasets = job.state["dataset"]
+    if isinstance(datasets, dict):
+        datasets = sorted(set(datasets.values()))
+    analysis_pipeline.results_store.start_session(
+        job.state["session_id"], mode="batch", dataset=datasets
+    )
+    with telemetry.run(job.state["session_id"]):
+        requests, report_ids = build_requests(reports, keys, model=model)
+        cache = analysis_pipeline.response_cache
+
+        # Batches left running by an earlier invocation are finished first
+        job.wait(api, poll_interval)
+        job.collect(api, cache)
+        submissions = 0
+        while True:
+            done = job.results()
+            pending = [request for cid, request in requests.items() if cid not in done]
+            if not pending or submissions > max_resubmissions:
+                break
+            job.submit(api, pending, completion_window)
+            submissions += 1
+            job.wait(api, poll_interval)
+            job.collect(api, cache)
+
+        stored = ingest(job, reports, report_ids, dataset=job.state["dataset"])
+        done = job.results()
+        failed = sum(
+            not all(cid in done for cid in custom_ids)
+            for custom_ids in report_ids.values()
+        )
+    summary = {
+        "reports": len(report_ids),
+        "stored": stored,
+        "failed": failed,
+        "requests": len(requests),
+        "batches": len(job.state["batches"]),
+    }
+    print(
+        f"Stored {stored} new analyses; {failed} of {len(report_ids)} reports failed "
+        f"after {summary['batches']} batches"
+    )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("directory", help="e.g. raw_experiences/LSD")
+    parser.add_argument("--job", required=True, help="directory for the job's state")
+    parser.add_argument("--base-url", help="OpenAI-compatible API, e.g. a local mock")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument(
+        "--max-resubmissions", type=int, default=DEFAULT_MAX_RESUBMISSIONS
+    )
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.base_url or args.api_key:
+        analysis_pipeline.configure_client(api_key=args.api_key, base_url=args.base_url)
+    rows = list(iter_reports(args.directory))[: args.limit]
+    reports = ReportIndex.from_dataframe(pd.DataFrame(rows))
+    run_batch_job(
+        reports,
+        reports.keys(),
+        args.job,
+        # The app's dataset keys, so the analyses show up under the same datasets
+        dataset=dict(zip(reports.keys(), (row["dataset"] for row in rows))),
+        model=args.model,
+        poll_interval=args.poll_interval,
+        max_resubmissions=args.max_resubmissions,
+    )
+
+
+if __name__ == "__main__":
+    main()
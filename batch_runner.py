@@ -0,0 +1,196 @@
+"""
+Headless batch analysis of a whole substance directory under raw_experiences/.
+
+Usage:
+    python batch_runner.py raw_experiences/LSD --checkpoint checkpoints/lsd.jsonl
+
+Every finished report is appended to the checkpoint file, so an interrupted run can be
+restarted with the same command and will skip reports that were already analyzed.
+"""
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import pandas as pd
+
+import analysis_pipeline
+from analysis_pipeline import ANALYSIS_MODES, run_analysis, save_data
+from dataset_catalog import dataset_key
+from report_index import report_key
+from llm_utils import track_usage
+
+
+def load_checkpoint(path):
+    """
+    Return the keys of reports already analyzed successfully.
+    A trailing partial line from a crash is ignored.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                done.add(record["key"])
+    return done
+
+
+def iter_reports(directory, chunk_size=500):
+    """
+    Stream report rows from every CSV under `directory` (a substance directory such as
+    raw_experiences/LSD) without loading them all at once. Each row's "dataset" is the
+    key the app's DatasetCatalog gives its file.
+    """
+    root = os.path.dirname(os.path.normpath(directory))
+    for csv_file in sorted(glob.glob(os.path.join(directory, "**/*.csv"), recursive=True)):
+        dataset = dataset_key(csv_file, root)
+        for chunk in pd.read_csv(csv_file, chunksize=chunk_size):
+            for row in chunk.to_dict("records"):
+                if isinstance(row.get("text"), str) and row["text"].strip():
+                    row["source_file"] = csv_file
+                    row["dataset"] = dataset
+                    yield row
+
+
+def _analyze_row(row, session_id, mode):
+    key = report_key(row)
+    record = {
+        "key": key,
+        "title": row.get("title"),
+        "source_file": row["source_file"],
+        "dataset": row["dataset"],
+    }
+    try:
+        with track_usage() as usage:
+            themes, substance, emotions, age, gender = run_analysis(
+                row["text"], key, session_id=session_id, mode=mode, save=False
+            )
+    except Exception as e:
+        return {**record, "status": "failed", "error": str(e)}
+    if themes is None:
+        return {**record, "status": "failed", "error": "schema validation failed"}
+    return {
+        **record,
+        "status": "ok",
+        "result": {
+            "substance": substance,
+            "themes": themes,
+            "emotions": emotions,
+            "age": age,
+            "gender": gender,
+            "usage": usage.snapshot(),
+        },
+    }
+
+
+def run_batch(
+    directory,
+    checkpoint_path,
+    max_concurrency=4,
+    chunk_size=100,
+    mode="two_pass",
+    limit=None,
+):
+    """
+    Analyze every not-yet-checkpointed report under `directory`, `chunk_size` reports at a time.
+    """
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    done = load_checkpoint(checkpoint_path)
+    print(f"Resuming with {len(done)} reports already analyzed")
+    session_id = str(uuid4())
+    analysis_pipeline.results_store.start_session(
+        session_id, mode=mode, directory=directory
+    )
+    processed = failed = 0
+
+    def pending_chunks():
+        chunk = []
+        seen = set()
+        for row in iter_reports(directory):
+            key = report_key(row)
+            if key in done or key in seen:
+                continue
+            seen.add(key)
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with open(checkpoint_path, "a") as checkpoint, ThreadPoolExecutor(
+        max_workers=max(1, max_concurrency)
+    ) as executor:
+        for chunk in pending_chunks():
+            if limit is not None:
+                chunk = chunk[: limit - processed]
+            records = list(
+                executor.map(
+                    _analyze_row, chunk, [session_id] * len(chunk), [mode] * len(chunk)
+                )
+            )
+            # Store before checkpointing so a crash never marks an unsaved report as done
+            save_data(
+                [
+                    {
+                        **record["result"],
+                        "key": record["key"],
+                        "title": record["title"],
+                        "dataset": record["dataset"],
+                    }
+                    for record in records
+                    if record["status"] == "ok"
+                ],
+                session_id=session_id,
+            )
+            for record in records:
+                checkpoint.write(json.dumps(record) + "\n")
+                processed += 1
+                failed += record["status"] != "ok"
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            print(f"Analyzed {processed} reports ({failed} failed)")
+            if limit is not None and processed >= limit:
+                break
+    return processed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", help="e.g. raw_experiences/LSD")
+    parser.add_argument("--checkpoint", required=True, help="Append-only JSONL checkpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--requests-per-minute", type=int, default=None)
+    parser.add_argument("--tokens-per-minute", type=int, default=None)
+    parser.add_argument("--mode", choices=ANALYSIS_MODES, default="two_pass")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    analysis_pipeline.request_budget.configure(
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+    )
+    # The shared limiter caps in-flight calls below the thread count otherwise
+    analysis_pipeline.concurrency_limiter.configure(maximum=args.concurrency)
+    run_batch(
+        args.directory,
+        args.checkpoint,
+        max_concurrency=args.concurrency,
+        chunk_size=args.chunk_size,
+        mode=args.mode,
+        limit=args.limit,
+    )
+
+
+if __name__ == "__main__":
+    main()
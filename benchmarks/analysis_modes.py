@@ -0,0 +1,62 @@
+"""
+Compare the two-pass and single-pass analysis modes on a fixed corpus.
+
+Usage:
+    python -m benchmarks.analysis_modes raw_experiences/LSD/reports.csv --limit 50
+"""
+import argparse
+import json
+import statistics
+import time
+
+import pandas as pd
+from pydantic import ValidationError
+
+import analysis_pipeline
+from analysis_pipeline import ANALYSIS_MODES, AnalysisResultJSON, analyze_report_json
+from llm_utils import usage_tracker
+
+
+def benchmark_mode(texts, mode):
+    before = usage_tracker.snapshot()
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    for text in texts:
+        report_start = time.perf_counter()
+        try:
+            AnalysisResultJSON(**json.loads(analyze_report_json(text, mode=mode)))
+        except (ValidationError, json.JSONDecodeError, TypeError) as e:
+            print(f"[{mode}] schema validation failed: {e}")
+            failures += 1
+        latencies.append(time.perf_counter() - report_start)
+    wall_time = time.perf_counter() - start
+    after = usage_tracker.snapshot()
+    return {
+        "mode": mode,
+        "reports": len(texts),
+        "wall_time_s": round(wall_time, 3),
+        "mean_latency_s": round(statistics.mean(latencies), 3) if latencies else 0.0,
+        "requests": after["requests"] - before["requests"],
+        "prompt_tokens": after["prompt_tokens"] - before["prompt_tokens"],
+        "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+        "validation_failure_rate": round(failures / len(texts), 3) if texts else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("corpus", help="CSV file with a 'text' column")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--modes", nargs="+", default=list(ANALYSIS_MODES))
+    args = parser.parse_args()
+
+    # Always measure real API calls, never cached responses
+    analysis_pipeline.response_cache.enabled = False
+    texts = pd.read_csv(args.corpus)["text"].dropna().head(args.limit).tolist()
+    results = [benchmark_mode(texts, mode) for mode in args.modes]
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Synthetic trip-report corpora for benchmarks, shaped like the parsed Erowid datasets.
+"""
+import random
+
+import pandas as pd
+
+SUBSTANCES = ["LSD", "Psilocybin Mushrooms", "DMT", "Mescaline", "Ayahuasca", "Ketamine"]
+THEMES = [
+    "ego dissolution",
+    "visual distortions",
+    "connection with nature",
+    "time dilation",
+    "spiritual insight",
+    "childhood memories",
+    "music appreciation",
+    "body load",
+    "synesthesia",
+    "fear of death",
+    "unity with others",
+    "geometric patterns",
+    "self reflection",
+    "nausea",
+    "laughter",
+    "introspection",
+]
+EMOTIONS = [
+    "euphoria",
+    "anxiety",
+    "awe",
+    "gratitude",
+    "fear",
+    "calm",
+    "confusion",
+    "love",
+    "sadness",
+    "joy",
+    "paranoia",
+    "wonder",
+]
+SEXES = ["Male", "Female", "Not Given"]
+FILLER = (
+    "the room felt different and I sat with my friends while the light moved slowly "
+    "across the wall and we talked about nothing in particular for a long time"
+).split()
+
+
+def synthetic_report(rng: random.Random, words: int) -> str:
+    """
+    One report of about `words` words mentioning a few themes and emotions.
+    """
+    substance = rng.choice(SUBSTANCES)
+    themes = rng.sample(THEMES, rng.randint(2, 5))
+    emotions = rng.sample(EMOTIONS, rng.randint(2, 4))
+    sentences = [f"I took {substance} on a quiet evening."]
+    sentences += [f"There was a lot of {theme}." for theme in themes]
+    sentences += [f"I felt {emotion}." for emotion in emotions]
+    while sum(len(sentence.split()) for sentence in sentences) < words:
+        start = rng.randrange(len(FILLER))
+        sentences.append(" ".join(FILLER[start:] + FILLER[:start]).capitalize() + ".")
+    rng.shuffle(sentences)
+    return " ".join(sentences)
+
+
+def synthetic_reports(
+    n: int,
+    seed: int = 0,
+    min_words: int = 300,
+    max_words: int = 1500,
+    long_fraction: float = 0.01,
+    long_words: int = 8000,
+) -> pd.DataFrame:
+    """
+    A DataFrame of `n` reports with the dataset columns the app reads. A `long_fraction`
+    share of reports are `long_words` long so chunked analysis is exercised too.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        words = long_words if rng.random() < long_fraction else rng.randint(min_words, max_words)
+        text = synthetic_report(rng, words)
+        rows.append(
+            {
+                "ID": 100000 + i,
+                "title": f"Synthetic report {i}",
+                "text": text,
+                "substance": text.split("I took ", 1)[1].split(" on ", 1)[0],
+                "age": rng.randint(18, 60),
+                "sex": rng.choice(SEXES),
+                "exp_year": rng.randint(1995, 2023),
+            }
+        )
+    return pd.DataFrame(rows)
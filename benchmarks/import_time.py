@@ -0,0 +1,154 @@
+"""
+Cold-start import time of the app's modules.
+
+Each module is imported in a fresh interpreter under `python -X importtime`, without an
+OpenAI key in the environment, so the numbers are what a new app process or CLI pays
+before doing anything. The slowest direct imports of each module are listed with it.
+
+Usage:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules main analysis_pipeline --repeat 9
+    python -m benchmarks.import_time --output imports.json
+    python -m benchmarks.import_time --baseline imports.json  # exit 1 on regressions
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+import pandas as pd
+
+MODULES = (
+    "main",
+    "analysis_pipeline",
+    "llm_utils",
+    "data_utils",
+    "aggregation",
+    "analytics",
+    "search_index",
+    "dedup",
+    "local_categorizer",
+    "results_store",
+    "batch_runner",
+    "batch_api",
+)
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Import time changes under this are noise, whatever the tolerance
+MIN_DELTA_MS = 20.0
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_profile(module: str):
+    """
+    Import `module` in a new interpreter; returns its cumulative import time and that of
+    each of its direct imports, in ms.
+    """
+    env = {name: value for name, value in os.environ.items() if name != "OPENAI_API_KEY"}
+    # Nothing should be written (or exported) just by importing
+    env["TELEMETRY_PATH"] = ""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    total, children, pending = None, {}, []
+    # Imports are logged when they finish, so a module's own imports precede it, one
+    # indentation level deeper
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        depth, name = (len(match.group(3)) - 1) // 2, match.group(4)
+        if depth == 0 and name == module:
+            total = cumulative_ms
+            children = {child: ms for child_depth, child, ms in pending if child_depth == 1}
+        elif depth == 0:
+            pending = []
+            continue
+        pending.append((depth, name, cumulative_ms))
+    return total, children
+
+
+def measure(module: str, repeat: int, top: int):
+    """
+    Median cold import time of `module` over `repeat` runs, after one warm-up run that
+    also compiles stale bytecode.
+    """
+    import_profile(module)
+    totals, children = [], {}
+    for _ in range(repeat):
+        total, direct = import_profile(module)
+        totals.append(total)
+        for child, ms in direct.items():
+            children.setdefault(child, []).append(ms)
+    slowest = sorted(
+        ((child, statistics.median(times)) for child, times in children.items()),
+        key=lambda item: -item[1],
+    )[:top]
+    return {
+        "module": module,
+        "import_ms": round(statistics.median(totals), 1),
+        "min_ms": round(min(totals), 1),
+        "slowest_imports": ", ".join(f"{child} {ms:.0f}ms" for child, ms in slowest),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Modules whose import time grew by more than `tolerance` (and MIN_DELTA_MS).
+    """
+    previous = {row["module"]: row for row in baseline}
+    found = []
+    for row in results:
+        old = previous.get(row["module"])
+        if old is None:
+            continue
+        if (
+            row["import_ms"] > old["import_ms"] * (1 + tolerance)
+            and row["import_ms"] - old["import_ms"] > MIN_DELTA_MS
+        ):
+            found.append(f"{row['module']}: {old['import_ms']}ms -> {row['import_ms']}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--modules", nargs="+", default=list(MODULES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=3, help="slowest imports to list")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    for module in args.modules:
+        results.append(measure(module, args.repeat, args.top))
+        print(f"{module}: {results[-1]['import_ms']}ms")
+
+    with pd.option_context("display.max_colwidth", None):
+        print(pd.DataFrame(results).to_string(index=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""
+Local stand-in for the OpenAI chat completions and Batch APIs, for benchmarking and for
+trying batch jobs without spending money.
+
+Replies are derived from the prompt (vocabulary from benchmarks.corpus found in the report
+becomes its themes/emotions, category prompts get deterministic categories), so every
+pipeline stage receives well-formed output. Latency, jitter, 5xx errors and 429s are
+configurable. Batches run every line through the same replies and 500s (batches get no
+429s) and complete `batch_latency` seconds after they are created.
+
+Usage:
+    python -m benchmarks.mock_openai --port 8089 --latency 0.2 --rate-limit-rate 0.05
+    # then point the pipeline at it:
+    analysis_pipeline.configure_client(api_key="mock", base_url="http://127.0.0.1:8089/v1")
+"""
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.corpus import EMOTIONS, SUBSTANCES, THEMES
+
+ITEM_SECTION = re.compile(r"# (THEMES|EMOTIONS)\n(.*?)# END OF \1", re.DOTALL)
+CATEGORY_SECTION = re.compile(r"# CATEGORIES\n(.*?)# END OF CATEGORIES", re.DOTALL)
+MAX_BROAD_CATEGORIES = 8
+
+
+def _bullets(section: str) -> List[str]:
+    lines = (line.strip() for line in section.splitlines())
+    return [line[2:].strip() for line in lines if line.startswith("- ")]
+
+
+def _mentions(text: str, vocabulary: List[str]) -> List[str]:
+    lowered = text.lower()
+    return [word for word in vocabulary if word.lower() in lowered]
+
+
+def _bucket(item: str, buckets: int) -> int:
+    return zlib.crc32(item.strip().lower().encode("utf-8")) % buckets
+
+
+def reply_for(prompt: str, json_mode: bool) -> str:
+    """
+    A plausible reply to one of the pipeline's prompts.
+    """
+    items = ITEM_SECTION.search(prompt)
+    categories = CATEGORY_SECTION.search(prompt)
+    if categories and items:
+        names = _bullets(categories.group(1)) or ["Other"]
+        mapping: Dict[str, List[str]] = {}
+        for item in _bullets(items.group(2)):
+            mapping.setdefault(names[_bucket(item, len(names))], []).append(item)
+        return json.dumps(mapping)
+    if items:
+        kind = items.group(1).lower()
+        count = min(MAX_BROAD_CATEGORIES, max(1, len(_bullets(items.group(2))) // 4))
+        broad = [f"{kind[:-1].title()} group {i + 1}" for i in range(count)]
+        return json.dumps({f"common_{kind}": broad})
+
+    substances = _mentions(prompt, SUBSTANCES)
+    themes = _mentions(prompt, THEMES)[:5] or ["general experience"]
+    emotions = _mentions(prompt, EMOTIONS)[:4] or ["neutral"]
+    substance = substances[0] if substances else "N/A"
+    if not json_mode:
+        return (
+            f"1. Common themes: {', '.join(themes)}\n2. Substance used: {substance}\n"
+            f"3. Age of reporter: N/A\n4. Gender of reporter: N/A\n"
+            f"5. Common emotions: {', '.join(emotions)}"
+        )
+    return json.dumps(
+        {
+            "substance": substance,
+            "themes": themes,
+            "emotions": emotions,
+            "age": "N/A",
+            "gender": "N/A",
+        }
+    )
+
+
+class MockOpenAIServer:
+    """
+    Threaded HTTP server implementing POST /v1/chat/completions, plus the files
+    (upload, content) and batches (create, retrieve) endpoints batch jobs use.
+
+    Each request sleeps `latency` ± `jitter` seconds, then fails with a 500 with probability
+    `error_rate` or a 429 (with Retry-After: `retry_after`) with probability
+    `rate_limit_rate`. stats() reports request counts by status and handling latencies.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 0.1,
+        seed: Optional[int] = None,
+        batch_latency: float = 0.5,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.batch_latency = batch_latency
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def reset_stats(self):
+        with self._lock:
+            self.status_counts: Dict[int, int] = {}
+            self.latencies: List[float] = []
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.batch_requests = 0
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "requests": sum(self.status_counts.values()),
+                "status_counts": dict(self.status_counts),
+                "latencies": list(self.latencies),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "batch_requests": self.batch_requests,
+            }
+
+    def _draw(self):
+        with self._lock:
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            roll = self._random.random()
+        if roll < self.error_rate:
+            return delay, 500
+        if roll < self.error_rate + self.rate_limit_rate:
+            return delay, 429
+        return delay, 200
+
+    def _record(self, status, elapsed, prompt_tokens=0, completion_tokens=0):
+        with self._lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.latencies.append(elapsed)
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def _completion(self, body: Dict[str, Any]) -> Tuple[Dict[str, Any], int, int]:
+        prompt = "\n".join(
+            str(message.get("content", "")) for message in body.get("messages", [])
+        )
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        content = reply_for(prompt, json_mode)
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(content) // 4)
+        completion = {
+            "id": f"chatcmpl-mock-{zlib.crc32(prompt.encode('utf-8'))}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+        return completion, prompt_tokens, completion_tokens
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}-mock-{next(self._ids)}"
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        with self._lock:
+            file_id = self._new_id("file")
+            self.files[file_id] = {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "content": content,
+            }
+        return self.files[file_id]
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Answer every request line of the input file now; the batch reports "completed"
+        once `batch_latency` has passed.
+        """
+        input_file = self.files[body["input_file_id"]]
+        outputs, errors = [], []
+        for line in input_file["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            _, status = self._draw()
+            request_id = self._new_id("batch_req")
+            if status == 200:
+                completion, prompt_tokens, completion_tokens = self._completion(
+                    request["body"]
+                )
+                response = {"status_code": 200, "request_id": request_id, "body": completion}
+                outputs.append(
+                    {
+                        "id": request_id,
+                        "custom_id": request["custom_id"],
+                        "response": response,
+                        "error": None,
+                    }
+                )
+            else:
+                prompt_tokens = completion_tokens = 0
+                response = {
+                    "status_code": 500,
+                    "request_id": request_id,
+                    "body": {
+                        "error": {"message": "Mock server error", "type": "server_error"}
+                    },
+                }
+                errors.append(
+                    {
+                        "id": request_id,
+                        "custom_id": request["custom_id"],
+                        "response": response,
+                        "error": None,
+                    }
+                )
+            with self._lock:
+                self.batch_requests += 1
+                self.prompt_tokens += prompt_tokens
+                self.completion_tokens += completion_tokens
+
+        def jsonl(records):
+            return "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+
+        output_file = self.add_file("batch_output.jsonl", "batch_output", jsonl(outputs))
+        error_file = (
+            self.add_file("batch_errors.jsonl", "batch_output", jsonl(errors))
+            if errors
+            else None
+        )
+        with self._lock:
+            batch_id = self._new_id("batch")
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body.get("endpoint"),
+                "errors": None,
+                "input_file_id": body["input_file_id"],
+                "completion_window": body.get("completion_window", "24h"),
+                "created_at": int(time.time()),
+                "metadata": body.get("metadata"),
+                "request_counts": {
+                    "total": len(outputs) + len(errors),
+                    "completed": len(outputs),
+                    "failed": len(errors),
+                },
+                "_ready_at": time.monotonic() + self.batch_latency,
+                "_output_file_id": output_file["id"],
+                "_error_file_id": error_file["id"] if error_file else None,
+            }
+        return self.retrieve_batch(batch_id)
+
+    def retrieve_batch(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            batch = self.batches[batch_id]
+            done = time.monotonic() >= batch["_ready_at"]
+            public = {k: v for k, v in batch.items() if not k.startswith("_")}
+        public["status"] = "completed" if done else "in_progress"
+        public["output_file_id"] = batch["_output_file_id"] if done else None
+        public["error_file_id"] = batch["_error_file_id"] if done else None
+        return public
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out as separate writes; don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _not_found(self, start):
+                self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                server._record(404, time.perf_counter() - start)
+
+            def _upload(self, payload):
+                # multipart/form-data with "purpose" and "file" fields
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+                    + payload
+                )
+                fields = {
+                    part.get_param("name", header="content-disposition"): part
+                    for part in message.iter_parts()
+                }
+                uploaded = server.add_file(
+                    fields["file"].get_filename() or "upload.jsonl",
+                    fields["purpose"].get_payload(decode=True).decode("utf-8"),
+                    fields["file"].get_payload(decode=True),
+                )
+                return {k: v for k, v in uploaded.items() if k != "content"}
+
+            def do_GET(self):
+                start = time.perf_counter()
+                parts = self.path.rstrip("/").split("/")
+                if parts[:3] == ["", "v1", "batches"] and len(parts) == 4:
+                    if parts[3] not in server.batches:
+                        return self._not_found(start)
+                    self._send(200, server.retrieve_batch(parts[3]))
+                elif parts[:3] == ["", "v1", "files"] and parts[4:] == ["content"]:
+                    if parts[3] not in server.files:
+                        return self._not_found(start)
+                    payload = server.files[parts[3]]["content"]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                else:
+                    return self._not_found(start)
+                server._record(200, time.perf_counter() - start)
+
+            def do_POST(self):
+                start = time.perf_counter()
+                length = int(self.headers.get("Content-Length", 0))
+                payload = self.rfile.read(length)
+                path = self.path.rstrip("/")
+                if path == "/v1/files":
+                    self._send(200, self._upload(payload))
+                    server._record(200, time.perf_counter() - start)
+                    return
+                body = json.loads(payload or b"{}")
+                if path == "/v1/batches":
+                    if body.get("input_file_id") not in server.files:
+                        self._send(400, {"error": {"message": "Unknown input_file_id"}})
+                        server._record(400, time.perf_counter() - start)
+                        return
+                    self._send(200, server.create_batch(body))
+                    server._record(200, time.perf_counter() - start)
+                    return
+                if path != "/v1/chat/completions":
+                    return self._not_found(start)
+                delay, status = server._draw()
+                time.sleep(delay)
+                if status == 500:
+                    self._send(
+                        500, {"error": {"message": "Mock server error", "type": "server_error"}}
+                    )
+                    server._record(500, time.perf_counter() - start)
+                    return
+                if status == 429:
+                    self._send(
+                        429,
+                        {"error": {"message": "Rate limit reached", "type": "requests"}},
+                        headers={"Retry-After": str(server.retry_after)},
+                    )
+                    server._record(429, time.perf_counter() - start)
+                    return
+
+                completion, prompt_tokens, completion_tokens = server._completion(body)
+                self._send(200, completion)
+                server._record(200, time.perf_counter() - start, prompt_tokens, completion_tokens)
+
+        return Handler
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--batch-latency", type=float, default=0.5)
+    args = parser.parse_args()
+    server = MockOpenAIServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        batch_latency=args.batch_latency,
+    )
+    print(f"Mock OpenAI API listening on {server.base_url}")
+    server.start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Throughput, latency, memory and token benchmarks of the pipeline against a local mock API.
+
+Each scenario runs on synthetic corpora of every requested size, with the response cache
+off and results written to a throwaway store. Request latencies are measured by the mock
+server, report latencies by the client.
+
+Usage:
+    python -m benchmarks.pipeline --sizes 10 100 1000 --concurrency 8
+    python -m benchmarks.pipeline --sizes 10000 --scenarios categorize aggregate
+    python -m benchmarks.pipeline --output bench.json
+    python -m benchmarks.pipeline --baseline bench.json  # exit 1 on regressions
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import analysis_pipeline
+from aggregation import IncrementalAggregator
+from analysis_pipeline import (
+    ANALYSIS_MODES,
+    CATEGORIZERS,
+    AnalysisResultJSON,
+    categorize_analysis_results,
+    run_analysis,
+    run_analysis_and_categorize,
+)
+from benchmarks.corpus import synthetic_reports
+from benchmarks.mock_openai import MockOpenAIServer, reply_for
+from llm_utils import usage_tracker
+from report_index import ReportIndex
+from results_store import ResultsStore
+
+SCENARIOS = ("run_analysis", "run_analysis_and_categorize", "categorize", "aggregate")
+# Aggregation scenario: analyses arrive in sessions of this many reports
+AGGREGATE_BATCH = 100
+MIN_MEMORY_DELTA_MB = 1.0
+
+
+def offline_analyses(df: pd.DataFrame):
+    """
+    Analyses of a synthetic corpus computed without the API, for the categorization and
+    aggregation scenarios. One variant item per report grows the vocabulary with the corpus.
+    """
+    analyses = []
+    for i, row in enumerate(df.to_dict("records")):
+        analysis = json.loads(reply_for(row["text"], json_mode=True))
+        analysis["themes"].append(f"{analysis['themes'][0]} variant {i % 997}")
+        analysis["key"] = str(row["ID"])
+        analyses.append(analysis)
+    return analyses
+
+
+def bench_run_analysis(df, args):
+    """
+    Returns (latencies of successful reports, number of failed reports).
+    """
+
+    def analyze(row):
+        start = time.perf_counter()
+        try:
+            themes, *_ = run_analysis(
+                row["text"], str(row["ID"]), session_id="bench", mode=args.mode, save=False
+            )
+        except Exception:
+            return None
+        return time.perf_counter() - start if themes is not None else None
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(analyze, df.to_dict("records")))
+    successful = [latency for latency in latencies if latency is not None]
+    return successful, len(latencies) - len(successful)
+
+
+def bench_run_analysis_and_categorize(df, args):
+    reports = ReportIndex.from_dataframe(df)
+    run_analysis_and_categorize(
+        reports,
+        reports.keys(),
+        max_concurrency=args.concurrency,
+        mode=args.mode,
+        categorizer=args.categorizer,
+        dataset="benchmark",
+    )
+
+
+def bench_categorize(df, args):
+    analyses = [
+        AnalysisResultJSON(**{k: v for k, v in analysis.items() if k != "key"})
+        for analysis in offline_analyses(df)
+    ]
+    categorize_analysis_results(
+        analyses, max_concurrency=args.concurrency, categorizer=args.categorizer
+    )
+
+
+def bench_aggregate(df, args):
+    aggregator = IncrementalAggregator(
+        categorizer=args.categorizer, max_concurrency=args.concurrency
+    )
+    analyses = offline_analyses(df)
+    for start in range(0, len(analyses), AGGREGATE_BATCH):
+        aggregator.add_many(analyses[start : start + AGGREGATE_BATCH])
+        aggregator.flush()
+    aggregator.counts("themes")
+    aggregator.counts("emotions")
+
+
+BENCHMARKS = {
+    "run_analysis": bench_run_analysis,
+    "run_analysis_and_categorize": bench_run_analysis_and_categorize,
+    "categorize": bench_categorize,
+    "aggregate": bench_aggregate,
+}
+
+
+def _percentile_ms(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 1) if len(values) else None
+
+
+def _run(scenario, df, args):
+    output = io.StringIO()
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(output):
+        return BENCHMARKS[scenario](df, args) or ([], None)
+
+
+def peak_memory_mb(scenario, df, args):
+    tracemalloc.start()
+    try:
+        _run(scenario, df, args)
+        return round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def measure(scenario, df, args, server):
+    """
+    Time one scenario, then (unless --skip-memory) repeat it under tracemalloc for its
+    peak memory; tracing slows the pipeline down too much to time the same run.
+    A scenario that raises (e.g. retries exhausted on 429s) is reported, not fatal.
+    """
+    server.reset_stats()
+    before = usage_tracker.snapshot()
+    error, report_latencies, failed_reports = None, [], None
+    start = time.perf_counter()
+    try:
+        report_latencies, failed_reports = _run(scenario, df, args)
+    except Exception as e:
+        error = repr(e)
+    wall_time = time.perf_counter() - start
+    after = usage_tracker.snapshot()
+    stats = server.stats()
+    return {
+        "scenario": scenario,
+        "reports": len(df),
+        "wall_time_s": round(wall_time, 3),
+        "reports_per_s": round(len(df) / wall_time, 2),
+        "requests": stats["requests"],
+        "requests_per_s": round(stats["requests"] / wall_time, 2),
+        "request_p50_ms": _percentile_ms(stats["latencies"], 50),
+        "request_p95_ms": _percentile_ms(stats["latencies"], 95),
+        "report_p50_ms": _percentile_ms(report_latencies, 50),
+        "report_p95_ms": _percentile_ms(report_latencies, 95),
+        "failed_requests": stats["requests"] - stats["status_counts"].get(200, 0),
+        "failed_reports": failed_reports,
+        "peak_memory_mb": (
+            None if args.skip_memory or error else peak_memory_mb(scenario, df, args)
+        ),
+        "prompt_tokens": after["prompt_tokens"] - before["prompt_tokens"],
+        "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+        "error": error,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Rows whose throughput dropped, or whose peak memory grew, by more than `tolerance`
+    (memory changes under MIN_MEMORY_DELTA_MB are ignored as noise).
+    """
+    previous = {(row["scenario"], row["reports"]): row for row in baseline}
+    found = []
+    for row in results:
+        old = previous.get((row["scenario"], row["reports"]))
+        if old is None or old.get("error"):
+            continue
+        if row["error"]:
+            found.append(f"{row['scenario']}@{row['reports']}: {row['error']}")
+            continue
+        if row["reports_per_s"] < old["reports_per_s"] * (1 - tolerance):
+            found.append(
+                f"{row['scenario']}@{row['reports']}: reports/s "
+                f"{old['reports_per_s']} -> {row['reports_per_s']}"
+            )
+        if (
+            row["peak_memory_mb"]
+            and old["peak_memory_mb"]
+            and row["peak_memory_mb"] > old["peak_memory_mb"] * (1 + tolerance)
+            and row["peak_memory_mb"] - old["peak_memory_mb"] > MIN_MEMORY_DELTA_MB
+        ):
+            found.append(
+                f"{row['scenario']}@{row['reports']}: peak memory "
+                f"{old['peak_memory_mb']}MB -> {row['peak_memory_mb']}MB"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--mode", choices=ANALYSIS_MODES, default="two_pass")
+    parser.add_argument("--categorizer", choices=CATEGORIZERS, default="llm")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="mock jitter (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 500s")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--skip-memory", action="store_true", help="skip the traced run")
+    parser.add_argument("--verbose", action="store_true", help="show pipeline output")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+    ).start()
+    analysis_pipeline.configure_client(api_key="mock", base_url=server.base_url)
+    # run_analysis calls from the benchmark's own threads go through the shared limiter
+    analysis_pipeline.concurrency_limiter.configure(maximum=args.concurrency)
+    # Always measure requests, never cached responses
+    analysis_pipeline.response_cache.enabled = False
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        analysis_pipeline.results_store = ResultsStore(os.path.join(directory, "results.sqlite3"))
+        for size in args.sizes:
+            df = synthetic_reports(size, seed=args.seed)
+            for scenario in args.scenarios:
+                results.append(measure(scenario, df, args, server))
+                print(f"{scenario} @ {size} reports: {results[-1]['wall_time_s']}s")
+    server.stop()
+
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
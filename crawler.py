@@ -0,0 +1,325 @@
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Iterable, List, Optional
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+import httpx
+
+DEFAULT_USER_AGENT = "psychedelic-trip-report-analysis/0.1 (research crawler)"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Async token bucket: on average `rate` acquisitions per second, bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CrawlStore:
+    """
+    Persistent frontier and visited set. Every URL is a row whose status moves from
+    'pending' to 'done' or 'failed'; validators are kept for conditional re-fetches.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                http_status INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                fetched_at REAL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_status ON pages (status)")
+        self._conn.commit()
+
+    def add(self, urls: Iterable[str]) -> List[str]:
+        """
+        Add URLs to the frontier, returning only the ones that were not known yet.
+        """
+        added = []
+        for url in urls:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO pages (url) VALUES (?)", (url,))
+            if cursor.rowcount:
+                added.append(url)
+        self._conn.commit()
+        return added
+
+    def pending(self, include_failed: bool = False) -> List[str]:
+        statuses = ("pending", "failed") if include_failed else ("pending",)
+        placeholders = ", ".join("?" * len(statuses))
+        return [
+            url
+            for (url,) in self._conn.execute(
+                f"SELECT url FROM pages WHERE status IN ({placeholders}) ORDER BY rowid",
+                statuses,
+            )
+        ]
+
+    def done(self) -> List[str]:
+        return [
+            url
+            for (url,) in self._conn.execute(
+                "SELECT url FROM pages WHERE status = 'done' ORDER BY rowid"
+            )
+        ]
+
+    def validators(self, url: str):
+        row = self._conn.execute(
+            "SELECT etag, last_modified FROM pages WHERE url = ?", (url,)
+        ).fetchone()
+        return row if row else (None, None)
+
+    def mark(self, url, status, http_status=None, etag=None, last_modified=None, attempts=0):
+        self._conn.execute(
+            "UPDATE pages SET status = ?, http_status = ?, "
+            "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), "
+            "attempts = attempts + ?, fetched_at = ? WHERE url = ?",
+            (status, http_status, etag, last_modified, attempts, time.time(), url),
+        )
+        self._conn.commit()
+
+    def counts(self):
+        return dict(self._conn.execute("SELECT status, COUNT(*) FROM pages GROUP BY status"))
+
+    def close(self):
+        self._conn.close()
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# handle_page(url, response) -> links to add to the frontier (may be empty)
+PageHandler = Callable[[str, httpx.Response], Awaitable[Iterable[str]]]
+
+
+class Crawler:
+    """
+    Polite, resumable async crawler over a single site.
+
+    Requests share one pooled httpx.AsyncClient, are spaced by a token bucket (slowed
+    further to the robots.txt Crawl-delay), limited to `max_concurrency` in flight, and
+    retried with jittered exponential backoff on 429/5xx/network errors (honouring
+    Retry-After). Revisits send If-None-Match/If-Modified-Since and skip 304 pages.
+    Progress lives in a CrawlStore, so an interrupted crawl resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        store: CrawlStore,
+        user_agent: str = DEFAULT_USER_AGENT,
+        requests_per_second: float = 1.0,
+        max_concurrency: int = 4,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        timeout: float = 30.0,
+        respect_robots: bool = True,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.store = store
+        self.user_agent = user_agent
+        self.requests_per_second = requests_per_second
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.respect_robots = respect_robots
+        self.transport = transport
+        self._robots = {}
+
+    def _client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            headers={"User-Agent": self.user_agent},
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency,
+            ),
+            transport=self.transport,
+        )
+
+    async def _load_robots(self, client, url) -> Optional[RobotFileParser]:
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        if origin not in self._robots:
+            parser = None
+            try:
+                response = await client.get(urljoin(origin, "/robots.txt"))
+                if response.status_code == 200:
+                    parser = RobotFileParser()
+                    parser.parse(response.text.splitlines())
+            except httpx.HTTPError:
+                pass
+            self._robots[origin] = parser
+        return self._robots[origin]
+
+    async def _fetch(self, client, bucket, url) -> Optional[httpx.Response]:
+        etag, last_modified = self.store.validators(url)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            delay = None
+            try:
+                response = await client.get(url, headers=headers)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = retry_after_seconds(response)
+                print(f"{url}: HTTP {response.status_code} (attempt {attempt + 1})")
+            except httpx.TransportError as e:
+                print(f"{url}: {e!r} (attempt {attempt + 1})")
+            if attempt == self.max_retries:
+                break
+            if delay is None:
+                delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+                delay = random.uniform(0, delay)  # full jitter
+            await asyncio.sleep(delay)
+        return None
+
+    async def run(
+        self,
+        seeds: Iterable[str],
+        handle_page: PageHandler,
+        refresh: bool = False,
+        retry_failed: bool = True,
+    ):
+        """
+        Crawl from `seeds` plus whatever is still pending in the store. With refresh=True,
+        seeds that were already fetched are revalidated with conditional requests.
+        """
+        seeds = list(seeds)
+        self.store.add(seeds)
+        queue: asyncio.Queue = asyncio.Queue()
+        queued = set()
+
+        def enqueue(url):
+            if url not in queued:
+                queued.add(url)
+                queue.put_nowait(url)
+
+        for url in self.store.pending(include_failed=retry_failed):
+            enqueue(url)
+        if refresh:
+            for url in seeds:
+                enqueue(url)
+
+        async with self._client() as client:
+            bucket = TokenBucket(self.requests_per_second)
+            if self.respect_robots and seeds:
+                robots = await self._load_robots(client, seeds[0])
+                delay = robots.crawl_delay(self.user_agent) if robots else None
+                if delay:
+                    bucket.rate = min(bucket.rate, 1.0 / float(delay))
+
+            async def worker():
+                while True:
+                    url = await queue.get()
+                    try:
+                        await self._visit(client, bucket, url, handle_page, enqueue)
+                    except Exception as e:
+                        print(f"{url}: handler failed: {e!r}")
+                        self.store.mark(url, "failed", attempts=1)
+                    finally:
+                        queue.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.max_concurrency)]
+            try:
+                await queue.join()
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        return self.store.counts()
+
+    async def _visit(self, client, bucket, url, handle_page, enqueue):
+        if self.respect_robots:
+            robots = await self._load_robots(client, url)
+            if robots is not None and not robots.can_fetch(self.user_agent, url):
+                self.store.mark(url, "skipped")
+                return
+        response = await self._fetch(client, bucket, url)
+        if response is None:
+            self.store.mark(url, "failed", attempts=self.max_retries + 1)
+            return
+        if response.status_code == 304:
+            self.store.mark(url, "done", http_status=304, attempts=1)
+            return
+        if response.status_code >= 400:
+            self.store.mark(url, "failed", http_status=response.status_code, attempts=1)
+            return
+        links = await handle_page(url, response) or []
+        for link in self.store.add(urljoin(url, link) for link in links):
+            enqueue(link)
+        self.store.mark(
+            url,
+            "done",
+            http_status=response.status_code,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            attempts=1,
+        )
+
+
+def crawl(seeds, handle_page, store_path, refresh=False, **crawler_options):
+    """
+    Synchronous entry point: run a Crawler over `seeds` with its state in `store_path`
+    (see Crawler.run for `refresh`).
+    """
+    store = CrawlStore(store_path)
+    try:
+        crawler = Crawler(store, **crawler_options)
+        return asyncio.run(crawler.run(seeds, handle_page, refresh=refresh))
+    finally:
+        store.close()
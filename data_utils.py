@@ -1,12 +1,27 @@
 # data_utils.py
-from typing import List, NamedTuple
-from collections import Counter
-from typing import Dict
-import plotly.express as px
-from analysis_pipeline import AnalysisResultJSON
+from typing import TYPE_CHECKING, List
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+from results_store import ResultsStore
+from telemetry import telemetry
 
+# plotly (and pandas, for heatmaps) are imported by the functions that draw, so importing
+# this module stays cheap; the pipeline is only needed for type hints
+if TYPE_CHECKING:
+    from concurrent.futures import Future
 
-def aggregate_data(analysis_results: List[AnalysisResultJSON]) -> Dict[str, Counter]:
+    import pandas as pd
+    from analysis_pipeline import AnalysisResultJSON
+
+
+def aggregate_data(analysis_results: List["AnalysisResultJSON"]) -> Dict[str, Counter]:
     theme_counter = Counter()
     emotion_counter = Counter()
 
@@ -17,7 +32,56 @@ def aggregate_data(analysis_results: List[AnalysisResultJSON]) -> Dict[str, Coun
     return {"themes": theme_counter, "emotions": emotion_counter}
 
 
-def create_theme_pie_chart(theme_counter: Counter):
+def aggregate_data_from_store(
+    store: ResultsStore, substance=None, session_id=None, dataset=None
+) -> Dict[str, Counter]:
+    """
+    Same result as aggregate_data, computed with GROUP BY queries over the results store.
+    """
+    return {
+        "themes": store.item_counts(
+            "themes", substance=substance, session_id=session_id, dataset=dataset
+        ),
+        "emotions": store.item_counts(
+            "emotions", substance=substance, session_id=session_id, dataset=dataset
+        ),
+    }
+
+
+# Figures and exports are memoized on a digest of the counts they were built from
+MAX_CACHED_FIGURES = 32
+EXPORT_FORMATS = ("png", "svg", "html")
+EXPORT_MIME_TYPES = {"png": "image/png", "svg": "image/svg+xml", "html": "text/html"}
+
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+
+def counter_digest(counter: Counter) -> str:
+    """
+    Stable hash of a Counter's contents, independent of insertion order.
+    """
+    items = sorted((str(item), count) for item, count in counter.items())
+    return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()
+
+
+def _memoized_figure(kind: str, counter: Counter, build):
+    key = (kind, counter_digest(counter))
+    with _figure_cache_lock:
+        if key in _figure_cache:
+            _figure_cache.move_to_end(key)
+            return _figure_cache[key]
+    fig = build(counter)
+    with _figure_cache_lock:
+        _figure_cache[key] = fig
+        while len(_figure_cache) > MAX_CACHED_FIGURES:
+            _figure_cache.popitem(last=False)
+    return fig
+
+
+def _build_theme_pie_chart(theme_counter: Counter):
+    import plotly.express as px
+
     fig = px.pie(
         values=theme_counter.values(), names=theme_counter.keys(), title="Common Themes"
     )
@@ -25,7 +89,9 @@ def create_theme_pie_chart(theme_counter: Counter):
     return fig
 
 
-def create_emotion_bar_chart(emotion_counter: Counter):
+def _build_emotion_bar_chart(emotion_counter: Counter):
+    import plotly.express as px
+
     fig = px.bar(
         x=list(emotion_counter.keys()),
         y=list(emotion_counter.values()),
@@ -35,5 +101,120 @@ def create_emotion_bar_chart(emotion_counter: Counter):
     return fig
 
 
-def export_visualization(fig, filename: str):
-    fig.write_image(f"visualizations/{filename}.png")
+def create_theme_pie_chart(theme_counter: Counter):
+    """
+    Pie chart of theme counts. Figures are shared between calls with the same counts,
+    so don't modify the returned figure.
+    """
+    return _memoized_figure("theme_pie", theme_counter, _build_theme_pie_chart)
+
+
+def create_emotion_bar_chart(emotion_counter: Counter):
+    """
+    Bar chart of emotion counts. Figures are shared between calls with the same counts,
+    so don't modify the returned figure.
+    """
+    return _memoized_figure("emotion_bar", emotion_counter, _build_emotion_bar_chart)
+
+
+def create_heatmap(table: "pd.DataFrame", title: str, share: bool = False):
+    """
+    Heatmap of an analytics table (rows × columns), e.g. substance × theme counts.
+    """
+    import plotly.express as px
+
+    fig = px.imshow(
+        table,
+        title=title,
+        aspect="auto",
+        color_continuous_scale="Viridis",
+        text_auto=".0%" if share else True,
+        labels={"color": "Share of reports" if share else "Reports"},
+    )
+    fig.update_xaxes(tickangle=-45)
+    return fig
+
+
+def render_figure(fig, formats: Tuple[str, ...] = EXPORT_FORMATS) -> Dict[str, bytes]:
+    """
+    Render a figure to each of `formats` (png, svg, html). Image formats need kaleido;
+    formats that can't be rendered are left out.
+    """
+    import plotly.io as pio
+
+    rendered = {}
+    for fmt in formats:
+        if fmt == "html":
+            rendered[fmt] = fig.to_html(include_plotlyjs="cdn").encode("utf-8")
+            continue
+        try:
+            rendered[fmt] = pio.to_image(fig, format=fmt)
+        except (ValueError, RuntimeError) as e:
+            telemetry.log(
+                logging.WARNING,
+                f"Couldn't render {fmt}, skipping it: {str(e).strip().splitlines()[0]}",
+                stage="chart_export",
+            )
+    return rendered
+
+
+class ChartExporter:
+    """
+    Renders figures (PNG/SVG/HTML bytes) in a background worker, so the app doesn't wait on the
+    image renderer. Exports are memoized on the figure's contents: exporting unchanged
+    charts again returns the earlier result.
+    """
+
+    def __init__(self, max_cached_exports: int = MAX_CACHED_FIGURES):
+        # One worker: the kaleido renderer is a single subprocess
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="chart-export"
+        )
+        self._exports = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_cached_exports = max_cached_exports
+
+    def _render(self, fig, filename, formats):
+        with telemetry.stage("chart_export", filename=filename, formats=",".join(formats)):
+            return render_figure(fig, formats)
+
+    def submit(
+        self, fig, filename: str, formats: Tuple[str, ...] = EXPORT_FORMATS
+    ) -> "Future[Dict[str, bytes]]":
+        """
+        Queue all `formats` of one figure as a single job. The future's result maps each
+        rendered format to its bytes.
+        """
+        key = (hashlib.sha256(fig.to_json().encode("utf-8")).hexdigest(), tuple(formats))
+        with self._lock:
+            future = self._exports.get(key)
+            if future is not None and not (future.done() and future.exception()):
+                self._exports.move_to_end(key)
+                return future
+            # Run in the caller's context, so the export's events belong to its run
+            future = self._executor.submit(
+                contextvars.copy_context().run, self._render, fig, filename, tuple(formats)
+            )
+            self._exports[key] = future
+            while len(self._exports) > self.max_cached_exports:
+                self._exports.popitem(last=False)
+        return future
+
+
+chart_exporter = ChartExporter()
+
+
+def export_visualization(
+    fig, filename: str, formats: Tuple[str, ...] = ("png",), directory="visualizations"
+):
+    """
+    Write `fig` to `directory` in each of `formats`; returns the written paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for fmt, data in chart_exporter.submit(fig, filename, formats).result().items():
+        path = os.path.join(directory, f"{filename}.{fmt}")
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
@@ -0,0 +1,116 @@
+import glob
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from report_index import ReportIndex
+
+# Only these columns are kept in memory (missing ones are simply skipped)
+DEFAULT_COLUMNS = ["ID", "title", "text", "substance", "age", "sex", "exp_year"]
+
+
+class DatasetInfo(NamedTuple):
+    key: str
+    path: str
+    size: int
+    mtime: float
+
+
+def dataset_key(csv_file: str, root: str) -> str:
+    """
+    `<substance>_<file name>`, where the substance is the directory directly under `root`.
+    """
+    relative = os.path.relpath(csv_file, root)
+    substance = relative.split(os.sep)[0]
+    return f"{substance}_{os.path.splitext(os.path.basename(csv_file))[0]}"
+
+
+class DatasetCatalog:
+    """
+    Index of the report CSVs under `root`. Startup only stats the files; a dataset is read on
+    first use, converted once to a Parquet cache holding just `columns`, and kept in an LRU
+    whose total in-memory size stays under `max_memory_bytes`.
+    """
+
+    def __init__(
+        self,
+        root: str = "raw_experiences",
+        cache_dir: str = "cache/datasets",
+        columns: Optional[List[str]] = None,
+        max_memory_bytes: int = 512 * 1024 * 1024,
+    ):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.columns = columns or DEFAULT_COLUMNS
+        self.max_memory_bytes = max_memory_bytes
+        self._loaded = OrderedDict()  # key -> (DataFrame, size in bytes)
+        self._indexes: Dict[str, ReportIndex] = {}
+        self._lock = threading.Lock()
+        self.datasets: Dict[str, DatasetInfo] = {}
+        self.scan()
+
+    def scan(self):
+        # CSVs as scraped, plus Parquet corpora written by report_parser
+        datasets = {}
+        for pattern in ("**/*.csv", "**/*.parquet"):
+            for data_file in sorted(
+                glob.glob(os.path.join(self.root, pattern), recursive=True)
+            ):
+                stat = os.stat(data_file)
+                key = dataset_key(data_file, self.root)
+                datasets[key] = DatasetInfo(key, data_file, stat.st_size, stat.st_mtime)
+        self.datasets = datasets
+        return datasets
+
+    def keys(self) -> List[str]:
+        return list(self.datasets.keys())
+
+    def _parquet_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _read(self, info: DatasetInfo) -> pd.DataFrame:
+        if info.path.endswith(".parquet"):
+            available = pq.read_schema(info.path).names
+            return pd.read_parquet(
+                info.path, columns=[c for c in self.columns if c in available]
+            )
+        parquet_path = self._parquet_path(info.key)
+        if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= info.mtime:
+            return pd.read_parquet(parquet_path)
+        df = pd.read_csv(info.path, usecols=lambda column: column in self.columns)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        df.to_parquet(parquet_path, index=False)
+        return df
+
+    def load(self, key: str) -> pd.DataFrame:
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return self._loaded[key][0]
+            df = self._read(self.datasets[key])
+            self._loaded[key] = (df, int(df.memory_usage(deep=True).sum()))
+            self._evict()
+            return df
+
+    def report_index(self, key: str) -> ReportIndex:
+        """
+        Key -> report lookup for a dataset, built once per load.
+        """
+        df = self.load(key)
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = ReportIndex.from_dataframe(df)
+            return self._indexes[key]
+
+    def _evict(self):
+        # The most recently loaded dataset is always kept, even if it alone is over the cap
+        while len(self._loaded) > 1 and self.memory_usage() > self.max_memory_bytes:
+            evicted, _ = self._loaded.popitem(last=False)
+            self._indexes.pop(evicted, None)
+
+    def memory_usage(self) -> int:
+        return sum(size for _, size in self._loaded.values())
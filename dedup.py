@@ -0,0 +1,194 @@
+import os
+import re
+import threading
+import zlib
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# a * x stays below 2**62 for a, x < 2**31 - 1, so uint64 arithmetic never overflows
+MERSENNE_PRIME = (1 << 31) - 1
+WORD = re.compile(r"\w+")
+
+
+def shingles(text: str, k: int = 5) -> np.ndarray:
+    """
+    Hashed word k-shingles of a report (lower-cased, punctuation ignored).
+    """
+    words = WORD.findall((text or "").lower())
+    if len(words) < k:
+        grams = [" ".join(words)] if words else [""]
+    else:
+        grams = [" ".join(words[i : i + k]) for i in range(len(words) - k + 1)]
+    return np.unique(
+        np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64)
+    )
+
+
+@lru_cache(maxsize=None)
+def lsh_parameters(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    (bands, rows) whose S-curve midpoint (1/bands)^(1/rows) is closest to `threshold`.
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1.0 / bands) ** (1.0 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class DedupIndex:
+    """
+    MinHash/LSH index of report texts for spotting reposted or cross-listed reports.
+    Reports are added incrementally; query() returns keys whose estimated Jaccard
+    similarity to a text is at least `threshold` (or the threshold it is given). The
+    signatures don't depend on the threshold, so one saved index serves every threshold;
+    the LSH bands for each threshold are built from them on first use.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.keys: List[str] = []
+        self.signatures: Dict[str, np.ndarray] = {}
+        # (bands, rows) -> one bucket dict per band
+        self._tables: Dict[Tuple[int, int], List[defaultdict]] = {}
+        self._lock = threading.Lock()
+        # Number of analyses copied from near-duplicates instead of calling the API
+        self.reused_analyses = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingles(text) % np.uint64(MERSENNE_PRIME)
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % np.uint64(
+            MERSENNE_PRIME
+        )
+        return permuted.min(axis=1).astype(np.uint32)
+
+    @staticmethod
+    def _band_keys(signature: np.ndarray, bands: int, rows: int):
+        for band in range(bands):
+            yield band, signature[band * rows : (band + 1) * rows].tobytes()
+
+    def _table(self, threshold: float) -> Tuple[int, int, List[defaultdict]]:
+        # Called with the lock held
+        bands, rows = lsh_parameters(threshold, self.num_perm)
+        table = self._tables.get((bands, rows))
+        if table is None:
+            table = self._tables[(bands, rows)] = [defaultdict(list) for _ in range(bands)]
+            for key in self.keys:
+                for band, band_key in self._band_keys(self.signatures[key], bands, rows):
+                    table[band][band_key].append(key)
+        return bands, rows, table
+
+    def add(self, key: str, text: Optional[str] = None, signature=None):
+        signature = self.signature(text) if signature is None else signature
+        with self._lock:
+            if key in self.signatures:
+                return
+            self.keys.append(key)
+            self.signatures[key] = signature
+            for (bands, rows), table in self._tables.items():
+                for band, band_key in self._band_keys(signature, bands, rows):
+                    table[band][band_key].append(key)
+
+    def query(
+        self, text: Optional[str] = None, signature=None, threshold: Optional[float] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Near-duplicates as (key, estimated similarity), most similar first.
+        """
+        signature = self.signature(text) if signature is None else signature
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            bands, rows, table = self._table(threshold)
+            candidates = set()
+            for band, band_key in self._band_keys(signature, bands, rows):
+                candidates.update(table[band].get(band_key, ()))
+            matches = []
+            for key in candidates:
+                similarity = float(np.mean(self.signatures[key] == signature))
+                if similarity >= threshold:
+                    matches.append((key, similarity))
+        return sorted(matches, key=lambda match: -match[1])
+
+    def __contains__(self, key):
+        return key in self.signatures
+
+    def __len__(self):
+        return len(self.keys)
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            signatures = (
+                np.stack([self.signatures[key] for key in self.keys])
+                if self.keys
+                else np.zeros((0, self.num_perm), dtype=np.uint32)
+            )
+            np.savez_compressed(
+                path,
+                keys=np.array(self.keys, dtype=object),
+                signatures=signatures,
+                params=np.array([self.threshold, self.num_perm, self.seed]),
+            )
+
+    @classmethod
+    def load(cls, path: str, threshold: Optional[float] = None) -> "DedupIndex":
+        """
+        Load a saved index, or start an empty one if `path` does not exist yet.
+        """
+        if not os.path.exists(path):
+            return cls(threshold=threshold or 0.8)
+        data = np.load(path, allow_pickle=True)
+        saved_threshold, num_perm, seed = data["params"]
+        index = cls(
+            threshold=threshold or float(saved_threshold),
+            num_perm=int(num_perm),
+            seed=int(seed),
+        )
+        for key, signature in zip(data["keys"], data["signatures"]):
+            index.add(str(key), signature=signature)
+        return index
+
+
+def plan_reuse(index: DedupIndex, keys, texts, has_analysis, threshold=None):
+    """
+    Decide which reports need an LLM analysis. Returns (signatures, reuse) where reuse maps
+    a report key to the key whose analysis it can copy: an already analyzed near-duplicate
+    from `index` (when `has_analysis(key)` is true), or an earlier report of this batch.
+    `threshold` defaults to the index's.
+    """
+    threshold = index.threshold if threshold is None else threshold
+    batch = DedupIndex(threshold=threshold, num_perm=index.num_perm, seed=index.seed)
+    signatures, reuse = {}, {}
+    for key, text in zip(keys, texts):
+        signature = index.signature(text)
+        signatures[key] = signature
+        source = next(
+            (
+                match
+                for match, _ in index.query(signature=signature, threshold=threshold)
+                if match != key and has_analysis(match)
+            ),
+            None,
+        )
+        if source is None:
+            source = next(
+                (match for match, _ in batch.query(signature=signature) if match != key),
+                None,
+            )
+        if source is not None:
+            reuse[key] = source
+        else:
+            batch.add(key, signature=signature)
+    return signatures, reuse
@@ -0,0 +1,507 @@
+import contextlib
+import contextvars
+import math
+import os
+import sys
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, List, Optional
+
+from tenacity import Retrying, retry_if_exception, stop_after_attempt
+from tenacity.wait import wait_base, wait_random_exponential
+
+from llm_cache import ResponseCache, cache_key
+from telemetry import telemetry
+
+try:
+    import tiktoken
+except ImportError:  # optional: exact token counts
+    tiktoken = None
+
+DEFAULT_MODEL = "gpt-3.5-turbo-1106"
+# Attempts per LLM call (1 + retries) and the jittered exponential backoff between them
+DEFAULT_MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class AnalysisCancelled(Exception):
+    """
+    Raised by LLM calls made, or about to retry, after their run was cancelled.
+    """
+
+
+# Cancellation event of the run the current context's LLM calls belong to
+_cancel_event: contextvars.ContextVar = contextvars.ContextVar("cancel_event", default=None)
+
+
+@contextlib.contextmanager
+def cancellable(event: threading.Event):
+    """
+    Make LLM calls in this block (and in contexts copied from it) raise AnalysisCancelled
+    instead of sending, waiting for the budget or backing off once `event` is set.
+    """
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+def check_cancelled():
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise AnalysisCancelled()
+
+
+def _sleep_unless_cancelled(seconds: float):
+    event = _cancel_event.get()
+    if event is None:
+        time.sleep(seconds)
+    elif event.wait(seconds):
+        raise AnalysisCancelled()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate (roughly four characters per token for English text).
+    """
+    return max(1, len(text) // 4)
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """
+    Exact token count when tiktoken is installed, else estimate_tokens.
+    """
+    if tiktoken is None:
+        return estimate_tokens(text)
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(text))
+
+
+def split_into_chunks(
+    text: str,
+    max_tokens: int,
+    overlap_tokens: int = 200,
+    model: str = DEFAULT_MODEL,
+    total_tokens: Optional[int] = None,
+) -> List[str]:
+    """
+    Split text into word-aligned chunks of at most ~`max_tokens` tokens, each repeating
+    the last ~`overlap_tokens` tokens of the previous one so no passage loses its context.
+    Pass `total_tokens` when the text was already counted.
+    """
+    words = text.split()
+    if total_tokens is None:
+        total_tokens = count_tokens(text, model)
+    if total_tokens <= max_tokens or not words:
+        return [text]
+    tokens_per_word = total_tokens / len(words)
+    window = max(1, int(max_tokens / tokens_per_word))
+    overlap = min(window - 1, int(overlap_tokens / tokens_per_word))
+    step = window - overlap
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start : start + window]))
+        if start + window >= len(words):
+            break
+    return chunks
+
+
+class RateBudget:
+    """
+    Sliding one-minute window of request and token spend, shared by all worker threads.
+    A limit of None means that dimension is unlimited.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        window: float = 60.0,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._events = deque()  # (timestamp, tokens) for every request in the window
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        with self._lock:
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+
+    def _expire(self, now):
+        while self._events and now - self._events[0][0] >= self.window:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def _wait_time(self, now, tokens):
+        if not self._events:
+            # Always let a request through on an empty window, even if it alone exceeds the token limit
+            return 0.0
+        over_requests = (
+            self.requests_per_minute is not None
+            and len(self._events) >= self.requests_per_minute
+        )
+        over_tokens = (
+            self.tokens_per_minute is not None
+            and self._tokens_in_window + tokens > self.tokens_per_minute
+        )
+        if not (over_requests or over_tokens):
+            return 0.0
+        return self._events[0][0] + self.window - now
+
+    def acquire(self, tokens: int = 0):
+        """
+        Block until a request costing `tokens` fits in the budget, then record it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+            _sleep_unless_cancelled(wait)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Transient API failures: rate limits, timeouts, connection errors and 5xx/408/409.
+    """
+    # An openai error can only exist once the (slow to import) package has been loaded
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return False
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code in (408, 409)
+    return False
+
+
+def _is_rate_limited(error: BaseException) -> bool:
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.RateLimitError)
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    The server's requested wait (Retry-After / retry-after-ms headers), if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class wait_retry_after_or_backoff(wait_base):
+    """
+    tenacity wait: the server's Retry-After when given, else full-jitter exponential backoff.
+    """
+
+    def __init__(self, base: float = BACKOFF_BASE, maximum: float = BACKOFF_MAX):
+        self.maximum = maximum
+        self.backoff = wait_random_exponential(multiplier=base, max=maximum)
+
+    def __call__(self, retry_state) -> float:
+        retry_after = retry_after_seconds(retry_state.outcome.exception())
+        if retry_after is not None:
+            return min(self.maximum, retry_after)
+        return self.backoff(retry_state)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Caps the number of LLM requests in flight and adapts the cap to the API (AIMD):
+    every `limit` successful requests raise it by one, up to `maximum`; a 429 halves it,
+    at most once per `cooldown` seconds so a burst of 429s from requests that were
+    already in flight only counts once.
+    """
+
+    def __init__(
+        self,
+        maximum: int = 8,
+        minimum: int = 1,
+        decrease_factor: float = 0.5,
+        cooldown: float = 5.0,
+    ):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.limit = maximum
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._successes = 0
+        self._last_decrease = -math.inf
+        self._condition = threading.Condition()
+
+    def configure(self, maximum: int):
+        with self._condition:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, self.maximum) if self.rate_limited else self.maximum
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self._successes = 0
+                self.limit += 1
+                self._condition.notify()
+
+    def on_rate_limited(self):
+        with self._condition:
+            self.rate_limited += 1
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            self.limit = max(self.minimum, math.floor(self.limit * self.decrease_factor))
+
+
+class UsageTracker:
+    """
+    Thread-safe running totals of requests and tokens reported by the API.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, usage):
+        with self._lock:
+            self.requests += 1
+            if usage is not None:
+                self.prompt_tokens += usage.prompt_tokens or 0
+                self.completion_tokens += usage.completion_tokens or 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+usage_tracker = UsageTracker()
+
+
+# OpenAI clients are pooled by settings, so threads and app sessions using the same key
+# and endpoint share one client and its connection pool
+_clients = {}
+_clients_lock = threading.Lock()
+_dotenv_loaded = False
+
+
+def _default_api_key() -> Optional[str]:
+    # .env is only read once a client needs the key
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        import dotenv
+
+        dotenv.load_dotenv()
+        _dotenv_loaded = True
+    return os.getenv("OPENAI_API_KEY")
+
+
+def get_openai_client(
+    api_key: Optional[str] = None, base_url: Optional[str] = None, **client_options
+):
+    """
+    Shared OpenAI client for these settings, created on first use; the openai package is
+    only imported then. `api_key` defaults to OPENAI_API_KEY, from the environment or
+    a .env file. Retries are off by default because chat_completion handles them (and
+    adapts concurrency on 429s).
+    """
+    api_key = api_key or _default_api_key()
+    client_options.setdefault("max_retries", 0)
+    key = (api_key, base_url, tuple(sorted(client_options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import OpenAI
+
+            client = _clients[key] = OpenAI(
+                api_key=api_key, base_url=base_url, **client_options
+            )
+    return client
+
+
+# Extra trackers (e.g. one per report) that calls in the current context also report to
+_context_trackers: contextvars.ContextVar = contextvars.ContextVar(
+    "context_trackers", default=()
+)
+
+
+@contextlib.contextmanager
+def track_usage():
+    """
+    Collect the usage of every API call made inside the block, including calls made by
+    worker threads started with contextvars.copy_context().run.
+    """
+    tracker = UsageTracker()
+    token = _context_trackers.set(_context_trackers.get() + (tracker,))
+    try:
+        yield tracker
+    finally:
+        _context_trackers.reset(token)
+
+
+def _is_valid(content: str, validate) -> bool:
+    if validate is None:
+        return True
+    try:
+        validate(content)
+    except Exception:
+        return False
+    return True
+
+
+def chat_completion(
+    client,
+    prompt: str,
+    json_mode: bool = False,
+    model: str = DEFAULT_MODEL,
+    budget: Optional[RateBudget] = None,
+    cache: Optional[ResponseCache] = None,
+    stage: str = "llm",
+    limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    validate: Optional[Callable[[str], Any]] = None,
+) -> str:
+    """
+    Send a single user message to the chat completions API and return the reply text.
+    Identical requests are answered from `cache` without touching the API or the budget.
+    Transient failures (see is_retryable) are retried up to `max_attempts` times in total,
+    waiting for Retry-After or a jittered exponential backoff; 429s also shrink `limiter`.
+    Every call is recorded in telemetry under `stage`. Calls stop (AnalysisCancelled)
+    before sending or retrying once the surrounding `cancellable` event is set.
+    `client` may also be a zero-argument factory, only called once a request actually
+    has to go to the API. Replies that `validate` rejects (raises on) are never cached:
+    a fresh one is raised to the caller, a cached one is evicted and requested again.
+    """
+    check_cancelled()
+    start = time.perf_counter()
+    key = None
+    if cache is not None and cache.enabled:
+        key = cache_key(model, prompt, json_mode)
+        cached = cache.get(key)
+        if cached is not None and _is_valid(cached, validate):
+            telemetry.record_call(stage, time.perf_counter() - start, cache_hit=True)
+            return cached
+        if cached is not None:
+            cache.delete(key)
+    kwargs = {}
+    if json_mode:
+        kwargs["response_format"] = {"type": "json_object"}
+    queue_wait = 0.0
+    attempts = 0
+
+    def resolve_client():
+        return client if hasattr(client, "chat") else client()
+
+    def attempt():
+        nonlocal queue_wait, attempts
+        wait_start = time.perf_counter()
+        with limiter.slot() if limiter is not None else contextlib.nullcontext():
+            if budget is not None:
+                budget.acquire(estimate_tokens(prompt))
+            queue_wait += time.perf_counter() - wait_start
+            check_cancelled()
+            attempts += 1
+            try:
+                response = resolve_client().chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    **kwargs,
+                )
+            except Exception as error:
+                if not _is_rate_limited(error):
+                    raise
+                if limiter is not None:
+                    limiter.on_rate_limited()
+                raise
+        if limiter is not None:
+            limiter.on_success()
+        return response
+
+    retrying = Retrying(
+        stop=stop_after_attempt(max_attempts),
+        wait=wait_retry_after_or_backoff(),
+        retry=retry_if_exception(is_retryable),
+        reraise=True,
+        sleep=_sleep_unless_cancelled,
+    )
+    try:
+        response = retrying(attempt)
+    except Exception as e:
+        telemetry.record_call(
+            stage,
+            time.perf_counter() - start,
+            queue_wait_seconds=queue_wait,
+            retries=max(0, attempts - 1),
+            error=repr(e),
+        )
+        raise
+    usage = getattr(response, "usage", None)
+    usage_tracker.record(usage)
+    for tracker in _context_trackers.get():
+        tracker.record(usage)
+    telemetry.record_call(
+        stage,
+        time.perf_counter() - start,
+        queue_wait_seconds=queue_wait,
+        prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+        retries=max(0, attempts - 1),
+    )
+    content = response.choices[0].message.content
+    if validate is not None:
+        validate(content)
+    if key is not None and content is not None:
+        cache.put(key, model, content)
+    return content
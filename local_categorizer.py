@@ -0,0 +1,121 @@
+import math
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from text_utils import count_unique_items
+
+
+def char_ngram_vectors(items, ngram_range=(2, 4), n_features=1024) -> np.ndarray:
+    """
+    TF-IDF weighted, L2-normalized hashed character n-gram vectors, one row per item.
+    crc32 is used for hashing so vectors are identical across processes.
+    """
+    rows, columns = [], []
+    for row, item in enumerate(items):
+        padded = f" {item} ".encode("utf-8")
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            for start in range(len(padded) - n + 1):
+                rows.append(row)
+                columns.append(zlib.crc32(padded[start : start + n]))
+    flat_index = np.array(rows, dtype=np.int64) * n_features + (
+        np.array(columns, dtype=np.int64) % n_features
+    )
+    counts = (
+        np.bincount(flat_index, minlength=len(items) * n_features)
+        .reshape(len(items), n_features)
+        .astype(np.float32)
+    )
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1.0 + len(items)) / (1.0 + document_frequency)) + 1.0
+    vectors = counts * idf.astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, seed=0, n_iter=50):
+    """
+    k-means on the unit sphere (cosine similarity) with k-means++ seeding.
+    Returns (labels, centroids).
+    """
+    rng = np.random.default_rng(seed)
+    n_items = vectors.shape[0]
+    centroids = [vectors[rng.integers(n_items)]]
+    best_similarity = vectors @ centroids[0]
+    for _ in range(1, n_clusters):
+        distance = np.clip(1.0 - best_similarity, 0.0, None)
+        total = distance.sum()
+        if total == 0:
+            break
+        centroids.append(vectors[rng.choice(n_items, p=distance / total)])
+        best_similarity = np.maximum(best_similarity, vectors @ centroids[-1])
+    centroids = np.stack(centroids)
+
+    labels = np.full(n_items, -1)
+    for _ in range(n_iter):
+        new_labels = np.argmax(vectors @ centroids.T, axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        sums = np.eye(centroids.shape[0], dtype=vectors.dtype)[labels].T @ vectors
+        norms = np.linalg.norm(sums, axis=1)
+        # Empty clusters keep their previous centroid
+        non_empty = norms > 0
+        centroids[non_empty] = sums[non_empty] / norms[non_empty, None]
+    return labels, centroids
+
+
+def default_n_clusters(n_unique: int) -> int:
+    return max(1, min(12, n_unique, round(math.sqrt(n_unique / 2))))
+
+
+def categorize_locally(
+    items, n_clusters: Optional[int] = None, seed=0
+) -> Dict[str, List[str]]:
+    """
+    Zero-API replacement for find_broad_categories + map_individual_to_broad_categories.
+    Unique items are clustered and each cluster is named after its most representative
+    item. Like the LLM mapping, every original occurrence is listed under its category,
+    so the result can go straight into aggregate_mapping_counts.
+    """
+    unique = list(count_unique_items(items).values())
+    if not unique:
+        return {}
+    names = [entry["item"] for entry in unique]
+    weights = np.array([entry["count"] for entry in unique], dtype=np.float32)
+    vectors = char_ngram_vectors([name.lower() for name in names])
+    n_clusters = n_clusters or default_n_clusters(len(unique))
+    labels, centroids = spherical_kmeans(vectors, min(n_clusters, len(unique)), seed=seed)
+
+    mapping = {}
+    for cluster in np.unique(labels):
+        members = np.flatnonzero(labels == cluster)
+        # Weight closeness to the centroid by how often the item was mentioned
+        scores = (vectors[members] @ centroids[cluster]) * np.log1p(weights[members])
+        label = names[members[np.argmax(scores)]]
+        mapping[label] = [
+            names[member] for member in members for _ in range(unique[member]["count"])
+        ]
+    return mapping
+
+
+def assign_locally(items, categories: List[str]) -> Dict[str, List[str]]:
+    """
+    Map items onto existing categories by nearest category name, in the same
+    {category: [every occurrence]} shape as categorize_locally.
+    """
+    unique = list(count_unique_items(items).values())
+    if not unique or not categories:
+        return {}
+    names = [entry["item"] for entry in unique]
+    vectors = char_ngram_vectors([name.lower() for name in names + list(categories)])
+    item_vectors, category_vectors = vectors[: len(names)], vectors[len(names) :]
+    nearest = np.argmax(item_vectors @ category_vectors.T, axis=1)
+    mapping = {}
+    for entry, category in zip(unique, nearest):
+        mapping.setdefault(categories[category], []).extend(
+            [entry["item"]] * entry["count"]
+        )
+    return mapping
@@ -1,64 +1,451 @@
 import streamlit as st
-import openai
 import pandas as pd
-import json
-import glob
 import os
-import plotly.express as px
+import threading
+import time
+from collections import Counter
 from analysis_pipeline import (
-    analyze_themes,
-    extract_data_to_json,
-    run_analysis,
-    AnalysisResultJSON,
-    run_analysis_and_categorize,
+    ANALYSIS_MODES,
+    CATEGORIZERS,
+    iter_analysis,
+    response_cache,
+    results_store,
+    use_client,
 )
+from analytics import GROUPS, KINDS, AnalysisFrame
+from aggregation import IncrementalAggregator
+from dataset_catalog import DatasetCatalog
+from dedup import DedupIndex
+from search_index import SearchIndex
+from telemetry import telemetry
+from text_utils import normalize_item
 from data_utils import (
-    aggregate_data,
     create_theme_pie_chart,
     create_emotion_bar_chart,
-    export_visualization,
+    create_heatmap,
+    chart_exporter,
+    EXPORT_MIME_TYPES,
 )
 
-# Import other necessary libraries
+
+@st.cache_resource
+def load_catalog():
+    # Only file metadata is read here; datasets are loaded on first selection
+    return DatasetCatalog(root="raw_experiences")
+
+
+DEDUP_INDEX_PATH = "cache/dedup_index.npz"
+SEARCH_INDEX_PATH = "cache/search_index.sqlite3"
+# Search results offered for selection, best matches first
+MAX_SEARCH_HITS = 500
+AGE_RANGE = (0, 100)
+
+
+@st.cache_resource
+def load_dedup_index():
+    # One index for every threshold: the threshold is applied when querying it
+    return DedupIndex.load(DEDUP_INDEX_PATH)
+
+
+@st.cache_resource
+def load_search_index():
+    return SearchIndex(SEARCH_INDEX_PATH)
+
+
+def search_reports(search_index, reports, dataset_key):
+    """
+    Search and filter widgets over the dataset's reports; returns the matching keys,
+    best match first.
+    """
+    query = st.text_input(
+        "Search reports",
+        help='All words and "quoted phrases" must match. Use OR between alternatives '
+        "and a trailing * to match word prefixes.",
+    )
+    substance_column, gender_column, age_column = st.columns(3)
+    substance_filter = substance_column.selectbox(
+        "Substance", ["Any"] + search_index.values("substance", dataset_key)
+    )
+    gender_filter = gender_column.selectbox(
+        "Gender", ["Any"] + search_index.values("gender", dataset_key)
+    )
+    min_age, max_age = age_column.slider("Age", *AGE_RANGE, value=AGE_RANGE)
+    try:
+        hits = search_index.search(
+            query,
+            dataset=dataset_key,
+            substance=None if substance_filter == "Any" else substance_filter,
+            gender=None if gender_filter == "Any" else gender_filter,
+            min_age=None if min_age == AGE_RANGE[0] else min_age,
+            max_age=None if max_age == AGE_RANGE[1] else max_age,
+            limit=MAX_SEARCH_HITS,
+        )
+    except ValueError as e:
+        st.warning(str(e))
+        hits = []
+    keys = [hit.key for hit in hits if hit.key in reports]
+    truncated = len(hits) == MAX_SEARCH_HITS
+    st.caption(
+        f"{len(keys)} matching reports"
+        + (f" (showing the best {MAX_SEARCH_HITS})" if truncated else "")
+    )
+    return keys
+
+
+@st.cache_resource(max_entries=1)
+def load_analytics(last_analysis_id):
+    # Rebuilt only when new analyses were stored (the argument is the cache key)
+    return AnalysisFrame.from_store(results_store)
+
+
+ANALYTICS_VIEWS = {
+    "Substance × item": "substance",
+    "Age band × item": "age_band",
+    "Gender × item": "gender",
+    "Dataset × item": "dataset",
+    "Item co-occurrence": None,
+}
+
+
+def show_analytics():
+    """
+    Heatmaps comparing the themes and emotions of every stored analysis across
+    substances, demographics and each other.
+    """
+    st.header("Compare stored analyses")
+    frame = load_analytics(results_store.last_analysis_id())
+    if not len(frame):
+        st.info("No stored analyses yet.")
+        return
+    view = st.selectbox("View", options=list(ANALYTICS_VIEWS))
+    kind = st.radio("Items", options=KINDS, horizontal=True)
+    other_kind = kind
+    if ANALYTICS_VIEWS[view] is None:
+        other_kind = st.radio("Against", options=KINDS, horizontal=True)
+    filter_columns = st.columns(len(GROUPS))
+    filters = {
+        group: column.multiselect(
+            group.replace("_", " ").capitalize(), frame.labels[group]
+        )
+        for group, column in zip(GROUPS, filter_columns)
+    }
+    top = st.slider("Items shown", min_value=5, max_value=50, value=20)
+    share = st.checkbox(
+        "Show shares instead of counts",
+        value=True,
+        help="Fraction of the group's reports (or of the row item's reports) mentioning "
+        "each item, so groups of different sizes can be compared.",
+    )
+    mask = frame.mask(**filters)
+    st.caption(f"{int(mask.sum())} of {len(frame)} analyzed reports selected")
+    if ANALYTICS_VIEWS[view] is None:
+        table = frame.co_occurrence(kind, other_kind, mask=mask, top=top, share=share)
+        title = f"{kind.capitalize()} × {other_kind} co-occurrence"
+    else:
+        by = ANALYTICS_VIEWS[view]
+        table = frame.contingency(kind, by=by, mask=mask, top=top, share=share)
+        title = f"{kind.capitalize()} by {by.replace('_', ' ')}"
+    if table.empty:
+        st.info("Nothing to show for this selection.")
+        return
+    st.plotly_chart(create_heatmap(table, title, share=share), use_container_width=True)
+    with st.expander("Table"):
+        st.dataframe(table)
 
 
 @st.cache_resource
-def load_data():
-    dataframes = {}
-    for csv_file in glob.glob("raw_experiences/**/*.csv", recursive=True):
-        substance = csv_file.split(os.sep)[
-            1
-        ]  # Assuming the substance name is the directory name
-        key = f"{substance}_{os.path.splitext(os.path.basename(csv_file))[0]}"
-        dataframes[key] = pd.read_csv(csv_file)
-    return dataframes
+def start_metrics_server(port):
+    # Prometheus scrape endpoint (/metrics), started once per Streamlit server
+    return telemetry.serve_prometheus(port=port)
+
+
+# Seconds between redraws of the live results while reports are being analyzed
+PROGRESS_REFRESH_SECONDS = 1.0
+PROVISIONAL_TOP_N = 15
+
+
+def _report_row(event, reports):
+    result = event["result"] or {}
+    return {
+        "report": reports.title(event["key"]),
+        "status": (
+            "failed" if not result else "reused" if event["reused"] else "analyzed"
+        ),
+        "substance": result.get("substance"),
+        "themes": ", ".join(result.get("themes", [])),
+        "emotions": ", ".join(result.get("emotions", [])),
+    }
+
+
+def _provisional_chart(counts, title):
+    # Raw (uncategorized) counts; the categorized charts replace these at the end
+    import plotly.express as px
+
+    top = counts.most_common(PROVISIONAL_TOP_N)
+    return px.bar(
+        x=[count for _, count in top],
+        y=[item for item, _ in top],
+        orientation="h",
+        title=title,
+        labels={"x": "Reports", "y": ""},
+    )
+
+
+def show_downloads(container, exports):
+    """
+    Fill `container` with a download button per rendered chart format, waiting for the
+    background exports to finish.
+    """
+    with container:
+        for name, future in exports.items():
+            columns = st.columns(len(EXPORT_MIME_TYPES))
+            for column, (fmt, data) in zip(columns, future.result().items()):
+                column.download_button(
+                    f"{name.replace('_', ' ').capitalize()} ({fmt.upper()})",
+                    data=data,
+                    file_name=f"{name}.{fmt}",
+                    mime=EXPORT_MIME_TYPES[fmt],
+                    key=f"download-{name}-{fmt}",
+                )
+
+
+class AnalysisRun:
+    """
+    An iter_analysis run in a worker thread. It lives in st.session_state, so it keeps
+    going through the reruns Streamlit does on every click, Cancel included, and each
+    rerun just shows its progress (see show_analysis_run).
+    """
+
+    def __init__(self, reports, selected_keys, api_key=None, **options):
+        self.reports = reports
+        self.cancel_event = threading.Event()
+        self.rows = []
+        self.theme_counts, self.emotion_counts = Counter(), Counter()
+        self.done, self.total = 0, len(selected_keys)
+        self.categorizing = False
+        self.outcome = None
+        self.error = None
+        self.dedup_index = options.get("dedup_index")
+        self.use_cache = options.get("use_cache", True)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(selected_keys, api_key, options),
+            name="analysis-run",
+            daemon=True,
+        )
+
+    def start(self) -> "AnalysisRun":
+        self._thread.start()
+        return self
+
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self, selected_keys, api_key, options):
+        try:
+            # The typed key applies to this run only; without one, the OPENAI_API_KEY
+            # environment variable (or .env) is used
+            with use_client(api_key=api_key or None):
+                for event in iter_analysis(
+                    self.reports, selected_keys, cancel_event=self.cancel_event, **options
+                ):
+                    self._record(event)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.dedup_index is not None:
+                self.dedup_index.save(DEDUP_INDEX_PATH)
+
+    def _record(self, event):
+        with self._lock:
+            if event["type"] == "report":
+                self.rows.append(_report_row(event, self.reports))
+                if event["result"]:
+                    self.theme_counts.update(
+                        {normalize_item(item) for item in event["result"]["themes"]}
+                    )
+                    self.emotion_counts.update(
+                        {normalize_item(item) for item in event["result"]["emotions"]}
+                    )
+                self.done, self.total = event["done"], event["total"]
+            elif event["type"] == "stage":
+                self.categorizing = True
+            else:
+                self.outcome = event
+
+    def snapshot(self):
+        with self._lock:
+            return (
+                list(self.rows),
+                Counter(self.theme_counts),
+                Counter(self.emotion_counts),
+                self.done,
+                self.total,
+                self.categorizing,
+            )
+
+
+def show_analysis_run(run: AnalysisRun):
+    """
+    Show a progress bar, a row per finished report and provisional theme/emotion counts
+    until `run` finishes, then return its "complete" event (None if it failed).
+    """
+    if run.running():
+        # Clicking reruns the script; the callback fires first and stops the analysis,
+        # and the rerun waits here for it to wind down and shows what was completed
+        st.button(
+            "Cancel analysis", on_click=run.cancel, disabled=run.cancel_event.is_set()
+        )
+        progress = st.progress(0.0, text="Analyzing reports...")
+        rows_placeholder = st.empty()
+        themes_placeholder = st.empty()
+        emotions_placeholder = st.empty()
+        while run.running():
+            rows, theme_counts, emotion_counts, done, total, categorizing = run.snapshot()
+            if categorizing:
+                progress.progress(1.0, text="Categorizing themes and emotions...")
+            else:
+                progress.progress(
+                    done / max(1, total), text=f"Analyzed {done} of {total} reports"
+                )
+            rows_placeholder.dataframe(pd.DataFrame(rows), use_container_width=True)
+            if theme_counts:
+                themes_placeholder.plotly_chart(
+                    _provisional_chart(theme_counts, "Themes so far (uncategorized)")
+                )
+            if emotion_counts:
+                emotions_placeholder.plotly_chart(
+                    _provisional_chart(emotion_counts, "Emotions so far (uncategorized)")
+                )
+            time.sleep(PROGRESS_REFRESH_SECONDS)
+        progress.empty()
+        themes_placeholder.empty()
+        emotions_placeholder.empty()
+    rows = run.snapshot()[0]
+    if rows:
+        st.dataframe(pd.DataFrame(rows), use_container_width=True)
+    if run.error is not None:
+        st.error(f"Analysis failed: {run.error}")
+    return run.outcome
 
 
 def main():
     st.title("Psychedelic Experience Analysis with LLMs")
-    dataframes = load_data()
+    if os.getenv("TELEMETRY_PORT"):
+        start_metrics_server(int(os.getenv("TELEMETRY_PORT")))
+    catalog = load_catalog()
     api_key = st.text_input("Enter your OpenAI API key", type="password")
-    dataset_options = list(dataframes.keys())
+    dataset_options = catalog.keys()
 
     # Select the dataset (now including the substance in its key)
     dataset_key = st.selectbox("Select the dataset", options=dataset_options)
-    df = dataframes[dataset_key]
+    if dataset_key is None:
+        st.error("No datasets found under 'raw_experiences'.")
+        return
+    reports = catalog.report_index(dataset_key)
 
     # Extract the substance from the selected dataset key
     substance = dataset_key.split("_")[0]
 
-    # Report selection
-    report_titles = df["title"].tolist() if "title" in df.columns else []
-    selected_titles = st.multiselect(
-        "Select reports for analysis", options=report_titles
+    # Only datasets whose file changed since they were last indexed are (re)indexed
+    search_index = load_search_index()
+    with st.spinner("Indexing reports for search..."):
+        search_index.update(catalog, [dataset_key])
+    matching_keys = search_reports(search_index, reports, dataset_key)
+
+    # Report selection (options are report keys, displayed with their titles)
+    if st.checkbox("Analyze all matching reports"):
+        selected_keys = matching_keys
+    else:
+        selected_keys = st.multiselect(
+            "Select reports for analysis",
+            options=matching_keys,
+            format_func=reports.label,
+        )
+    max_concurrency = st.number_input(
+        "Max concurrent API requests", min_value=1, max_value=32, value=4
+    )
+    requests_per_minute = st.number_input(
+        "Requests per minute limit (0 = unlimited)", min_value=0, value=0
+    )
+    analysis_mode = st.radio(
+        "Analysis mode",
+        options=ANALYSIS_MODES,
+        help="single_pass extracts JSON in one call per report instead of two.",
     )
+    categorizer = st.radio(
+        "Categorizer",
+        options=CATEGORIZERS,
+        help="local clusters themes and emotions on CPU without any API calls.",
+    )
+    # Applies to this session's runs only
+    use_cache = st.checkbox("Reuse cached LLM responses", value=response_cache.enabled)
+    accumulate = st.checkbox(
+        "Add to previous analyses of this dataset",
+        help="Keeps running counts across runs; only new reports and new themes cost API calls.",
+    )
+    aggregator = None
+    if accumulate:
+        aggregator_key = f"aggregator-{dataset_key}-{categorizer}"
+        if aggregator_key not in st.session_state:
+            st.session_state[aggregator_key] = IncrementalAggregator(
+                categorizer=categorizer
+            )
+        aggregator = st.session_state[aggregator_key]
+    dedup_index, similarity_threshold = None, None
+    if st.checkbox(
+        "Reuse analyses of near-duplicate reports",
+        value=True,
+        help="Reposted or cross-listed reports copy an existing analysis instead of calling the API.",
+    ):
+        similarity_threshold = st.slider(
+            "Near-duplicate similarity threshold", min_value=0.5, max_value=1.0, value=0.8
+        )
+        dedup_index = load_dedup_index()
     if st.button("Analyze Reports"):
+        # One run per session: a run still going is stopped before it is replaced, so it
+        # doesn't keep calling the API for results nobody sees
+        previous_run = st.session_state.get("analysis_run")
+        if previous_run is not None and previous_run.running():
+            with st.spinner("Cancelling the current analysis..."):
+                previous_run.cancel()
+                previous_run.wait()
+        st.session_state["analysis_run"] = AnalysisRun(
+            reports,
+            selected_keys,
+            api_key=api_key,
+            max_concurrency=int(max_concurrency),
+            requests_per_minute=int(requests_per_minute) or None,
+            mode=analysis_mode,
+            categorizer=categorizer,
+            dataset=dataset_key,
+            aggregator=aggregator,
+            dedup_index=dedup_index,
+            dedup_threshold=similarity_threshold,
+            use_cache=use_cache,
+        ).start()
+    run = st.session_state.get("analysis_run")
+    exports = {}
+    if run is not None:
         with st.spinner("Fetching and analyzing reports..."):
-            theme_counts, emotion_counts, _ = run_analysis_and_categorize(
-                df, selected_titles
-            )
+            outcome = show_analysis_run(run)
+        if outcome is not None:
+            theme_counts = outcome["theme_counts"]
+            emotion_counts = outcome["emotion_counts"]
+            if outcome["cancelled"]:
+                analyzed = len(outcome["analysis_results"])
+                st.warning(
+                    f"Analysis cancelled after {analyzed} reports; "
+                    "showing their uncategorized themes and emotions."
+                )
 
-            # Assuming `run_analysis_and_categorize` returns the aggregate counts
             if theme_counts and emotion_counts:
                 # Create visualizations
                 theme_fig = create_theme_pie_chart(theme_counts)
@@ -68,58 +455,43 @@ def main():
                 st.plotly_chart(theme_fig)
                 st.plotly_chart(emotion_fig)
 
-                # Optionally save visualizations
-                # Note: This will save images to the server running Streamlit.
-                # Users will not be able to download them directly from the app without additional steps.
-                export_visualization(theme_fig, "theme_distribution")
-                export_visualization(emotion_fig, "emotion_distribution")
-
-                st.success(
-                    "Visualizations generated. Check the 'visualizations' folder for saved images."
-                )
+                # Rendered to PNG/SVG/HTML in the background; the download buttons appear
+                # below the charts once the files are ready
+                exports = {
+                    "theme_distribution": chart_exporter.submit(
+                        theme_fig, "theme_distribution"
+                    ),
+                    "emotion_distribution": chart_exporter.submit(
+                        emotion_fig, "emotion_distribution"
+                    ),
+                }
+                downloads = st.container()
+                st.success("Visualizations generated.")
             else:
+                exports = {}
                 st.error("No themes or emotions to display.")
-            # if st.button("Analyze Reports"):
-            #     with st.spinner("Fetching and analyzing reports..."):
-            #         analysis_results = []
-
-            #         for title in selected_titles:
-            #             print(f"Analyzing report titled: {title}")
-            #             raw_experience = df[df["title"] == title]["text"].iloc[0]
-            #             themes, substance, emotions, age, gender = run_analysis(
-            #                 raw_experience=raw_experience, output_filename=title
-            #             )
-            #             if themes is not None:
-            #                 analysis_result = {
-            #                     "themes": themes,
-            #                     "substance": substance,
-            #                     "emotions": emotions,
-            #                     "age": age,
-            #                     "gender": gender,
-            #                 }
-            #                 analysis_results.append(analysis_result)
-            #             else:
-            #                 st.error(f"Analysis failed for report titled: {title}")
-
-            #         if analysis_results:
-            #             st.success("Analysis complete! See the visualizations below.")
-
-            #             report_analyses = [
-            #                 AnalysisResultJSON(**result) for result in analysis_results
-            #             ]
-            #             aggregated_data = aggregate_data(report_analyses)
-
-            #             # Create visualizations
-            #             theme_fig = create_theme_pie_chart(aggregated_data["themes"])
-            #             emotion_fig = create_emotion_bar_chart(aggregated_data["emotions"])
-
-            #             # Display visualizations in Streamlit
-            #             st.plotly_chart(theme_fig)
-            #             st.plotly_chart(emotion_fig)
-
-            # Optionally save visualizations
-            export_visualization(theme_fig, "theme_distribution")
-            export_visualization(emotion_fig, "emotion_distribution")
+            if run.dedup_index is not None:
+                st.caption(
+                    f"Near-duplicate reuse: {run.dedup_index.reused_analyses} analyses "
+                    "copied instead of calling the API"
+                )
+            if response_cache.enabled and run.use_cache:
+                cache_stats = response_cache.stats()
+                st.caption(
+                    f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                    f"{cache_stats['entries']} entries stored"
+                )
+
+            with st.expander("Run telemetry"):
+                st.caption(
+                    "Wall time per pipeline stage (nested stages included) and the LLM "
+                    "calls made in it."
+                )
+                st.dataframe(pd.DataFrame(telemetry.summary(outcome["session_id"])))
+        if exports:
+            show_downloads(downloads, exports)
+
+    show_analytics()
 
 
 # Run the Streamlit app
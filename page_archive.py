@@ -0,0 +1,215 @@
+"""
+Compressed, append-only archive of raw report pages.
+
+Usage:
+    python page_archive.py import erowid-exps erowid-archive
+"""
+import argparse
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+SEGMENT_NAME = "pages-{:05d}.gz"
+
+
+def _compress(content: bytes, level: int) -> bytes:
+    # One self-contained gzip member per page, so the segment is also a valid .gz stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(content) + compressor.flush()
+
+
+class PageArchive:
+    """
+    Pages are appended as individual gzip members to segment files of at most
+    `max_segment_bytes`, and a SQLite index maps each ExpID to (segment, offset, length).
+    Bulk writes cost one fsync and one index transaction per batch; random reads are a
+    slice of a memory-mapped segment plus one decompression.
+    """
+
+    def __init__(
+        self,
+        directory: str = "erowid-archive",
+        max_segment_bytes: int = 1024 * 1024 * 1024,
+        compression_level: int = 6,
+    ):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.compression_level = compression_level
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._maps = {}  # segment number -> (file, mmap)
+        self._index = sqlite3.connect(
+            os.path.join(directory, "index.sqlite3"), check_same_thread=False
+        )
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                exp_id TEXT PRIMARY KEY,
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL
+            )
+            """
+        )
+        self._index.commit()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, SEGMENT_NAME.format(segment))
+
+    def _current_segment(self) -> int:
+        row = self._index.execute("SELECT MAX(segment) FROM pages").fetchone()
+        segment = row[0] or 0
+        path = self._segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.max_segment_bytes:
+            segment += 1
+        return segment
+
+    def write_pages(self, pages: Iterable[Tuple[str, bytes]]) -> int:
+        """
+        Append many (exp_id, raw html) pages. Re-written IDs point at their newest copy.
+        """
+        written = 0
+        with self._lock:
+            segment = self._current_segment()
+            handle = open(self._segment_path(segment), "ab")
+            rows = []
+            try:
+                for exp_id, content in pages:
+                    if isinstance(content, str):
+                        content = content.encode("utf-8")
+                    record = _compress(content, self.compression_level)
+                    if handle.tell() and handle.tell() + len(record) > self.max_segment_bytes:
+                        handle.flush()
+                        os.fsync(handle.fileno())
+                        handle.close()
+                        segment += 1
+                        handle = open(self._segment_path(segment), "ab")
+                    offset = handle.tell()
+                    handle.write(record)
+                    rows.append(
+                        (str(exp_id), segment, offset, len(record), len(content), time.time())
+                    )
+                    written += 1
+                handle.flush()
+                os.fsync(handle.fileno())
+            finally:
+                handle.close()
+            # The index only ever points at bytes that are already durable
+            with self._index:
+                self._index.executemany(
+                    "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+        return written
+
+    def put(self, exp_id: str, content: bytes):
+        self.write_pages([(exp_id, content)])
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        entry = self._maps.get(segment)
+        if entry is None or len(entry[1]) < end:
+            if entry is not None:
+                entry[1].close()
+                entry[0].close()
+            handle = open(self._segment_path(segment), "rb")
+            entry = (handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ))
+            self._maps[segment] = entry
+        return entry[1]
+
+    def _read(self, segment: int, offset: int, length: int) -> bytes:
+        with self._lock:
+            mapped = self._map(segment, offset + length)
+            record = mapped[offset : offset + length]
+        return zlib.decompress(record, 31)
+
+    def get(self, exp_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._index.execute(
+                "SELECT segment, offset, length FROM pages WHERE exp_id = ?", (str(exp_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        return self._read(*row)
+
+    def __contains__(self, exp_id) -> bool:
+        with self._lock:
+            row = self._index.execute(
+                "SELECT 1 FROM pages WHERE exp_id = ?", (str(exp_id),)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._index.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            rows = self._index.execute("SELECT exp_id FROM pages").fetchall()
+        return [exp_id for (exp_id,) in rows]
+
+    def iter_pages(self) -> Iterator[Tuple[str, bytes]]:
+        """
+        Stream every page in on-disk order, which keeps reads sequential.
+        """
+        with self._lock:
+            rows = self._index.execute(
+                "SELECT exp_id, segment, offset, length FROM pages ORDER BY segment, offset"
+            ).fetchall()
+        for exp_id, segment, offset, length in rows:
+            yield exp_id, self._read(segment, offset, length)
+
+    def import_directory(self, directory: str, batch_size: int = 1000) -> int:
+        """
+        Bulk-import one-file-per-page directories (e.g. the notebook's erowid-exps/),
+        using each file name as the ExpID.
+        """
+
+        def pages():
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and name not in self:
+                    with open(path, "rb") as f:
+                        yield name, f.read()
+
+        imported = 0
+        batch = []
+        for page in pages():
+            batch.append(page)
+            if len(batch) == batch_size:
+                imported += self.write_pages(batch)
+                batch = []
+        if batch:
+            imported += self.write_pages(batch)
+        return imported
+
+    def close(self):
+        with self._lock:
+            for handle, mapped in self._maps.values():
+                mapped.close()
+                handle.close()
+            self._maps = {}
+            self._index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Import a one-file-per-page directory")
+    import_parser.add_argument("source")
+    import_parser.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        archive = PageArchive(args.archive)
+        print(f"Imported {archive.import_directory(args.source)} pages into {args.archive}")
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
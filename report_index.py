@@ -0,0 +1,65 @@
+import hashlib
+from typing import Dict, List
+
+import pandas as pd
+
+
+def report_key(row) -> str:
+    """
+    Stable identifier of a report row: the Erowid ExpID when present, else a content hash.
+    """
+    report_id = row.get("ID")
+    if report_id is not None and not pd.isna(report_id):
+        if isinstance(report_id, float) and report_id.is_integer():
+            report_id = int(report_id)
+        return str(report_id).strip()
+    digest = hashlib.sha1(f"{row.get('title')}\n{row.get('text')}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ReportIndex:
+    """
+    Hash index from report key to title and text for one dataset, built once so that
+    looking up M selected reports is O(M) instead of one DataFrame scan per report.
+    Rows sharing a key get a "-2", "-3", ... suffix so every report stays addressable.
+    """
+
+    def __init__(self, keys: List[str], titles: List[str], texts: List[str]):
+        self._keys = keys
+        self._titles = dict(zip(keys, titles))
+        self._texts = dict(zip(keys, texts))
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "ReportIndex":
+        keys, titles, texts = [], [], []
+        seen: Dict[str, int] = {}
+        for row in df.to_dict("records"):
+            key = report_key(row)
+            seen[key] = seen.get(key, 0) + 1
+            if seen[key] > 1:
+                key = f"{key}-{seen[key]}"
+            keys.append(key)
+            titles.append(row.get("title") if isinstance(row.get("title"), str) else key)
+            texts.append(row.get("text"))
+        return cls(keys, titles, texts)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._texts
+
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def title(self, key: str) -> str:
+        return self._titles[key]
+
+    def text(self, key: str) -> str:
+        return self._texts[key]
+
+    def label(self, key: str) -> str:
+        """
+        Display name for selection widgets, unambiguous even when titles collide.
+        """
+        return f"{self._titles[key]} (#{key})"
@@ -0,0 +1,195 @@
+"""
+Parse saved Erowid report pages into a typed Parquet corpus for the app.
+
+Usage:
+    python report_parser.py erowid-archive raw_experiences/all/reports.parquet --workers 8
+"""
+import argparse
+import os
+import re
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+import dateutil.parser
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lxml import html as lxml_html
+
+from page_archive import PageArchive
+
+SCHEMA = pa.schema(
+    [
+        ("ID", pa.int64()),
+        ("title", pa.string()),
+        ("substance", pa.string()),
+        ("substances", pa.list_(pa.string())),
+        ("method", pa.list_(pa.string())),
+        ("amount", pa.list_(pa.string())),
+        ("form", pa.list_(pa.string())),
+        ("body_weight", pa.string()),
+        ("exp_year", pa.int32()),
+        ("age", pa.int32()),
+        ("sex", pa.string()),
+        ("published", pa.timestamp("s")),
+        ("text", pa.string()),
+    ]
+)
+
+# class attribute -> list field, as in the notebook's find_class_attr calls
+CLASS_FIELDS = {
+    ("div", "title"): "title",
+    ("div", "substance"): "substance",
+    ("td", "dosechart-substance"): "substances",
+    ("td", "dosechart-method"): "method",
+    ("td", "dosechart-amount"): "amount",
+    ("td", "dosechart-form"): "form",
+    ("td", "bodyweight-amount"): "body_weight",
+}
+# "<label>: <value>" cells, as in the notebook's find_text_in_td calls
+LABEL_FIELDS = {
+    "ExpID": "ID",
+    "Exp Year": "exp_year",
+    "Age at time of experience": "age",
+    "Gender": "sex",
+    "Published": "published",
+}
+LABEL_PATTERN = re.compile(r"^\s*(%s)\s*:" % "|".join(map(re.escape, LABEL_FIELDS)))
+DIGITS = re.compile(r"\d+")
+
+
+def _first_int(value: Optional[str]) -> Optional[int]:
+    match = DIGITS.search(value or "")
+    return int(match.group()) if match else None
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return dateutil.parser.parse(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _report_text(element) -> str:
+    # Same heuristic as the notebook's get_text: the longest block is the report body
+    text_parts = element.text_content().split("\n\n\n\n\n")
+    text_body = max(text_parts, key=len)
+    return text_body.replace("\n", "").replace("\t", "")
+
+
+def parse_page(content: bytes) -> Dict[str, Any]:
+    """
+    Extract every get_content field from one page in a single pass over its elements.
+    """
+    root = lxml_html.fromstring(content)
+    lists = {field: [] for field in CLASS_FIELDS.values()}
+    labels = {}
+    text = None
+    for element in root.iter("div", "td"):
+        classes = element.get("class", "").split()
+        for class_name in classes:
+            field = CLASS_FIELDS.get((element.tag, class_name))
+            if field is not None:
+                lists[field].append(element.text_content().strip())
+        if element.tag == "div" and "report-text-surround" in classes:
+            text = _report_text(element)
+        elif element.tag == "td":
+            cell = element.text_content()
+            match = LABEL_PATTERN.match(cell)
+            if match and LABEL_FIELDS[match.group(1)] not in labels:
+                labels[LABEL_FIELDS[match.group(1)]] = cell.split(": ")[-1].strip()
+
+    return {
+        "ID": _first_int(labels.get("ID")),
+        "title": lists["title"][0] if lists["title"] else None,
+        "substance": lists["substance"][0] if lists["substance"] else None,
+        "substances": lists["substances"],
+        "method": lists["method"],
+        "amount": lists["amount"],
+        "form": lists["form"],
+        "body_weight": lists["body_weight"][0] if lists["body_weight"] else None,
+        "exp_year": _first_int(labels.get("exp_year")),
+        "age": _first_int(labels.get("age")),
+        "sex": labels.get("sex"),
+        "published": _parse_date(labels.get("published")),
+        "text": text,
+    }
+
+
+def _parse_record(record: Tuple[str, bytes]) -> Optional[Dict[str, Any]]:
+    exp_id, content = record
+    try:
+        row = parse_page(content)
+    except Exception as e:
+        print(f"Failed to parse page {exp_id}: {e}")
+        return None
+    if row["ID"] is None:
+        row["ID"] = _first_int(exp_id)
+    return row if row["text"] else None
+
+
+def iter_directory_pages(directory: str) -> Iterator[Tuple[str, bytes]]:
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                yield name, f.read()
+
+
+def iter_source_pages(source: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    Pages from a PageArchive directory, or from a one-file-per-page directory.
+    """
+    if os.path.exists(os.path.join(source, "index.sqlite3")):
+        return PageArchive(source).iter_pages()
+    return iter_directory_pages(source)
+
+
+def parse_pages(
+    pages: Iterable[Tuple[str, bytes]],
+    output_path: str,
+    workers: Optional[int] = None,
+    batch_size: int = 2000,
+) -> int:
+    """
+    Parse pages on a process pool and stream the rows into a Parquet file.
+    Only one batch of pages is in memory at a time.
+    """
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, batch_size // (workers * 4))
+    written = 0
+    pages = iter(pages)
+    with Pool(processes=workers) as pool, pq.ParquetWriter(output_path, SCHEMA) as writer:
+        while True:
+            batch = list(islice(pages, batch_size))
+            if not batch:
+                break
+            rows = [row for row in pool.map(_parse_record, batch, chunksize) if row]
+            if rows:
+                writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+                written += len(rows)
+            print(f"Parsed {written} reports")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help="PageArchive directory or one-file-per-page directory")
+    parser.add_argument("output", help="Parquet file, e.g. raw_experiences/all/reports.parquet")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=2000)
+    args = parser.parse_args()
+    parse_pages(
+        iter_source_pages(args.source),
+        args.output,
+        workers=args.workers,
+        batch_size=args.batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
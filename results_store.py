@@ -0,0 +1,287 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+DEFAULT_RESULTS_PATH = "processed_data/results.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    metadata TEXT,
+    theme_counts TEXT,
+    emotion_counts TEXT
+);
+CREATE TABLE IF NOT EXISTS reports (
+    report_key TEXT PRIMARY KEY,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS analyses (
+    analysis_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL REFERENCES sessions (session_id),
+    report_key TEXT NOT NULL REFERENCES reports (report_key),
+    dataset TEXT,
+    substance TEXT COLLATE NOCASE,
+    age TEXT,
+    gender TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS themes (
+    analysis_id INTEGER NOT NULL REFERENCES analyses (analysis_id),
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS emotions (
+    analysis_id INTEGER NOT NULL REFERENCES analyses (analysis_id),
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analyses_substance ON analyses (substance);
+CREATE INDEX IF NOT EXISTS analyses_session ON analyses (session_id);
+CREATE INDEX IF NOT EXISTS analyses_report ON analyses (report_key);
+CREATE INDEX IF NOT EXISTS themes_analysis ON themes (analysis_id);
+CREATE INDEX IF NOT EXISTS emotions_analysis ON emotions (analysis_id);
+"""
+
+ITEM_TABLES = {"themes": "themes", "emotions": "emotions"}
+# Columns added after the first release, created on stores that predate them
+MIGRATIONS = {
+    "analyses": {
+        "prompt_tokens": "INTEGER",
+        "completion_tokens": "INTEGER",
+        "dataset": "TEXT",
+    },
+}
+
+
+class ResultsStore:
+    """
+    Embedded SQLite store for every analysis ever run, replacing one JSON file per report.
+    Writes are batched into one transaction per call; reads are plain SQL over indexed tables.
+    """
+
+    def __init__(self, path: str = DEFAULT_RESULTS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            self._migrate(self._conn)
+        return self._conn
+
+    def _migrate(self, conn):
+        added = set()
+        for table, columns in MIGRATIONS.items():
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                    added.add((table, column))
+        # Older stores kept one dataset per report (the last one it was analyzed under);
+        # their analyses inherit it as the best guess
+        if ("analyses", "dataset") in added:
+            conn.execute(
+                "UPDATE analyses SET dataset = (SELECT dataset FROM reports r "
+                "WHERE r.report_key = analyses.report_key) WHERE dataset IS NULL"
+            )
+        conn.execute("CREATE INDEX IF NOT EXISTS analyses_dataset ON analyses (dataset)")
+        conn.commit()
+
+    def _ensure_session(self, conn, session_id, metadata=None):
+        conn.execute(
+            "INSERT OR IGNORE INTO sessions (session_id, created_at, metadata) VALUES (?, ?, ?)",
+            (session_id, time.time(), json.dumps(metadata or {})),
+        )
+
+    def start_session(self, session_id: str, **metadata):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                self._ensure_session(conn, session_id, metadata)
+
+    def save_analyses(self, session_id: str, records: List[Dict[str, Any]]) -> List[int]:
+        """
+        Store a batch of analyses in a single transaction. Each record holds the
+        AnalysisResultJSON fields plus the report "key", and optionally "title", "dataset"
+        and "usage" (token accounting). The dataset belongs to the analysis, so a report
+        listed in several datasets counts in each one it was analyzed under.
+        """
+        now = time.time()
+        analysis_ids = []
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                self._ensure_session(conn, session_id)
+                for record in records:
+                    conn.execute(
+                        "INSERT INTO reports (report_key, title) VALUES (?, ?) "
+                        "ON CONFLICT (report_key) DO UPDATE SET "
+                        "title = COALESCE(excluded.title, title)",
+                        (record["key"], record.get("title")),
+                    )
+                    usage = record.get("usage") or {}
+                    cursor = conn.execute(
+                        "INSERT INTO analyses (session_id, report_key, dataset, substance, "
+                        "age, gender, prompt_tokens, completion_tokens, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            session_id,
+                            record["key"],
+                            record.get("dataset"),
+                            record.get("substance"),
+                            record.get("age") or "N/A",
+                            record.get("gender") or "N/A",
+                            usage.get("prompt_tokens"),
+                            usage.get("completion_tokens"),
+                            now,
+                        ),
+                    )
+                    analysis_id = cursor.lastrowid
+                    analysis_ids.append(analysis_id)
+                    for kind in ITEM_TABLES:
+                        conn.executemany(
+                            f"INSERT INTO {ITEM_TABLES[kind]} (analysis_id, name) VALUES (?, ?)",
+                            [(analysis_id, item) for item in record.get(kind) or []],
+                        )
+        return analysis_ids
+
+    def save_session_summary(self, session_id: str, theme_counts, emotion_counts):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                self._ensure_session(conn, session_id)
+                conn.execute(
+                    "UPDATE sessions SET theme_counts = ?, emotion_counts = ? WHERE session_id = ?",
+                    (json.dumps(theme_counts), json.dumps(emotion_counts), session_id),
+                )
+
+    def _filters(self, substance=None, session_id=None, dataset=None):
+        clauses, params = [], []
+        if substance is not None:
+            clauses.append("a.substance = ?")
+            params.append(substance)
+        if session_id is not None:
+            clauses.append("a.session_id = ?")
+            params.append(session_id)
+        if dataset is not None:
+            clauses.append("a.dataset = ?")
+            params.append(dataset)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def item_counts(
+        self, kind: str, substance=None, session_id=None, dataset=None
+    ) -> Counter:
+        """
+        Count themes or emotions (`kind` is "themes" or "emotions") with a single GROUP BY.
+        """
+        table = ITEM_TABLES[kind]
+        where, params = self._filters(substance, session_id, dataset)
+        with self._lock:
+            rows = self._connection().execute(
+                f"SELECT i.name, COUNT(*) FROM {table} i "
+                "JOIN analyses a ON a.analysis_id = i.analysis_id "
+                f"{where} GROUP BY i.name",
+                params,
+            ).fetchall()
+        return Counter(dict(rows))
+
+    def fetch_analyses(
+        self, substance=None, session_id=None, dataset=None, limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Analyses matching the filters as AnalysisResultJSON-shaped dicts (plus key and dataset).
+        """
+        where, params = self._filters(substance, session_id, dataset)
+        query = (
+            "SELECT a.analysis_id, a.report_key, r.title, a.dataset, a.substance, a.age, a.gender "
+            "FROM analyses a JOIN reports r ON r.report_key = a.report_key "
+            f"{where} ORDER BY a.analysis_id"
+        )
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute(query, params).fetchall()
+            analyses = {
+                row[0]: {
+                    "key": row[1],
+                    "title": row[2],
+                    "dataset": row[3],
+                    "substance": row[4],
+                    "age": row[5],
+                    "gender": row[6],
+                    "themes": [],
+                    "emotions": [],
+                }
+                for row in rows
+            }
+            for kind, table in ITEM_TABLES.items():
+                item_rows = conn.execute(
+                    f"SELECT i.analysis_id, i.name FROM {table} i "
+                    "JOIN analyses a ON a.analysis_id = i.analysis_id "
+                    f"{where} ORDER BY i.rowid",
+                    params,
+                ).fetchall()
+                for analysis_id, name in item_rows:
+                    if analysis_id in analyses:
+                        analyses[analysis_id][kind].append(name)
+        return list(analyses.values())
+
+    def last_analysis_id(self) -> int:
+        """
+        Id of the newest stored analysis (0 if none), to tell whether anything changed.
+        """
+        with self._lock:
+            row = self._connection().execute("SELECT MAX(analysis_id) FROM analyses").fetchone()
+        return row[0] or 0
+
+    def has_analysis(self, report_key: str) -> bool:
+        """
+        Whether the report was ever analyzed.
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT 1 FROM analyses WHERE report_key = ? LIMIT 1", (report_key,)
+            ).fetchone()
+        return row is not None
+
+    def latest_analysis(self, report_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Most recent stored analysis of a report, or None if it was never analyzed.
+        """
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT analysis_id, substance, age, gender FROM analyses "
+                "WHERE report_key = ? ORDER BY analysis_id DESC LIMIT 1",
+                (report_key,),
+            ).fetchone()
+            if row is None:
+                return None
+            analysis = {
+                "key": report_key,
+                "substance": row[1],
+                "age": row[2],
+                "gender": row[3],
+            }
+            for kind, table in ITEM_TABLES.items():
+                analysis[kind] = [
+                    name
+                    for (name,) in conn.execute(
+                        f"SELECT name FROM {table} WHERE analysis_id = ? ORDER BY rowid",
+                        (row[0],),
+                    )
+                ]
+        return analysis
@@ -1,10 +1,30 @@
 import requests
 from bs4 import BeautifulSoup
 import json
+import os
+import re
+from crawler import CrawlStore, crawl
+from page_archive import PageArchive
 
-# TODO: I used Apify.com because I was rate limited by Erowid.org - accidentally scrapped 5000+ pages in one sitting and IP address was banned lol. going to revisit this code later to continue so I don't need to use apify | 12/4/23
+# Report pages are fetched through crawler.Crawler, which is rate limited, respects
+# robots.txt, retries and can resume
 # Base URL of the site we will scrape from
 BASE_URL = "https://erowid.org/experiences/"
+# One crawl frontier per seed, so each substance only ever resumes its own pages
+CRAWL_STATE_DIR = "crawl_state"
+ARCHIVE_DIR = "erowid-archive"
+
+
+def crawl_state_path(seed_url):
+    name = re.sub(r"[^A-Za-z0-9]+", "_", seed_url.replace(BASE_URL, "")).strip("_")
+    return os.path.join(CRAWL_STATE_DIR, f"erowid-{name}.sqlite3")
+
+
+def report_text(content):
+    # Report pages hold the text; listing pages only link to reports
+    soup = BeautifulSoup(content, "html.parser")
+    report = soup.find("div", class_="report-text-surround")
+    return None if report is None else report.text
 
 
 def get_substance_links(substances):
@@ -28,26 +48,57 @@ def get_substance_links(substances):
 
 
 # Function to scrape the reports of a specific substance
-def scrape_substance_reports(substance_url):
-    # Construct the URL for the substance page
-    url = substance_url
-    # Make the request and create a BeautifulSoup object
-    page = requests.get(url)
-    soup = BeautifulSoup(page.content, "html.parser")
-    all_reports_link_table = soup.find("table", id="exp-front-top-table")
-    # Extract the trip reports - this would need to be customized according to the page structure
+def scrape_substance_reports(
+    substance_url,
+    state_path=None,
+    requests_per_second=0.5,
+    max_concurrency=2,
+    archive=None,
+    **crawler_options,
+):
+    # With a page_archive.PageArchive, every report page is stored (by ExpID) as soon as
+    # it is fetched, and all of the substance's reports are returned, including those
+    # fetched by earlier, possibly interrupted, runs. Without one, only this run's are.
+    state_path = state_path or crawl_state_path(substance_url)
     reports = []
-    # Example: Find all 'a' elements with a specific CSS class (this would depend on the actual structure of the page)
-    report_links = soup.find_all("a", class_="report-link-class")
-    for link in report_links:
-        report_url = BASE_URL + link["href"]
-        report_page = requests.get(report_url)
-        report_soup = BeautifulSoup(report_page.content, "html.parser")
-
-        # Again, you would need to customize the extraction process based on the structure of the individual report pages
-        report_text = report_soup.find("div", class_="report-text-class").text
-        reports.append(report_text)
 
+    async def handle_page(url, response):
+        text = report_text(response.content)
+        if text is not None:
+            if archive is not None:
+                archive.put(url.split("ID=")[-1], response.content)
+            else:
+                reports.append(text)
+            return []
+        soup = BeautifulSoup(response.content, "html.parser")
+        return [
+            BASE_URL + link["href"]
+            for link in soup.find_all("a", href=True)
+            if "exp.php?ID=" in link["href"]
+        ]
+
+    # The listing page is revisited (conditionally) on every run to find new reports
+    crawl(
+        [substance_url],
+        handle_page,
+        state_path,
+        refresh=True,
+        requests_per_second=requests_per_second,
+        max_concurrency=max_concurrency,
+        **crawler_options,
+    )
+    if archive is None:
+        return reports
+    store = CrawlStore(state_path)
+    try:
+        urls = [url for url in store.done() if "exp.php?ID=" in url]
+    finally:
+        store.close()
+    for url in urls:
+        content = archive.get(url.split("ID=")[-1])
+        text = report_text(content) if content is not None else None
+        if text is not None:
+            reports.append(text)
     return reports
 
 
@@ -66,15 +117,19 @@ def save_reports_to_file(reports, filename):
 
 
 # Main function to run the scraping process
-def main(substances, output_filename):
+def main(substances, output_filename, archive_dir=ARCHIVE_DIR):
     substance_links = get_substance_links(substances)
     all_reports = {}
     print("SUBSTANCE LINKS", substance_links)
-    # Scrape reports for each substance
-    for substance, url in substance_links.items():
-        print("SCRAPING", substance, url)
-        reports = scrape_substance_reports(url)
-        all_reports[substance] = reports
+    # Report pages go to the archive as they arrive, and the output is rebuilt from it,
+    # so a resumed or repeated crawl still writes every report found so far
+    archive = PageArchive(archive_dir)
+    try:
+        for substance, url in substance_links.items():
+            print("SCRAPING", substance, url)
+            all_reports[substance] = scrape_substance_reports(url, archive=archive)
+    finally:
+        archive.close()
 
     # Save the reports to a JSON file
     with open(output_filename, "w") as file:
@@ -82,8 +137,9 @@ def main(substances, output_filename):
 
 
 # Example usage:
-substances_to_scrape = [
-    "LSD",
-]  # Your list of substances goes here
-output_file = "trip_reports.json"
-main(substances_to_scrape, output_file)
+if __name__ == "__main__":
+    substances_to_scrape = [
+        "LSD",
+    ]  # Your list of substances goes here
+    output_file = "trip_reports.json"
+    main(substances_to_scrape, output_file)
@@ -0,0 +1,394 @@
+"""
+Persistent full-text index over report titles and texts, for finding reports to analyze.
+
+Built on SQLite FTS5 with bm25 ranking (title matches weigh more than text matches) and
+filters on dataset, substance, age and gender. The index is updated incrementally:
+unchanged dataset files are skipped, and only new or edited reports are re-indexed.
+
+Usage:
+    python search_index.py "ego death" nausea --dataset LSD_reports --limit 20
+"""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from typing import Iterable, List, NamedTuple, Optional
+
+import pandas as pd
+
+from report_index import ReportIndex
+
+DEFAULT_SEARCH_INDEX_PATH = "cache/search_index.sqlite3"
+# bm25 column weights: title, text
+TITLE_WEIGHT = 5.0
+TEXT_WEIGHT = 1.0
+QUERY_TOKEN = re.compile(r'"[^"]*"\*?|\S+')
+# Dropped from queries (outside quoted phrases): they match nearly every report, which
+# makes ranking slow without changing which reports come first
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from had has have he her his i in is it its me "
+    "my of on or she so that the their them then there they this to was we were with "
+    "you".split()
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    dataset TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS reports (
+    rowid INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    report_key TEXT NOT NULL,
+    title TEXT,
+    substance TEXT COLLATE NOCASE,
+    age INTEGER,
+    gender TEXT COLLATE NOCASE,
+    digest TEXT NOT NULL,
+    UNIQUE (dataset, report_key)
+);
+CREATE INDEX IF NOT EXISTS reports_substance ON reports (substance);
+CREATE INDEX IF NOT EXISTS reports_gender ON reports (gender);
+CREATE INDEX IF NOT EXISTS reports_age ON reports (age);
+CREATE VIRTUAL TABLE IF NOT EXISTS report_text USING fts5 (
+    title, text, tokenize = 'porter unicode61 remove_diacritics 2', prefix = '2 3'
+);
+"""
+
+
+class SearchHit(NamedTuple):
+    dataset: str
+    key: str
+    title: str
+    substance: Optional[str]
+    age: Optional[int]
+    gender: Optional[str]
+    score: float
+    snippet: str
+
+
+def to_fts_query(query: str) -> str:
+    """
+    Turn user input into an FTS5 query: words and "quoted phrases" must all match,
+    a trailing * matches prefixes and OR/NOT between terms are kept. Unquoted stopwords
+    are dropped and everything else is quoted, so punctuation can't break the syntax.
+    """
+    terms = []
+    for token in QUERY_TOKEN.findall(query):
+        if token in ("OR", "NOT", "AND"):
+            # Operators left next to each other by a dropped stopword ("ego OR the OR
+            # nausea") keep only the first
+            if terms and terms[-1] not in ("OR", "NOT", "AND"):
+                terms.append(token)
+            continue
+        if token.lower() in STOPWORDS:
+            continue
+        prefix = token.endswith("*")
+        phrase = token.rstrip("*").strip('"').replace('"', '""')
+        if phrase.strip():
+            terms.append(f'"{phrase}"' + ("*" if prefix else ""))
+    # Operators need a term on both sides
+    while terms and terms[0] in ("OR", "NOT", "AND"):
+        terms.pop(0)
+    while terms and terms[-1] in ("OR", "NOT", "AND"):
+        terms.pop()
+    return " ".join(terms)
+
+
+def _digest(title, text) -> str:
+    return hashlib.sha1(f"{title}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _age(value) -> Optional[int]:
+    try:
+        return None if pd.isna(value) else int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _text(value) -> Optional[str]:
+    return value if isinstance(value, str) and value.strip() else None
+
+
+class SearchIndex:
+    """
+    FTS5 index of every report in the catalog, keyed by (dataset, report key) where the
+    report key is the one ReportIndex gives the report, so hits can be analyzed directly.
+    """
+
+    def __init__(self, path: str = DEFAULT_SEARCH_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def index_dataframe(self, dataset: str, df: pd.DataFrame) -> int:
+        """
+        Bring one dataset's reports in the index up to date with `df`: new and edited
+        reports are (re-)indexed and reports no longer in `df` are removed. Returns the
+        number of reports written.
+        """
+        reports = ReportIndex.from_dataframe(df)
+        rows = df.to_dict("records")
+        written = 0
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                existing = dict(
+                    conn.execute(
+                        "SELECT report_key, digest FROM reports WHERE dataset = ?",
+                        (dataset,),
+                    ).fetchall()
+                )
+                for key, row in zip(reports.keys(), rows):
+                    title, text = reports.title(key), reports.text(key) or ""
+                    digest = _digest(title, text)
+                    if existing.pop(key, None) == digest:
+                        continue
+                    self._delete(conn, dataset, key)
+                    cursor = conn.execute(
+                        "INSERT INTO reports (dataset, report_key, title, substance, "
+                        "age, gender, digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            dataset,
+                            key,
+                            title,
+                            _text(row.get("substance")),
+                            _age(row.get("age")),
+                            _text(row.get("sex")),
+                            digest,
+                        ),
+                    )
+                    conn.execute(
+                        "INSERT INTO report_text (rowid, title, text) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, title, text),
+                    )
+                    written += 1
+                for key in existing:
+                    self._delete(conn, dataset, key)
+        return written
+
+    @staticmethod
+    def _delete(conn, dataset, key):
+        row = conn.execute(
+            "SELECT rowid FROM reports WHERE dataset = ? AND report_key = ?",
+            (dataset, key),
+        ).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM report_text WHERE rowid = ?", row)
+            conn.execute("DELETE FROM reports WHERE rowid = ?", row)
+
+    def update(self, catalog, keys: Optional[Iterable[str]] = None) -> int:
+        """
+        Index the catalog's datasets (or just `keys`), skipping dataset files whose size
+        and modification time haven't changed since they were last indexed. Datasets gone
+        from the catalog are dropped. Returns the number of reports written.
+        """
+        keys = list(catalog.keys() if keys is None else keys)
+        with self._lock:
+            conn = self._connection()
+            indexed = {
+                row[0]: tuple(row[1:])
+                for row in conn.execute("SELECT dataset, path, size, mtime FROM datasets")
+            }
+        written = 0
+        for key in keys:
+            info = catalog.datasets[key]
+            if indexed.get(key) == (info.path, info.size, info.mtime):
+                continue
+            written += self.index_dataframe(key, catalog.load(key))
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO datasets (dataset, path, size, mtime) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, info.path, info.size, info.mtime),
+                )
+        if keys == catalog.keys():
+            for key in set(indexed) - set(keys):
+                self.remove_dataset(key)
+        if written:
+            self.optimize()
+        return written
+
+    def optimize(self):
+        """
+        Merge the FTS index segments left by incremental writes; queries get faster.
+        """
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT INTO report_text (report_text) VALUES ('optimize')")
+
+    def remove_dataset(self, dataset: str):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "DELETE FROM report_text WHERE rowid IN "
+                    "(SELECT rowid FROM reports WHERE dataset = ?)",
+                    (dataset,),
+                )
+                conn.execute("DELETE FROM reports WHERE dataset = ?", (dataset,))
+                conn.execute("DELETE FROM datasets WHERE dataset = ?", (dataset,))
+
+    def search(
+        self,
+        query: str = "",
+        dataset: Optional[str] = None,
+        substance: Optional[str] = None,
+        gender: Optional[str] = None,
+        min_age: Optional[int] = None,
+        max_age: Optional[int] = None,
+        limit: Optional[int] = 100,
+    ) -> List[SearchHit]:
+        """
+        Reports matching `query` (see to_fts_query), best bm25 score first, restricted by
+        the given filters. Without a query, every report passing the filters matches.
+        Raises ValueError if FTS5 still can't parse the query.
+        """
+        conditions, params = [], []
+        for column, value in (
+            ("r.dataset", dataset),
+            ("r.substance", substance),
+            ("r.gender", gender),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if min_age is not None:
+            conditions.append("r.age >= ?")
+            params.append(min_age)
+        if max_age is not None:
+            conditions.append("r.age <= ?")
+            params.append(max_age)
+        filters = "".join(f" AND {condition}" for condition in conditions)
+        match = to_fts_query(query or "")
+        limit_clause = " LIMIT ?" if limit is not None else ""
+        limit_params = [limit] if limit is not None else []
+        if not match:
+            sql = (
+                "SELECT r.dataset, r.report_key, r.title, r.substance, r.age, r.gender, "
+                f"0.0, '' FROM reports r WHERE 1{filters} ORDER BY r.rowid{limit_clause}"
+            )
+            with self._lock:
+                rows = self._connection().execute(sql, params + limit_params).fetchall()
+            return [SearchHit(*row[:6], score=row[6], snippet=row[7]) for row in rows]
+
+        # Rank first, then build snippets for the returned hits only: snippets cost far
+        # more than scores and SQLite would otherwise compute one for every match
+        ranked_sql = (
+            f"SELECT report_text.rowid, bm25(report_text, {TITLE_WEIGHT}, {TEXT_WEIGHT}) "
+            "AS score FROM report_text "
+            + ("JOIN reports r ON r.rowid = report_text.rowid " if filters else "")
+            + f"WHERE report_text MATCH ?{filters} ORDER BY score{limit_clause}"
+        )
+        with self._lock:
+            conn = self._connection()
+            try:
+                ranked = conn.execute(
+                    ranked_sql, [match] + params + limit_params
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                raise ValueError(f"Could not parse query {query!r}: {e}") from e
+            if not ranked:
+                return []
+            rowids = [rowid for rowid, _ in ranked]
+            details = {
+                row[0]: row[1:]
+                for row in conn.execute(
+                    "SELECT r.rowid, r.dataset, r.report_key, r.title, r.substance, "
+                    "r.age, r.gender, snippet(report_text, 1, '[', ']', '…', 12) "
+                    "FROM report_text JOIN reports r ON r.rowid = report_text.rowid "
+                    "WHERE report_text MATCH ? AND report_text.rowid IN "
+                    f"({', '.join('?' * len(rowids))})",
+                    [match] + rowids,
+                )
+            }
+        # bm25 scores are negative, lower is better; report them as higher is better
+        return [
+            SearchHit(*details[rowid][:6], score=-score, snippet=details[rowid][6])
+            for rowid, score in ranked
+        ]
+
+    def values(self, column: str, dataset: Optional[str] = None) -> List[str]:
+        """
+        Distinct substances or genders, for filter widgets.
+        """
+        if column not in ("substance", "gender"):
+            raise ValueError(f"Unknown filter column: {column}")
+        sql = f"SELECT DISTINCT {column} FROM reports WHERE {column} IS NOT NULL"
+        params = []
+        if dataset is not None:
+            sql += " AND dataset = ?"
+            params.append(dataset)
+        with self._lock:
+            rows = self._connection().execute(sql + f" ORDER BY {column}", params)
+            return [row[0] for row in rows.fetchall()]
+
+    def __len__(self):
+        with self._lock:
+            row = self._connection().execute("SELECT COUNT(*) FROM reports").fetchone()
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("query", nargs="*", help="words and \"quoted phrases\"")
+    parser.add_argument("--root", default="raw_experiences")
+    parser.add_argument("--index", default=DEFAULT_SEARCH_INDEX_PATH)
+    parser.add_argument("--dataset")
+    parser.add_argument("--substance")
+    parser.add_argument("--gender")
+    parser.add_argument("--min-age", type=int)
+    parser.add_argument("--max-age", type=int)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    from dataset_catalog import DatasetCatalog
+
+    index = SearchIndex(args.index)
+    written = index.update(DatasetCatalog(root=args.root))
+    print(f"Indexed {written} new or changed reports ({len(index)} total)")
+    # Multi-word arguments were quoted on the command line, so search them as phrases
+    query = " ".join(f'"{term}"' if " " in term else term for term in args.query)
+    try:
+        hits = index.search(
+            query,
+            dataset=args.dataset,
+            substance=args.substance,
+            gender=args.gender,
+            min_age=args.min_age,
+            max_age=args.max_age,
+            limit=args.limit,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    for hit in hits:
+        print(f"{hit.score:7.2f}  {hit.dataset}  #{hit.key}  {hit.title}")
+        if hit.snippet:
+            print(f"         {hit.snippet}")
+
+
+if __name__ == "__main__":
+    main()
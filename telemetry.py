@@ -0,0 +1,326 @@
+"""
+Per-stage timing and LLM call telemetry for pipeline runs.
+
+Pipeline stages are wrapped in `telemetry.stage(name)` and every chat completion reports
+its wall time, queue wait, tokens, retries and cache hit with `telemetry.record_call`.
+Warnings go through `telemetry.log`, which also keeps them with the run's events.
+Events of a run can be exported as JSONL, and running totals as Prometheus text.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+# Events kept in memory for summaries; older events only survive in the JSONL export
+MAX_EVENTS = 200_000
+
+logger = logging.getLogger("pipeline")
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+class Telemetry:
+    """
+    Thread-safe recorder of stage spans and LLM calls. Stage wall times include the
+    stages nested inside them (e.g. "aggregate" includes its "mapping" calls).
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        # Per context, so concurrent runs (e.g. app sessions) don't mix up their events
+        self._run_id: contextvars.ContextVar = contextvars.ContextVar(
+            "telemetry_run_id", default=None
+        )
+        self._events = deque(maxlen=MAX_EVENTS)
+        self._lock = threading.Lock()
+        # Running totals for the Prometheus endpoint, never reset
+        self._stage_totals = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+        self._call_totals = defaultdict(
+            lambda: {
+                "count": 0,
+                "seconds": 0.0,
+                "queue_wait_seconds": 0.0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "retries": 0,
+                "cache_hits": 0,
+                "errors": 0,
+            }
+        )
+
+    @property
+    def run_id(self) -> Optional[str]:
+        return self._run_id.get()
+
+    def start_run(self, run_id: str) -> contextvars.Token:
+        """
+        Tag the events recorded in this context, including worker threads started with
+        contextvars.copy_context().run, with `run_id`. Pass the token to end_run.
+        """
+        return self._run_id.set(run_id)
+
+    def end_run(self, token: Optional[contextvars.Token] = None):
+        """
+        Append the finished run's events to `path` (if set), then restore the run the
+        context was in before start_run returned `token`.
+        """
+        if self.path and self.run_id:
+            self.export_jsonl(self.path, run_id=self.run_id)
+        if token is not None:
+            try:
+                self._run_id.reset(token)
+            except ValueError:
+                # A generator finalized from another context, which was never tagged
+                pass
+
+    @contextlib.contextmanager
+    def run(self, run_id: str):
+        """
+        start_run for the block and end_run after it, also when it raises or a generator
+        running it is closed early.
+        """
+        token = self.start_run(run_id)
+        try:
+            yield
+        finally:
+            self.end_run(token)
+
+    def _add(self, event: Dict[str, Any]):
+        event["run_id"] = self.run_id
+        event["time"] = time.time()
+        with self._lock:
+            self._events.append(event)
+            if event["type"] == "stage":
+                totals = self._stage_totals[event["stage"]]
+                totals["count"] += 1
+                totals["seconds"] += event["seconds"]
+            elif event["type"] == "llm_call":
+                totals = self._call_totals[event["stage"]]
+                totals["count"] += 1
+                totals["seconds"] += event["seconds"]
+                totals["queue_wait_seconds"] += event["queue_wait_seconds"]
+                totals["prompt_tokens"] += event["prompt_tokens"]
+                totals["completion_tokens"] += event["completion_tokens"]
+                totals["retries"] += event["retries"]
+                totals["cache_hits"] += event["cache_hit"]
+                totals["errors"] += event["error"] is not None
+
+    @contextlib.contextmanager
+    def stage(self, name: str, queued_at: Optional[float] = None, **labels):
+        """
+        Time a pipeline stage. `queued_at` (a time.perf_counter() value) records how long
+        the work waited, e.g. in an executor queue, before the stage started. Labels can
+        be added inside the block through the yielded dict.
+        """
+        start = time.perf_counter()
+        queue_wait = max(0.0, start - queued_at) if queued_at is not None else 0.0
+        try:
+            yield labels
+        finally:
+            self.record_stage(name, time.perf_counter() - start, queue_wait, **labels)
+
+    def record_stage(self, name: str, seconds: float, queue_wait_seconds=0.0, **labels):
+        self._add(
+            {
+                "type": "stage",
+                "stage": name,
+                "seconds": seconds,
+                "queue_wait_seconds": queue_wait_seconds,
+                "labels": labels,
+            }
+        )
+
+    def record_call(
+        self,
+        stage: str,
+        seconds: float,
+        queue_wait_seconds: float = 0.0,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        retries: int = 0,
+        cache_hit: bool = False,
+        error: Optional[str] = None,
+    ):
+        self._add(
+            {
+                "type": "llm_call",
+                "stage": stage,
+                "seconds": seconds,
+                "queue_wait_seconds": queue_wait_seconds,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "retries": retries,
+                "cache_hit": cache_hit,
+                "error": error,
+            }
+        )
+
+    def log(self, level: int, message: str, stage: Optional[str] = None, **labels):
+        """
+        Log `message` (logger "pipeline") and keep it with the run's events, e.g. a
+        failed report or a fallback to local categorization.
+        """
+        logger.log(level, message)
+        self._add(
+            {
+                "type": "log",
+                "level": logging.getLevelName(level),
+                "stage": stage,
+                "message": message,
+                "labels": labels,
+            }
+        )
+
+    def events(self, run_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                dict(event)
+                for event in self._events
+                if run_id is None or event["run_id"] == run_id
+            ]
+
+    def summary(self, run_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        One row per stage: stage wall time and the LLM calls made inside it, slowest first.
+        """
+        rows = {}
+        for event in self.events(run_id):
+            if event["type"] == "log":
+                continue
+            row = rows.setdefault(
+                event["stage"],
+                {
+                    "stage": event["stage"],
+                    "spans": 0,
+                    "wall_time_s": 0.0,
+                    "queue_wait_s": 0.0,
+                    "llm_calls": 0,
+                    "llm_time_s": 0.0,
+                    "cache_hits": 0,
+                    "retries": 0,
+                    "errors": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                },
+            )
+            row["queue_wait_s"] += event["queue_wait_seconds"]
+            if event["type"] == "stage":
+                row["spans"] += 1
+                row["wall_time_s"] += event["seconds"]
+            else:
+                row["llm_calls"] += 1
+                row["llm_time_s"] += event["seconds"]
+                row["cache_hits"] += event["cache_hit"]
+                row["retries"] += event["retries"]
+                row["errors"] += event["error"] is not None
+                row["prompt_tokens"] += event["prompt_tokens"]
+                row["completion_tokens"] += event["completion_tokens"]
+        for row in rows.values():
+            for field in ("wall_time_s", "queue_wait_s", "llm_time_s"):
+                row[field] = round(row[field], 3)
+        return sorted(
+            rows.values(), key=lambda row: -max(row["wall_time_s"], row["llm_time_s"])
+        )
+
+    def export_jsonl(self, path: str, run_id: Optional[str] = None) -> int:
+        events = self.events(run_id)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "a") as f:
+            for event in events:
+                f.write(json.dumps(event, default=str) + "\n")
+        return len(events)
+
+    def prometheus_text(self) -> str:
+        """
+        Running totals in the Prometheus text exposition format.
+        """
+        with self._lock:
+            stage_totals = {stage: dict(t) for stage, t in self._stage_totals.items()}
+            call_totals = {stage: dict(t) for stage, t in self._call_totals.items()}
+        lines = [
+            "# HELP pipeline_stage_seconds Wall time spent in pipeline stages.",
+            "# TYPE pipeline_stage_seconds summary",
+        ]
+        for stage, totals in sorted(stage_totals.items()):
+            labels = _labels({"stage": stage})
+            lines.append(f"pipeline_stage_seconds_sum{{{labels}}} {totals['seconds']:.6f}")
+            lines.append(f"pipeline_stage_seconds_count{{{labels}}} {totals['count']}")
+        lines += [
+            "# HELP llm_call_seconds Wall time of LLM calls, including retries.",
+            "# TYPE llm_call_seconds summary",
+        ]
+        for stage, totals in sorted(call_totals.items()):
+            labels = _labels({"stage": stage})
+            lines.append(f"llm_call_seconds_sum{{{labels}}} {totals['seconds']:.6f}")
+            lines.append(f"llm_call_seconds_count{{{labels}}} {totals['count']}")
+        counters = [
+            (
+                "llm_queue_wait_seconds_total",
+                "queue_wait_seconds",
+                "Time LLM calls waited for the rate budget.",
+            ),
+            ("llm_retries_total", "retries", "Retried LLM requests."),
+            (
+                "llm_cache_hits_total",
+                "cache_hits",
+                "LLM calls answered from the response cache.",
+            ),
+            ("llm_errors_total", "errors", "LLM calls that failed."),
+        ]
+        for metric, field, help_text in counters:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for stage, totals in sorted(call_totals.items()):
+                lines.append(f"{metric}{{{_labels({'stage': stage})}}} {totals[field]}")
+        lines += [
+            "# HELP llm_tokens_total Tokens reported by the API.",
+            "# TYPE llm_tokens_total counter",
+        ]
+        for stage, totals in sorted(call_totals.items()):
+            for kind in ("prompt", "completion"):
+                labels = _labels({"stage": stage, "kind": kind})
+                lines.append(f"llm_tokens_total{{{labels}}} {totals[f'{kind}_tokens']}")
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(
+        self, port: int = 9464, host: str = "127.0.0.1"
+    ) -> ThreadingHTTPServer:
+        """
+        Serve prometheus_text() at http://host:port/metrics from a daemon thread.
+        """
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                payload = telemetry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# Shared by the whole pipeline; set TELEMETRY_PATH="" to skip the JSONL export
+telemetry = Telemetry(
+    path=os.getenv("TELEMETRY_PATH", "processed_data/telemetry.jsonl") or None
+)
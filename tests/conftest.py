@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Nothing is exported to processed_data/ by the tests
+os.environ.setdefault("TELEMETRY_PATH", "")
@@ -0,0 +1,122 @@
+import json
+
+import httpx
+import pytest
+
+import analysis_pipeline
+from batch_api import BatchAPI, run_batch_job
+from llm_cache import ResponseCache
+from report_index import ReportIndex
+from results_store import ResultsStore
+
+
+class BatchServer:
+    """
+    Mock transport for the files and batches endpoints. A batch reports "in_progress"
+    when first polled and "completed" after that; requests for the reports in
+    `invalid_once` get an unparseable reply the first time they are submitted.
+    """
+
+    def __init__(self, invalid_once=()):
+        self.invalid_once = set(invalid_once)
+        self.files = {}
+        self.batches = {}
+        self.transport = httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        parts = request.url.path.strip("/").split("/")[1:]
+        if request.method == "POST" and parts == ["files"]:
+            # The JSONL lines of the multipart upload
+            lines = [
+                line
+                for line in request.read().splitlines()
+                if line.startswith(b'{"custom_id"')
+            ]
+            file_id = f"file-{len(self.files)}"
+            self.files[file_id] = lines
+            return httpx.Response(200, json={"id": file_id})
+        if request.method == "POST" and parts == ["batches"]:
+            body = json.loads(request.read())
+            batch_id = f"batch-{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "status": "validating",
+                "input_file_id": body["input_file_id"],
+            }
+            return httpx.Response(200, json=self.batches[batch_id])
+        if parts[0] == "batches":
+            batch = self.batches[parts[1]]
+            if batch["status"] == "validating":
+                batch["status"] = "in_progress"
+            else:
+                batch["status"] = "completed"
+                batch["output_file_id"] = self._run(batch["input_file_id"])
+            return httpx.Response(200, json=batch)
+        if parts[0] == "files" and parts[2:] == ["content"]:
+            return httpx.Response(200, content=b"\n".join(self.files[parts[1]]))
+        return httpx.Response(404)
+
+    def _run(self, input_file_id: str) -> str:
+        output = []
+        for line in self.files[input_file_id]:
+            request = json.loads(line)
+            key = request["custom_id"].split(":")[0]
+            content = json.dumps(
+                {"substance": "LSD", "themes": [f"theme {key}"], "emotions": ["awe"]}
+            )
+            if key in self.invalid_once:
+                self.invalid_once.discard(key)
+                content = "not json"
+            reply = {
+                "choices": [{"message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            }
+            record = {
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": reply},
+                "error": None,
+            }
+            output.append(json.dumps(record).encode("utf-8"))
+        file_id = f"file-{len(self.files)}"
+        self.files[file_id] = output
+        return file_id
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ResultsStore(str(tmp_path / "results.sqlite3"))
+    monkeypatch.setattr(analysis_pipeline, "results_store", store)
+    monkeypatch.setattr(
+        analysis_pipeline,
+        "response_cache",
+        ResponseCache(str(tmp_path / "cache.sqlite3"), enabled=False),
+    )
+    return store
+
+
+def test_submit_wait_collect_ingest(tmp_path, store):
+    reports = ReportIndex(
+        ["1", "2"], ["First trip", "Second trip"], ["A short report.", "Another one."]
+    )
+    server = BatchServer(invalid_once={"2"})
+    api = BatchAPI("https://api.test/v1", "key", transport=server.transport)
+    job_dir = str(tmp_path / "job")
+    dataset = {"1": "LSD_reports", "2": "LSD_more"}
+
+    summary = run_batch_job(reports, reports.keys(), job_dir, dataset, api, poll_interval=0)
+
+    # The invalid reply was resubmitted in a second batch
+    assert summary == {"reports": 2, "stored": 2, "failed": 0, "requests": 2, "batches": 2}
+    analyses = {analysis["key"]: analysis for analysis in store.fetch_analyses()}
+    assert analyses["1"]["dataset"] == "LSD_reports"
+    assert analyses["2"]["dataset"] == "LSD_more"
+    assert analyses["2"]["themes"] == ["theme 2"]
+    with open(f"{job_dir}/errors.jsonl") as f:
+        assert [json.loads(line)["custom_id"][:2] for line in f] == ["2:"]
+
+    # Rerunning the finished job submits and stores nothing new
+    summary = run_batch_job(reports, reports.keys(), job_dir, dataset, api, poll_interval=0)
+
+    assert summary["stored"] == 0
+    assert summary["batches"] == 2
+    assert len(store.fetch_analyses()) == 2
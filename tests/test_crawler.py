@@ -0,0 +1,92 @@
+import asyncio
+
+import httpx
+
+from crawler import Crawler, CrawlStore
+
+SITE = "https://example.org"
+ROBOTS = "User-agent: *\nDisallow: /private/\n"
+PAGES = {
+    "/": "/a /b /private/secret",
+    "/a": "",
+    "/b": "",
+    "/private/secret": "",
+}
+
+
+class Site:
+    """
+    Mock transport for a small site; `failures` maps a path to statuses served (in order)
+    before the page itself.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = {
+            path: list(statuses) for path, statuses in (failures or {}).items()
+        }
+        self.requests = []
+        self.transport = httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        self.requests.append(path)
+        if path == "/robots.txt":
+            return httpx.Response(200, text=ROBOTS)
+        if self.failures.get(path):
+            return httpx.Response(self.failures[path].pop(0), headers={"Retry-After": "0"})
+        return httpx.Response(200, text=PAGES[path])
+
+    def fetched(self, path):
+        return self.requests.count(path)
+
+
+async def links(url, response):
+    return response.text.split()
+
+
+def crawl(store, site, **options):
+    crawler = Crawler(
+        store, requests_per_second=1000, backoff_base=0, transport=site.transport, **options
+    )
+    return asyncio.run(crawler.run([SITE + "/"], links))
+
+
+def test_follows_links_and_respects_robots(tmp_path):
+    store = CrawlStore(str(tmp_path / "crawl.sqlite3"))
+    site = Site()
+
+    counts = crawl(store, site)
+
+    assert counts == {"done": 3, "skipped": 1}
+    assert site.fetched("/private/secret") == 0
+    assert site.fetched("/robots.txt") == 1
+
+
+def test_retries_429_honouring_retry_after(tmp_path):
+    store = CrawlStore(str(tmp_path / "crawl.sqlite3"))
+    site = Site(failures={"/a": [429, 429]})
+
+    counts = crawl(store, site)
+
+    assert counts == {"done": 3, "skipped": 1}
+    assert site.fetched("/a") == 3
+
+
+def test_resumes_failed_pages_without_refetching_done_ones(tmp_path):
+    path = str(tmp_path / "crawl.sqlite3")
+    store = CrawlStore(path)
+    assert crawl(store, Site(failures={"/b": [503]}), max_retries=0) == {
+        "done": 2,
+        "failed": 1,
+        "skipped": 1,
+    }
+    store.close()
+
+    store = CrawlStore(path)
+    site = Site()
+    counts = crawl(store, site)
+
+    assert counts == {"done": 3, "skipped": 1}
+    assert site.fetched("/b") == 1
+    assert site.fetched("/") == 0
+    assert site.fetched("/a") == 0
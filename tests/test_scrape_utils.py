@@ -0,0 +1,78 @@
+import httpx
+import pytest
+
+import scrape_utils
+from page_archive import PageArchive
+from scrape_utils import BASE_URL, scrape_substance_reports
+
+
+class Erowid:
+    """
+    Mock transport for substance listing pages linking to report pages; `down` holds
+    report IDs that currently answer 503.
+    """
+
+    def __init__(self, listings):
+        self.listings = listings
+        self.down = set()
+        self.requests = []
+        self.transport = httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(str(request.url))
+        if request.url.path == "/robots.txt":
+            return httpx.Response(404)
+        exp_id = request.url.params.get("ID")
+        if exp_id is None:
+            links = self.listings[request.url.path.rsplit("/", 1)[-1]]
+            html = "".join(f'<a href="exp.php?ID={i}">{i}</a>' for i in links)
+            return httpx.Response(200, text=html)
+        if exp_id in self.down:
+            return httpx.Response(503)
+        return httpx.Response(
+            200, text=f'<div class="report-text-surround">Report {exp_id}</div>'
+        )
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(scrape_utils, "CRAWL_STATE_DIR", str(tmp_path / "state"))
+    archive = PageArchive(str(tmp_path / "archive"))
+    yield archive
+    archive.close()
+
+
+def scrape(site, substance, archive):
+    return scrape_substance_reports(
+        BASE_URL + substance,
+        archive=archive,
+        requests_per_second=1000,
+        max_retries=0,
+        transport=site.transport,
+    )
+
+
+def test_resumed_and_repeated_crawls_return_every_report(archive):
+    site = Erowid({"lsd": ["1", "2"]})
+    site.down = {"2"}
+    assert scrape(site, "lsd", archive) == ["Report 1"]
+
+    # Resuming fetches only the failed page, but returns the earlier run's report too
+    site.down, site.requests = set(), []
+    assert scrape(site, "lsd", archive) == ["Report 1", "Report 2"]
+    assert BASE_URL + "exp.php?ID=1" not in site.requests
+
+    # A finished crawl revisits the listing and picks up new reports
+    site.listings["lsd"].append("3")
+    assert scrape(site, "lsd", archive) == ["Report 1", "Report 2", "Report 3"]
+
+
+def test_substances_keep_separate_frontiers(archive):
+    site = Erowid({"lsd": ["1", "2"], "dmt": ["3"]})
+    site.down = {"2"}
+    scrape(site, "lsd", archive)
+
+    # LSD's unfinished page is not fetched (or reported) as a DMT report
+    site.down, site.requests = set(), []
+    assert scrape(site, "dmt", archive) == ["Report 3"]
+    assert BASE_URL + "exp.php?ID=2" not in site.requests
@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+from search_index import SearchIndex, to_fts_query
+
+REPORTS = pd.DataFrame(
+    {
+        "ID": [1, 2, 3],
+        "title": ["Ego death", "Nausea at the peak", "A quiet evening"],
+        "text": [
+            "The ego dissolved completely.",
+            "Strong nausea before the come-up.",
+            "Nothing much happened.",
+        ],
+        "substance": ["LSD", "LSD", "LSD"],
+    }
+)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "search.sqlite3"))
+    index.index_dataframe("LSD_reports", REPORTS)
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("ego OR the OR nausea", '"ego" OR "nausea"'),
+        ("ego AND OR nausea", '"ego" AND "nausea"'),
+        ("OR the ego NOT", '"ego"'),
+        ("the OR", ""),
+    ],
+)
+def test_stopwords_between_operators(query, expected):
+    assert to_fts_query(query) == expected
+
+
+def test_search_with_stopwords_between_operators(index):
+    hits = index.search("ego OR the OR nausea", dataset="LSD_reports")
+
+    assert sorted(hit.key for hit in hits) == ["1", "2"]
+
+
+def test_unparseable_query_raises_value_error(index, monkeypatch):
+    # What the query used to become before repeated operators were collapsed
+    monkeypatch.setattr("search_index.to_fts_query", lambda query: '"ego" OR OR "nausea"')
+
+    with pytest.raises(ValueError, match="Could not parse query"):
+        index.search("ego OR the OR nausea")
@@ -0,0 +1,24 @@
+from typing import Any, Dict
+
+
+def normalize_item(item: str) -> str:
+    """
+    Dedup key for a theme or emotion: case, surrounding punctuation and whitespace are ignored.
+    """
+    return " ".join(str(item).strip().strip(".,;:!-\"'").lower().split())
+
+
+def count_unique_items(items) -> Dict[str, Any]:
+    """
+    Collapse items that only differ in formatting, returning
+    {normalized key: {"item": first spelling seen, "count": occurrences}}.
+    """
+    unique = {}
+    for item in items:
+        key = normalize_item(item)
+        if not key:
+            continue
+        if key not in unique:
+            unique[key] = {"item": str(item).strip(), "count": 0}
+        unique[key]["count"] += 1
+    return unique